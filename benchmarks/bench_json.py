@@ -0,0 +1,73 @@
+"""
+Benchmark JSON serialization of the graph payloads.
+
+Compares the old path (lists + plotly's PlotlyJSONEncoder) with the
+serializer in webserver/serialize.py, using a synthetic heatmap of the same
+shape generate_datasets() returns (20 depths, 3 hour bins).
+
+Usage:
+    python benchmarks/bench_json.py --years 2 --repeat 5
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import plotly
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'webserver'))
+import serialize  # noqa: E402
+
+depth_set = [0.5 + i for i in range(20)]
+
+
+def make_heatmap(years, as_lists):
+    x = pd.date_range('2025-01-01', periods=int(years * 365 * 8), freq='3h')
+    z = np.random.default_rng(0).normal(10, 2, size=(len(depth_set), len(x))).round(4)
+    z[:, ::7] = np.nan  # gaps, as in the real data
+    y = -1 * np.array(depth_set)
+    if as_lists:
+        z, y = z.tolist(), y.tolist()
+    return dict(data=[dict(z=z, x=x, y=y, type='heatmap')],
+                layout=dict(title='bench', connectgaps=False))
+
+
+def make_scatter(years):
+    days = pd.date_range('2025-01-01', periods=int(years * 365), freq='D').date.tolist()
+    counts = np.random.default_rng(0).integers(1, 12, len(days)).tolist()
+    return [dict(data=[dict(x=days, y=counts, type='Scatter', mode='markers')],
+                 layout=dict(title='bench'))]
+
+
+def timeit(func, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = func()
+        best = min(best, time.perf_counter() - t0)
+    return best, len(out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--years', type=float, default=2, help='Years of data in the synthetic graphs')
+    parser.add_argument('--repeat', type=int, default=5, help='Repetitions, the best time is reported')
+    args = parser.parse_args()
+
+    cases = [
+        ('heatmap', make_heatmap(args.years, as_lists=True), make_heatmap(args.years, as_lists=False)),
+        ('scatter', make_scatter(args.years), make_scatter(args.years)),
+    ]
+    print(f"orjson available: {serialize.orjson is not None}")
+    print(f"{'payload':10} {'before (s)':>12} {'after (s)':>12} {'speedup':>8} {'size (MB)':>10}")
+    for name, before_obj, after_obj in cases:
+        t_before, size = timeit(lambda: json.dumps(before_obj, cls=plotly.utils.PlotlyJSONEncoder), args.repeat)
+        t_after, _ = timeit(lambda: serialize.dumps_bytes(after_obj), args.repeat)
+        print(f"{name:10} {t_before:12.4f} {t_after:12.4f} {t_before / t_after:8.1f} {size / 1e6:10.2f}")
+
+
+if __name__ == "__main__":
+    main()
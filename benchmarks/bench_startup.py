@@ -0,0 +1,69 @@
+"""
+Benchmark webserver cold start.
+
+Each run starts a fresh Python process, imports webserver/webserver.py (as a
+WSGI worker does on boot) and then requests the front page and the two
+download pages, so the cost of anything deferred to the first request is
+measured as well. config.json must point at a database, but the timed
+requests only touch it lightly.
+
+Usage:
+    python benchmarks/bench_startup.py --repeat 5
+    python benchmarks/bench_startup.py --webserver-dir /path/to/other/checkout/webserver
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# Runs in the child process, prints the timings as JSON
+CHILD = r"""
+import json, sys, time
+t0 = time.perf_counter()
+import webserver
+t_import = time.perf_counter() - t0
+client = webserver.app.test_client()
+timings = {'import': t_import}
+for name, url in [('front page', '/'), ('download (no)', '/download/'), ('download (en)', '/download/en/')]:
+    t = time.perf_counter()
+    status = client.get(url).status_code
+    timings[name] = time.perf_counter() - t
+    if status != 200:
+        sys.exit(f"{url} returned {status}")
+timings['total'] = time.perf_counter() - t0
+print(json.dumps(timings))
+"""
+
+
+def run_once(webserver_dir):
+    out = subprocess.run([sys.executable, '-c', CHILD], cwd=webserver_dir, capture_output=True, text=True)
+    if out.returncode != 0:
+        sys.exit(out.stderr)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def dash_imported_at_boot(webserver_dir):
+    code = "import sys, webserver; print('dash' in sys.modules)"
+    out = subprocess.run([sys.executable, '-c', code], cwd=webserver_dir, capture_output=True, text=True)
+    return out.stdout.strip().splitlines()[-1] if out.returncode == 0 else 'error'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5, help='Number of cold starts, the median is reported')
+    parser.add_argument('--webserver-dir', default=os.path.join(os.path.dirname(__file__), '..', 'webserver'),
+                        help='Directory with webserver.py (default: this checkout)')
+    args = parser.parse_args()
+
+    runs = [run_once(args.webserver_dir) for _ in range(args.repeat)]
+    print(f"{'step':<16} {'median (s)':>11} {'min (s)':>9}")
+    for key in runs[0]:
+        values = [run[key] for run in runs]
+        print(f"{key:<16} {statistics.median(values):>11.3f} {min(values):>9.3f}")
+    print(f"dash imported at boot: {dash_imported_at_boot(args.webserver_dir)}")
+
+
+if __name__ == '__main__':
+    main()
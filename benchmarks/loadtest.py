@@ -0,0 +1,286 @@
+"""
+HTTP load test of the webserver.
+
+Sends concurrent requests to each route of a running webserver (Flask or the
+async app) and reports p50/p95/p99 latency and throughput per route. Each
+route is tested on its own: `--concurrency` workers send `--requests`
+requests between them. The dates are taken from /api/v2/stats, so the
+test works with any data (see seed_data.py for synthetic data).
+
+The report can be saved as JSON and compared with an earlier run. Routes
+that got slower (p95) or slower in throughput by more than --threshold are
+marked, and the exit code is 1 if there are any.
+
+Usage:
+    python webserver/webserver.py &                     # or uvicorn async_api:app --port 8077
+    python benchmarks/loadtest.py --base-url http://127.0.0.1:8076 --output before.json
+    ... change something, restart the server ...
+    python benchmarks/loadtest.py --base-url http://127.0.0.1:8076 --compare before.json
+    python benchmarks/loadtest.py --routes heatmap resampledday --requests 200
+"""
+import argparse
+import json
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import numpy as np
+
+DATATYPES = ['temperature', 'salinity', 'oxygen', 'fluorescence', 'turbidity']
+OLD_DATATYPES = ['temp', 'salt', 'oxygene', 'fluorescens', 'turbidity']
+
+
+def dash_payload(outputs, inputs, state):
+    """
+    Body of a Dash callback request (POST /download/_dash-update-component).
+    """
+    output_ids = [{'id': i, 'property': p} for i, p in outputs]
+    return {
+        'output': '..' + '...'.join(f'{i}.{p}' for i, p in outputs) + '..',
+        'outputs': output_ids,
+        'inputs': [{'id': i, 'property': p, 'value': v} for i, p, v in inputs],
+        'state': [{'id': i, 'property': p, 'value': v} for i, p, v in state],
+        'changedPropIds': [f'{inputs[0][0]}.{inputs[0][1]}'],
+    }
+
+
+def date_picker_payload(start, end):
+    return dash_payload(
+        [('time-series-graph', 'figure'), ('date-picker-range', 'start_date'),
+         ('date-picker-range', 'end_date'), ('dives-count-box', 'children')],
+        [('date-picker-range', 'start_date', start), ('date-picker-range', 'end_date', end),
+         ('time-series-graph', 'relayoutData', None)],
+        [('language', 'data', 'no')])
+
+
+def resampled_download_payload(start, end, download_format):
+    return dash_payload(
+        [('download-resampled-data', 'data'), ('download-resampled-location', 'href')],
+        [('download-button', 'n_clicks', 1)],
+        [('date-picker-range', 'start_date', start), ('date-picker-range', 'end_date', end),
+         ('depth-range-slider', 'value', [0.5, 19.5]), ('resampling-interval-radio', 'value', '3H'),
+         ('depth-aggregation-radio', 'value', 'all_selected'),
+         ('parameter-checklist', 'value', DATATYPES),
+         ('download-format-radio', 'value', download_format), ('language', 'data', 'no')])
+
+
+def make_routes(days, rng):
+    """
+    name -> function returning (method, path, body) for one request. days are the days with data.
+    """
+    def random_day():
+        return days[rng.integers(len(days))]
+
+    def random_range(length):
+        start = random_day()
+        return start, start + timedelta(days=length - 1)
+
+    def resampledday():
+        return 'GET', f"/resampledday/{OLD_DATATYPES[rng.integers(5)]}/{random_day():%Y%m%d}.json", None
+
+    def resampled_month():
+        start, end = random_range(30)
+        return 'GET', f"/api/v2/resampled/{DATATYPES[rng.integers(5)]}.json?start={start:%Y-%m-%d}&end={end:%Y-%m-%d}", None
+
+    def series_year():
+        start, end = random_range(365)
+        return 'GET', f"/api/v2/series/{DATATYPES[rng.integers(5)]}.json?depth=2.5&start={start:%Y-%m-%d}&end={end:%Y-%m-%d}", None
+
+    def heatmap_tile():
+        return 'GET', f"/api/v2/heatmap/{DATATYPES[rng.integers(5)]}/3H/{random_day():%Y-%m}.json", None
+
+    def download_csv():
+        start, end = random_range(7)
+        parameters = '&'.join(f'parameters={p}' for p in DATATYPES)
+        return 'GET', f"/api/v2/download/resampled.csv?start={start:%Y-%m-%d}&end={end:%Y-%m-%d}&{parameters}", None
+
+    def dash_date_picker():
+        start, end = random_range(30)
+        return 'POST', '/download/_dash-update-component', date_picker_payload(f'{start:%Y-%m-%d}', f'{end:%Y-%m-%d}')
+
+    def dash_download_xlsx():
+        start, end = random_range(7)
+        return 'POST', '/download/_dash-update-component', \
+            resampled_download_payload(f'{start:%Y-%m-%d}', f'{end:%Y-%m-%d}', 'xlsx')
+
+    return {
+        'frontpage': lambda: ('GET', '/', None),
+        'allgraphs': lambda: ('GET', '/allgraphs', None),
+        'heatmap': lambda: ('GET', f"/api/v1/heatmap/{DATATYPES[rng.integers(5)]}.json", None),
+        'heatmap_tile': heatmap_tile,
+        'resampledday': resampledday,
+        'resampled_month': resampled_month,
+        'series_year': series_year,
+        'stats': lambda: ('GET', '/api/v2/stats', None),
+        'count': lambda: ('GET', '/count', None),
+        'download_csv': download_csv,
+        'dash_date_picker': dash_date_picker,
+        'dash_download_xlsx': dash_download_xlsx,
+    }
+
+
+def send(base_url, method, path, body, compress, timeout):
+    """
+    Send one request. Returns (seconds, status, response bytes).
+    """
+    headers = {'Accept-Encoding': 'gzip' if compress else 'identity'}
+    data = None
+    if body is not None:
+        data = json.dumps(body).encode('utf-8')
+        headers['Content-Type'] = 'application/json'
+    request = urllib.request.Request(base_url + path, data=data, headers=headers, method=method)
+    t0 = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            size = len(response.read())
+            status = response.status
+    except urllib.error.HTTPError as e:
+        size = len(e.read())
+        status = e.code
+    except (urllib.error.URLError, TimeoutError) as e:
+        return time.perf_counter() - t0, f'error: {e}', 0
+    return time.perf_counter() - t0, status, size
+
+
+def run_route(base_url, make_request, n_requests, concurrency, compress, timeout):
+    """
+    Send n_requests requests from concurrency threads and return the statistics.
+    """
+    requests = [make_request() for _ in range(n_requests)]  # made up front, the generators are not thread safe
+    results = []
+    lock = threading.Lock()
+
+    def worker(req):
+        result = send(base_url, *req, compress=compress, timeout=timeout)
+        with lock:
+            results.append(result)
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(worker, requests))
+    wall = time.perf_counter() - t0
+
+    latencies = np.array([r[0] for r in results])
+    errors = [r[1] for r in results if r[1] != 200]
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {
+        'requests': n_requests,
+        'errors': len(errors),
+        'error_examples': sorted(set(str(e) for e in errors))[:3],
+        'p50_ms': round(p50 * 1000, 1),
+        'p95_ms': round(p95 * 1000, 1),
+        'p99_ms': round(p99 * 1000, 1),
+        'mean_ms': round(latencies.mean() * 1000, 1),
+        'throughput_rps': round(n_requests / wall, 2),
+        'mean_kb': round(np.mean([r[2] for r in results]) / 1024, 1),
+    }
+
+
+def data_days(base_url, timeout):
+    """
+    Days with dives, from /api/v2/stats (CSV with date,dives).
+    """
+    with urllib.request.urlopen(base_url + '/api/v2/stats', timeout=timeout) as response:
+        lines = response.read().decode('utf-8').splitlines()[1:]
+    days = [datetime.strptime(line.split(',')[0][:10], '%Y-%m-%d') for line in lines if line]
+    if not days:
+        sys.exit("No dives in the database, seed it first (benchmarks/seed_data.py).")
+    return days
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(report, previous=None, threshold=0.2):
+    """
+    Print the report, with the change from previous if given. Returns the names of regressed routes.
+    """
+    regressions = []
+    if previous is None:
+        print(f"{'route':<20} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>8} {'KB':>8} {'errors':>7}")
+        for name, r in report['routes'].items():
+            print(f"{name:<20} {r['p50_ms']:>9} {r['p95_ms']:>9} {r['p99_ms']:>9} {r['throughput_rps']:>8} "
+                  f"{r['mean_kb']:>8} {r['errors']:>7}")
+        return regressions
+
+    print(f"Compared with {previous['meta'].get('commit')} at {previous['meta'].get('time')}")
+    print(f"{'route':<20} {'p50 ms':>17} {'p95 ms':>17} {'req/s':>15} {'errors':>7}")
+    for name, r in report['routes'].items():
+        old = previous['routes'].get(name)
+        if old is None:
+            print(f"{name:<20} {r['p50_ms']:>17} {r['p95_ms']:>17} {r['throughput_rps']:>15} {r['errors']:>7}  (new)")
+            continue
+        slower = r['p95_ms'] > old['p95_ms'] * (1 + threshold)
+        less_throughput = r['throughput_rps'] < old['throughput_rps'] * (1 - threshold)
+        flag = '  REGRESSION' if slower or less_throughput or r['errors'] > old['errors'] else ''
+        if flag:
+            regressions.append(name)
+        print(f"{name:<20} {old['p50_ms']:>8}->{r['p50_ms']:<8} {old['p95_ms']:>8}->{r['p95_ms']:<8} "
+              f"{old['throughput_rps']:>7}->{r['throughput_rps']:<7} {r['errors']:>7}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--base-url', default='http://127.0.0.1:8076', help='URL of the running webserver')
+    parser.add_argument('--routes', nargs='*', help='Routes to test (default: all)')
+    parser.add_argument('--requests', type=int, default=100, help='Requests per route')
+    parser.add_argument('--concurrency', type=int, default=8, help='Concurrent requests')
+    parser.add_argument('--warmup', type=int, default=2, help='Unmeasured requests per route first')
+    parser.add_argument('--timeout', type=float, default=120, help='Request timeout in seconds')
+    parser.add_argument('--no-compression', action='store_true', help='Do not send Accept-Encoding: gzip')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for the dates and datatypes')
+    parser.add_argument('--output', help='Save the report as JSON')
+    parser.add_argument('--compare', help='Earlier JSON report to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Relative change in p95 or throughput that counts as a regression')
+    args = parser.parse_args()
+
+    base_url = args.base_url.rstrip('/')
+    rng = np.random.default_rng(args.seed)
+    routes = make_routes(data_days(base_url, args.timeout), rng)
+    names = args.routes or list(routes)
+    unknown = [name for name in names if name not in routes]
+    if unknown:
+        sys.exit(f"Unknown routes: {unknown}. Valid options are: {list(routes)}")
+
+    report = {
+        'meta': {'time': datetime.now().isoformat(timespec='seconds'), 'commit': git_commit(),
+                 'base_url': base_url, 'requests': args.requests, 'concurrency': args.concurrency,
+                 'compression': not args.no_compression},
+        'routes': {},
+    }
+    for name in names:
+        for _ in range(args.warmup):
+            send(base_url, *routes[name](), compress=not args.no_compression, timeout=args.timeout)
+        report['routes'][name] = run_route(base_url, routes[name], args.requests, args.concurrency,
+                                           not args.no_compression, args.timeout)
+        print(f"{name}: done", file=sys.stderr)
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    regressions = print_report(report, previous, args.threshold)
+    for name, r in report['routes'].items():
+        if r['errors']:
+            print(f"{name}: {r['errors']} failed requests, e.g. {r['error_examples']}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+"""
+Seed a local Postgres database with synthetic dive data for load tests.
+
+Creates dives for a configurable number of years and dives per day, with
+session data (weather), interpolated data (20 depths) and optionally raw
+data, using COPY. Values follow a seasonal cycle and a depth gradient so the
+heatmaps look like real data. The dives are written with their own device
+name, so they can be removed again with --clear without touching real data.
+
+The schema must exist (pgsql_init/create_database.sql).
+
+Usage:
+    python benchmarks/seed_data.py --years 3 --dives-per-day 8
+    python benchmarks/seed_data.py --years 10 --dives-per-day 8 --raw-rows 0   # skip raw data
+    python benchmarks/seed_data.py --clear
+"""
+import argparse
+import io
+import json
+import os
+import uuid
+
+import numpy as np
+import pandas as pd
+import psycopg2
+
+depth_set = [0.5 + i for i in range(20)]
+
+
+def default_dbconn():
+    path = os.path.join(os.path.dirname(__file__), '..', 'webserver', 'config.json')
+    if not os.path.exists(path):
+        path = os.path.join(os.path.dirname(__file__), '..', 'config.json')
+    with open(path) as f:
+        return json.load(f).get('pg_conn')
+
+
+def copy_rows(cur, table, columns, rows):
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join('\\N' if v is None else str(v) for v in row))
+        buffer.write('\n')
+    buffer.seek(0)
+    cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buffer)
+
+
+def make_month(rng, month_start, month_end, dives_per_day, raw_rows, device, first_profile):
+    """
+    Rows for session_data, interpolated_timeseries and raw_timeseries for the dives in one month.
+    """
+    days = pd.date_range(month_start, month_end - pd.Timedelta(days=1), freq='D')
+    # Dives every 24 / dives_per_day hours, a few minutes late
+    offsets = np.arange(dives_per_day) * (24 / dives_per_day)
+    starts = (days.values[:, None] + (offsets * 3600e9).astype('timedelta64[ns]')[None, :]).ravel()
+    starts = starts + rng.integers(0, 50 * 60, len(starts)).astype('timedelta64[s]')
+    starts = pd.DatetimeIndex(starts).floor('s')
+    n = len(starts)
+    season = np.cos(2 * np.pi * (starts.dayofyear.values - 220) / 365.25)  # 1 in August
+
+    sessions, interpolated, raw = [], [], []
+    for i, ts in enumerate(starts):
+        sessionid = str(uuid.uuid4())
+        sessions.append((sessionid, device, first_profile + i, ts, round(10 + 8 * season[i] + rng.normal(0, 2), 2),
+                         'SRID=4326;POINT(5.3 60.4)', f'{device}_{first_profile + i}.txt',
+                         round(abs(rng.normal(5, 3)), 1), round(rng.uniform(0, 360)), round(rng.normal(1010, 10), 1)))
+        depth = np.array(depth_set)
+        temperature = 8 + 6 * season[i] * np.exp(-depth / 8) + rng.normal(0, 0.2, 20)
+        salinity = 30 + 3 * (1 - np.exp(-depth / 5)) + rng.normal(0, 0.1, 20)
+        oxygen = 300 + 20 * season[i] - 2 * depth + rng.normal(0, 3, 20)
+        fluorescence = np.clip(1 + season[i] * np.exp(-depth / 6) + rng.normal(0, 0.1, 20), 0, None)
+        turbidity = np.clip(0.5 + rng.normal(0, 0.1, 20), 0, None)
+        for j in range(20):
+            interpolated.append((sessionid, j, round(salinity[j], 4), round(temperature[j], 4), depth[j],
+                                 round(oxygen[j], 4), round(fluorescence[j], 4), round(turbidity[j], 4)))
+        if raw_rows:
+            pressure = np.linspace(0, 20, raw_rows)
+            for j in range(raw_rows):
+                k = min(int(pressure[j]), 19)
+                raw.append((sessionid, ts, j, round(salinity[k], 4), round(temperature[k], 4), round(pressure[j], 3),
+                            round(oxygen[k], 4), round(fluorescence[k], 4), round(turbidity[k], 4)))
+    return sessions, interpolated, raw, n
+
+
+def seed(dbconn, start, years, dives_per_day, raw_rows, device, seed_value=0):
+    rng = np.random.default_rng(seed_value)
+    months = pd.date_range(pd.Timestamp(start).replace(day=1), periods=int(round(years * 12)) + 1, freq='MS')
+    total = 0
+    with psycopg2.connect(dbconn) as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT COALESCE(MAX(profilenumber), 0) FROM session_data WHERE devicename = %s;", (device,))
+            profile = cur.fetchone()[0] + 1
+        for month_start, month_end in zip(months[:-1], months[1:]):
+            sessions, interpolated, raw, n = make_month(rng, month_start, month_end, dives_per_day,
+                                                        raw_rows, device, profile)
+            with conn.cursor() as cur:
+                copy_rows(cur, 'session_data', ['sessionid', 'devicename', 'profilenumber', 'startdatetime', 'airtemp',
+                                                'location', 'filename', 'windspeed', 'winddirection', 'airpressure'],
+                          sessions)
+                copy_rows(cur, 'interpolated_timeseries', ['sessionid', 'seq', 'salinity', 'temperature',
+                                                           'pressure_dbar', 'oxygen', 'fluorescence', 'turbidity'],
+                          interpolated)
+                if raw:
+                    cur.execute("SELECT ensure_raw_timeseries_partition(%s);", (month_start.to_pydatetime(),))
+                    copy_rows(cur, 'raw_timeseries', ['sessionid', 'startdatetime', 'seq', 'salinity', 'temperature',
+                                                      'pressure_dbar', 'oxygen', 'fluorescence', 'turbidity'], raw)
+            conn.commit()
+            profile += n
+            total += n
+            print(f"{month_start:%Y-%m}: {n} dives")
+        with conn.cursor() as cur:
+            cur.execute("ANALYZE session_data; ANALYZE interpolated_timeseries; ANALYZE raw_timeseries;")
+    return total
+
+
+def clear(dbconn, device):
+    with psycopg2.connect(dbconn) as conn:
+        with conn.cursor() as cur:
+            # raw_timeseries and interpolated_timeseries are removed by ON DELETE CASCADE
+            cur.execute("DELETE FROM session_data WHERE devicename = %s;", (device,))
+            return cur.rowcount
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dbconn', default=None, help='Connection string (default: pg_conn in config.json)')
+    parser.add_argument('--start', default='2020-01-01', help='First day of the synthetic data')
+    parser.add_argument('--years', type=float, default=3, help='Years of data')
+    parser.add_argument('--dives-per-day', type=int, default=8, help='Dives per day')
+    parser.add_argument('--raw-rows', type=int, default=110, help='Raw rows per dive (0: no raw data)')
+    parser.add_argument('--device', default='loadtest', help='Device name of the synthetic dives')
+    parser.add_argument('--clear', action='store_true', help='Remove the synthetic dives instead')
+    args = parser.parse_args()
+    dbconn = args.dbconn or default_dbconn()
+    if args.clear:
+        print(f"Removed {clear(dbconn, args.device)} dives")
+    else:
+        total = seed(dbconn, args.start, args.years, args.dives_per_day, args.raw_rows, args.device)
+        print(f"Added {total} dives")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+"""
+Archive old months of raw_timeseries.
+
+raw_timeseries is partitioned by month (see pgsql_init/create_database.sql).
+This script writes the partitions older than a given number of months to
+gzipped CSV files in the archive directory, then detaches them and drops the
+detached tables (unless --keep is given). Ingests and reads of the other months
+are not blocked while a partition is copied.
+
+Session data and the interpolated data are not touched, only the raw readings
+are removed from the database.
+
+Usage:
+    python3 fetchdata/archive_partitions.py --older-than 24 --archive-dir /local/webdata/gabriel/archive
+    python3 fetchdata/archive_partitions.py --older-than 24 --dry-run
+"""
+import argparse
+import datetime
+import gzip
+import json
+import logging
+import os
+import re
+
+import psycopg2
+from psycopg2 import sql
+
+logger = logging.getLogger()
+handler = logging.StreamHandler()
+formatter = logging.Formatter('%(asctime)s %(name)-2s %(levelname)-8s %(message)s')
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.setLevel(logging.DEBUG)
+
+partition_pattern = re.compile(r'^raw_timeseries_(\d{4})_(\d{2})$')
+
+
+def list_partitions(conn):
+    """
+    Return [(partition name, first day of month)] for the attached monthly partitions, oldest first.
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT c.relname
+            FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'raw_timeseries'::regclass;
+        """)
+        names = [row[0] for row in cur.fetchall()]
+    partitions = []
+    for name in names:
+        match = partition_pattern.match(name)
+        if match:
+            partitions.append((name, datetime.date(int(match.group(1)), int(match.group(2)), 1)))
+    return sorted(partitions, key=lambda p: p[1])
+
+
+def archive_partition(conn, name, archive_dir, keep=False, lock_timeout='10s'):
+    """
+    Write partition name to archive_dir/<name>.csv.gz, then detach it and drop it unless keep is set.
+
+    The partition is copied while it is still attached, with a SHARE lock on the partition only, so
+    ingests into other months and reads of raw_timeseries go on. The detach takes an ACCESS EXCLUSIVE
+    lock on raw_timeseries, so it runs in a short transaction of its own, waits at most lock_timeout
+    for the lock and is only committed when the partition still has the rows that were archived.
+
+    Returns:
+        bool: True if the partition was archived, False if it is left attached (try again later).
+    """
+    path = os.path.join(archive_dir, f"{name}.csv.gz")
+    partition = sql.Identifier(name)
+    try:
+        with conn.cursor() as cur:
+            # A late dive for this month waits until the copy is done
+            cur.execute(sql.SQL("LOCK TABLE {} IN SHARE MODE;").format(partition))
+            with gzip.open(path + '.part', 'wb') as fh:
+                cur.copy_expert(sql.SQL("COPY {} TO STDOUT WITH (FORMAT csv, HEADER)").format(partition), fh)
+            copied = cur.rowcount
+        os.replace(path + '.part', path)
+        conn.rollback()
+    except (psycopg2.Error, OSError) as e:
+        conn.rollback()
+        logger.error("Could not archive %s: %s", name, e)
+        return False
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SET LOCAL lock_timeout = %s;", (lock_timeout,))
+            cur.execute(sql.SQL("LOCK TABLE {} IN SHARE MODE;").format(partition))
+            cur.execute(sql.SQL("SELECT COUNT(*) FROM {};").format(partition))
+            if cur.fetchone()[0] != copied:
+                conn.rollback()
+                logger.warning("%s changed while it was archived, it is left attached", name)
+                return False
+            cur.execute(sql.SQL("ALTER TABLE raw_timeseries DETACH PARTITION {};").format(partition))
+            if keep:
+                # Rename so a late dive for this month gets a new partition
+                cur.execute(sql.SQL("ALTER TABLE {} RENAME TO {};").format(
+                    partition, sql.Identifier(f"archived_{name}")))
+            else:
+                cur.execute(sql.SQL("DROP TABLE {};").format(partition))
+        conn.commit()
+    except psycopg2.Error as e:
+        conn.rollback()
+        logger.error("Could not detach %s, it is archived in %s but left attached: %s", name, path, e)
+        return False
+    logger.info("Archived %s to %s", name, path)
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Archive old months of raw_timeseries')
+    parser.add_argument('--older-than', type=int, required=True,
+                        help='Archive months that ended more than this many months ago')
+    parser.add_argument('--archive-dir', help='Directory for the archived CSV files')
+    parser.add_argument('--keep', action='store_true',
+                        help='Keep the detached tables (renamed to archived_<name>) instead of dropping them')
+    parser.add_argument('--dry-run', action='store_true', help='Only list the partitions that would be archived')
+    args = parser.parse_args()
+    if not args.dry_run and not args.archive_dir:
+        parser.error('--archive-dir is required unless --dry-run is given')
+
+    # no errorhandling
+    with open("config.json", "r") as f:
+        configdata = json.loads(f.read())
+
+    today = datetime.date.today()
+    month_index = today.year * 12 + today.month - 1 - args.older_than
+    cutoff = datetime.date(month_index // 12, month_index % 12 + 1, 1)
+
+    conn = psycopg2.connect(configdata["pg_conn"])
+    old_partitions = [name for name, month in list_partitions(conn) if month < cutoff]
+    if args.dry_run:
+        for name in old_partitions:
+            print(name)
+    else:
+        os.makedirs(args.archive_dir, exist_ok=True)
+        for name in old_partitions:
+            archive_partition(conn, name, args.archive_dir, keep=args.keep)
+    conn.close()
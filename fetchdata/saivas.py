@@ -11,6 +11,7 @@ import os.path
 import time
 import psycopg2, psycopg2.extras
 import arrow
+import json
 from decode import Decoder
 import logging
 
@@ -84,15 +85,20 @@ class SaivasServer(object):
     
     def prepare_statements(self):
         """Prepare SQL statements for use in the decoding process."""
-        self.check_query = "SELECT COUNT(*) FROM session_data WHERE profilenumber = %s;"
+        # Uses the unique index on (devicename, profilenumber)
+        self.check_query = "SELECT COUNT(*) FROM session_data WHERE devicename = %s AND profilenumber = %s;"
         self.insert_query = """
         INSERT INTO session_data (sessionid, devicename, profilenumber, startdatetime, airtemp, location, filename, windspeed, winddirection, airpressure)
         VALUES (%s, %s, %s, %s, %s, ST_GeomFromText(%s, 4326), %s, %s, %s, %s);
         """
+        # raw_timeseries is partitioned by month on startdatetime, the partition is created if needed
+        self.ensure_partition_query = "SELECT ensure_raw_timeseries_partition(%s);"
         self.insert_timeseries_query = """
-        INSERT INTO raw_timeseries (sessionid, seq, salinity, temperature, pressure_dbar, oxygen, fluorescence, turbidity)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s);
+        INSERT INTO raw_timeseries (sessionid, startdatetime, seq, salinity, temperature, pressure_dbar, oxygen, fluorescence, turbidity)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s);
         """
+        # Tells the webserver (/api/v2/events) about the new dive, sent when the dive is committed
+        self.notify_query = "SELECT pg_notify('new_dive', %s);"
 
     def decodeall(self, max_age = None):
         """
@@ -111,7 +117,7 @@ class SaivasServer(object):
                         if "profilenumber" in mydive.datadict:
                             with self.conn.cursor() as cursor:
                                 # Sjekk om 'profilenumber' allerede finnes i databasen
-                                cursor.execute(self.check_query, (mydive.datadict["profilenumber"],))
+                                cursor.execute(self.check_query, (mydive.datadict["devicename"], mydive.datadict["profilenumber"]))
                                 count = cursor.fetchone()[0]
                                 if count == 0:
                                     # Sett inn dataene i databasen
@@ -131,9 +137,11 @@ class SaivasServer(object):
                                         mydive.datadict.get('winddirection'),
                                         mydive.datadict.get('airpressure')
                                     ))
+                                    cursor.execute(self.ensure_partition_query, (mydive.datadict['startdatetime'],))
                                     for data in mydive.datadict['rawtimeseries']:
                                         cursor.execute(self.insert_timeseries_query, (
                                             mydive.datadict['sessionid'],
+                                            mydive.datadict['startdatetime'],
                                             data['seq'],
                                             data.get('salt'),
                                             data.get('temp'),
@@ -142,6 +150,13 @@ class SaivasServer(object):
                                             data.get('fluorescens'),
                                             data.get('turbidity')
                                         ))
+                                    cursor.execute(self.notify_query, (json.dumps({
+                                        'event': 'dive',
+                                        'sessionid': str(mydive.datadict['sessionid']),
+                                        'devicename': mydive.datadict['devicename'],
+                                        'profilenumber': mydive.datadict['profilenumber'],
+                                        'startdatetime': str(mydive.datadict['startdatetime']),
+                                    }),))
                                     self.conn.commit()
                                     logger.debug('Saved %s to PostgreSQL', mydive.datadict["profilenumber"])
                 except Exception as e:
@@ -24,12 +24,21 @@ from numpy import nan
 import numpy as np
 import logging
 import psycopg2
+import psycopg2.extensions
 import json
+import os
+import sys
+
+# datacube.py is shared with the webserver
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'webserver'))
+from datacube import DataCube, VARIABLES
 
 # no errorhandling 
 with open("config.json","r") as f:
     configdata = json.loads(f.read())
 PG_CONNSTR = configdata["pg_conn"]
+# The memory-mapped copy of the interpolated data read by the webserver (optional)
+DATACUBE_DIR = configdata.get("datacube_dir")
 
 depth_set = [0.5, 1.5, 2.5, 3.5, 4.5, 5.5, 6.5, 7.5, 8.5, 9.5, 10.5, 11.5, 12.5, 13.5, 14.5, 15.5, 16.5, 17.5, 18.5,
              19.5]
@@ -42,13 +51,44 @@ handler.setFormatter(formatter)
 logger.addHandler(handler)
 logger.setLevel(logging.DEBUG)
 
-def processraw(conn, depth_set, force=False):
+def notify_profile(cursor, sessionid, startdatetime, df):
+    """
+    Tell the webserver (/api/v2/events) about the interpolated dive, sent when the transaction is committed.
+    df is the interpolated dive with pressure_dbar as the index.
+    """
+    message = {'event': 'profile', 'sessionid': str(sessionid), 'startdatetime': str(startdatetime),
+               'depth': [float(depth) for depth in df.index]}
+    for column in ['temperature', 'salinity', 'oxygen', 'fluorescence', 'turbidity']:
+        # NaN is not valid JSON
+        message[column] = [None if pd.isna(value) else round(float(value), 4) for value in df[column]]
+    cursor.execute("SELECT pg_notify('new_dive', %s);", (json.dumps(message),))
+
+def cube_profile(sessionid, startdatetime, df):
+    """
+    The interpolated dive as a dive of the data cube: values[variable][depth], NaN for missing depths.
+    """
+    values = df.reindex(depth_set)[VARIABLES].to_numpy(dtype=float).T
+    return sessionid, startdatetime, values
+
+def append_to_cube(cube, profiles):
+    """
+    Add the dives processed (and committed) to the data cube. If that fails the cube is marked stale, so the
+    webserver reads from the database until the cube is built again.
+    """
+    try:
+        cube.append(profiles)
+    except Exception as e:
+        logger.error("Could not add %d dives to the data cube, marking it stale: %s", len(profiles), e)
+        cube.mark_stale()
+
+def processraw(conn, depth_set, force=False, cube=None):
     count = 0
+    profiles = []
 
     with conn.cursor() as cursor:
         # Fetch all sessions
         cursor.execute("""
-            SELECT sessionid, COUNT(interpolated_timeseries.sessionid) 
+            SELECT sessionid, COUNT(interpolated_timeseries.sessionid), startdatetime 
             FROM session_data LEFT JOIN interpolated_timeseries USING(sessionid) 
             GROUP BY sessionid  
             ORDER BY startdatetime DESC;
@@ -58,14 +98,15 @@ def processraw(conn, depth_set, force=False):
         for row in rows_sessions:
             sessionid = row[0]  
             exists = row[1] > 0
+            startdatetime = row[2]
             if exists == 0 or force:
                 try:
-                # Fetch raw data for the session
+                # Fetch raw data for the session (startdatetime selects the raw_timeseries partition)
                     cursor.execute("""
                         SELECT seq, salinity, temperature, pressure_dbar, oxygen, fluorescence, turbidity 
                         FROM raw_timeseries 
-                        WHERE sessionid = %s ORDER BY seq;
-                    """, (sessionid,))
+                        WHERE sessionid = %s AND startdatetime = %s ORDER BY seq;
+                    """, (sessionid, startdatetime))
                     rows_all  = cursor.fetchall()
                     df = pd.DataFrame(rows_all, columns=[desc.name for desc in cursor.description])
                     # make the pressure the index of the dataframe
@@ -99,16 +140,25 @@ def processraw(conn, depth_set, force=False):
                             interpolated_row.get('turbidity')
                         ))
                     
+                    if not exists:
+                        notify_profile(cursor, sessionid, startdatetime, df)
+                    if cube is not None:
+                        profiles.append(cube_profile(sessionid, startdatetime, df))
                     count += 1
                     # logger.debug("Processed session %s with %d interpolated readings", sessionid, len(df))
                 except Exception as e:
                     logger.error("Error processing session %s: %s", sessionid, e)
                     continue            
+    # After a failed statement the commit is a rollback and none of the dives were stored
+    stored = conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_INERROR
     conn.commit() 
+    if cube is not None and stored:
+        append_to_cube(cube, profiles)
     return count
 
 
 if __name__ == "__main__":
     conn = psycopg2.connect(PG_CONNSTR)
-    count = processraw(conn, depth_set, force=False)
+    cube = DataCube(DATACUBE_DIR) if DATACUBE_DIR else None
+    count = processraw(conn, depth_set, force=False, cube=cube)
     print("Processed {} documents".format(count))
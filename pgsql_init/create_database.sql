@@ -20,17 +20,36 @@ CREATE TABLE IF NOT EXISTS session_data (
     airpressure FLOAT
 );
 
+-- raw_timeseries is partitioned by month on the dive time (copied from session_data),
+-- so time range exports only read the months involved and old months can be archived.
+-- Partitions are created at ingest by ensure_raw_timeseries_partition().
 CREATE TABLE IF NOT EXISTS raw_timeseries (
-    id SERIAL PRIMARY KEY,
+    id SERIAL,
     sessionid UUID REFERENCES session_data(sessionid) ON DELETE CASCADE,
+    startdatetime TIMESTAMP NOT NULL,
     seq INT NOT NULL,
     salinity FLOAT, 
     temperature FLOAT, 
     pressure_dbar FLOAT NOT NULL,
     oxygen FLOAT,
     fluorescence FLOAT,
-    turbidity FLOAT
-);
+    turbidity FLOAT,
+    PRIMARY KEY (id, startdatetime)
+) PARTITION BY RANGE (startdatetime);
+
+-- Create the monthly partition of raw_timeseries for ts if it does not exist. Returns the partition name.
+CREATE OR REPLACE FUNCTION ensure_raw_timeseries_partition(ts TIMESTAMP) RETURNS TEXT AS $$
+DECLARE
+    month_start TIMESTAMP := date_trunc('month', ts);
+    partition_name TEXT := 'raw_timeseries_' || to_char(month_start, 'YYYY_MM');
+BEGIN
+    IF to_regclass(partition_name) IS NULL THEN
+        EXECUTE format('CREATE TABLE IF NOT EXISTS %I PARTITION OF raw_timeseries FOR VALUES FROM (%L) TO (%L)',
+                       partition_name, month_start, month_start + INTERVAL '1 month');
+    END IF;
+    RETURN partition_name;
+END;
+$$ LANGUAGE plpgsql SECURITY DEFINER SET search_path = public;
 
 CREATE TABLE IF NOT EXISTS interpolated_timeseries (
     id SERIAL PRIMARY KEY,
@@ -46,7 +65,278 @@ CREATE TABLE IF NOT EXISTS interpolated_timeseries (
 
 
 CREATE INDEX idx_raw_timeseries_sessionid ON raw_timeseries(sessionid);
-CREATE INDEX idx_interpolated_timeseries_sessionid ON interpolated_timeseries(sessionid);
+-- The rows of a partition are inserted in dive time order, so a BRIN index is small and effective
+CREATE INDEX idx_raw_timeseries_startdatetime ON raw_timeseries USING BRIN (startdatetime);
+-- Covering index for the session_data join in the read queries: the values can be read from the index
+CREATE INDEX idx_interpolated_timeseries_covering ON interpolated_timeseries(sessionid, pressure_dbar)
+    INCLUDE (temperature, salinity, oxygen, fluorescence, turbidity);
+-- Time range filters (startdatetime >= start AND startdatetime < end)
+CREATE INDEX idx_session_data_startdatetime ON session_data(startdatetime);
+-- A dive is identified by device and profile number (used by the ingest duplicate check)
+CREATE UNIQUE INDEX idx_session_data_device_profile ON session_data(devicename, profilenumber);
+
+
+-- Climatology: sums per variable, day of year and depth of all interpolated data, kept up to date by triggers.
+-- mean = sum / n, std = sqrt((sumsq - sum^2 / n) / (n - 1)).
+-- doy is the day of year (1-366), dates after February 28 are one day later in leap years.
+CREATE TABLE IF NOT EXISTS climatology (
+    variable VARCHAR(20) NOT NULL,
+    doy SMALLINT NOT NULL,
+    pressure_dbar FLOAT NOT NULL,
+    n BIGINT NOT NULL,
+    sum DOUBLE PRECISION NOT NULL,
+    sumsq DOUBLE PRECISION NOT NULL,
+    PRIMARY KEY (variable, doy, pressure_dbar)
+);
+
+-- The variables of one interpolated row as (variable, value) rows, without missing values
+CREATE OR REPLACE FUNCTION climatology_values(temperature FLOAT, salinity FLOAT, oxygen FLOAT,
+                                              fluorescence FLOAT, turbidity FLOAT)
+RETURNS TABLE (variable VARCHAR(20), value FLOAT) AS $$
+    SELECT v.variable, v.value
+    FROM (VALUES ('temperature', temperature), ('salinity', salinity), ('oxygen', oxygen),
+                 ('fluorescence', fluorescence), ('turbidity', turbidity)) AS v(variable, value)
+    WHERE v.value IS NOT NULL AND v.value <> 'NaN';
+$$ LANGUAGE sql IMMUTABLE;
+
+-- Add the rows inserted into interpolated_timeseries (statement trigger, also for COPY)
+CREATE OR REPLACE FUNCTION climatology_add_rows() RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO climatology AS c (variable, doy, pressure_dbar, n, sum, sumsq)
+    SELECT v.variable, EXTRACT(doy FROM sd.startdatetime), r.pressure_dbar,
+           COUNT(*), SUM(v.value), SUM(v.value * v.value)
+    FROM new_rows r
+    JOIN session_data sd USING (sessionid)
+    CROSS JOIN LATERAL climatology_values(r.temperature, r.salinity, r.oxygen, r.fluorescence, r.turbidity) v
+    GROUP BY 1, 2, 3
+    ON CONFLICT (variable, doy, pressure_dbar) DO UPDATE
+        SET n = c.n + EXCLUDED.n, sum = c.sum + EXCLUDED.sum, sumsq = c.sumsq + EXCLUDED.sumsq;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Remove the interpolated rows of a dive before it is deleted (its rows go by ON DELETE CASCADE)
+CREATE OR REPLACE FUNCTION climatology_remove_session() RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE climatology c
+    SET n = c.n - d.n, sum = c.sum - d.sum, sumsq = c.sumsq - d.sumsq
+    FROM (SELECT v.variable, EXTRACT(doy FROM OLD.startdatetime) AS doy, r.pressure_dbar,
+                 COUNT(*) AS n, SUM(v.value) AS sum, SUM(v.value * v.value) AS sumsq
+          FROM interpolated_timeseries r
+          CROSS JOIN LATERAL climatology_values(r.temperature, r.salinity, r.oxygen, r.fluorescence, r.turbidity) v
+          WHERE r.sessionid = OLD.sessionid
+          GROUP BY 1, 2, 3) d
+    WHERE c.variable = d.variable AND c.doy = d.doy AND c.pressure_dbar = d.pressure_dbar;
+    RETURN OLD;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Compute the whole table again from interpolated_timeseries. Returns the number of rows.
+CREATE OR REPLACE FUNCTION climatology_rebuild() RETURNS BIGINT AS $$
+    DELETE FROM climatology;
+    INSERT INTO climatology (variable, doy, pressure_dbar, n, sum, sumsq)
+    SELECT v.variable, EXTRACT(doy FROM sd.startdatetime), r.pressure_dbar,
+           COUNT(*), SUM(v.value), SUM(v.value * v.value)
+    FROM interpolated_timeseries r
+    JOIN session_data sd USING (sessionid)
+    CROSS JOIN LATERAL climatology_values(r.temperature, r.salinity, r.oxygen, r.fluorescence, r.turbidity) v
+    GROUP BY 1, 2, 3;
+    SELECT COUNT(*) FROM climatology;
+$$ LANGUAGE sql;
+
+CREATE TRIGGER interpolated_timeseries_climatology
+    AFTER INSERT ON interpolated_timeseries
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION climatology_add_rows();
+
+CREATE TRIGGER session_data_climatology
+    BEFORE DELETE ON session_data
+    FOR EACH ROW EXECUTE FUNCTION climatology_remove_session();
+
+
+-- Surface rollup: the surface data of session_data per resampling interval, kept up to date by triggers.
+-- Counts and sums per bin, so averages over bins and ranges are sum / n. The wind is stored as the
+-- sums of the vector components u = windspeed * sin(direction) and v = windspeed * cos(direction),
+-- the average direction is DEGREES(ATAN2(sum_u, sum_v)).
+-- Bins are date_bin() with origin 2001-01-03 for 3H to 1W and calendar months for 1M, as in
+-- build_surface_query() in webserver/utils.py.
+CREATE TABLE IF NOT EXISTS surface_rollup (
+    resampling VARCHAR(3) NOT NULL,
+    ts TIMESTAMP NOT NULL,
+    dives INT NOT NULL,
+    n_airtemp INT NOT NULL,
+    sum_airtemp FLOAT,
+    n_windspeed INT NOT NULL,
+    sum_windspeed FLOAT,
+    n_airpressure INT NOT NULL,
+    sum_airpressure FLOAT,
+    n_wind INT NOT NULL,
+    sum_u FLOAT,
+    sum_v FLOAT,
+    PRIMARY KEY (resampling, ts)
+);
+
+-- The resampling intervals of the rollup
+CREATE OR REPLACE FUNCTION surface_rollup_intervals() RETURNS TABLE (resampling VARCHAR(3), step INTERVAL) AS $$
+    VALUES ('3H', INTERVAL '3 hours'), ('6H', INTERVAL '6 hours'), ('12H', INTERVAL '12 hours'),
+           ('1D', INTERVAL '1 day'), ('1W', INTERVAL '1 week'), ('1M', INTERVAL '1 month');
+$$ LANGUAGE sql IMMUTABLE;
+
+-- Start of the bin of ts
+CREATE OR REPLACE FUNCTION surface_rollup_bin(resampling VARCHAR(3), step INTERVAL, ts TIMESTAMP)
+RETURNS TIMESTAMP AS $$
+    SELECT CASE WHEN resampling = '1M' THEN date_trunc('month', ts)
+                ELSE date_bin(step, ts, TIMESTAMP '2001-01-03 00:00:00') END;
+$$ LANGUAGE sql IMMUTABLE;
+
+-- Compute the bins that overlap from_ts .. to_ts (inclusive) again from session_data
+CREATE OR REPLACE FUNCTION surface_rollup_refresh(from_ts TIMESTAMP, to_ts TIMESTAMP) RETURNS VOID AS $$
+DECLARE
+    r RECORD;
+    lo TIMESTAMP;
+    hi TIMESTAMP;
+BEGIN
+    -- One refresh at a time, so concurrent ingests see each other's dives
+    PERFORM pg_advisory_xact_lock(hashtext('surface_rollup'));
+    FOR r IN SELECT * FROM surface_rollup_intervals() LOOP
+        lo := surface_rollup_bin(r.resampling, r.step, from_ts);
+        hi := surface_rollup_bin(r.resampling, r.step, to_ts) + r.step;
+        DELETE FROM surface_rollup WHERE resampling = r.resampling AND ts >= lo AND ts < hi;
+        INSERT INTO surface_rollup (resampling, ts, dives, n_airtemp, sum_airtemp, n_windspeed, sum_windspeed,
+                                    n_airpressure, sum_airpressure, n_wind, sum_u, sum_v)
+        SELECT r.resampling, surface_rollup_bin(r.resampling, r.step, startdatetime) AS bin, COUNT(*),
+               COUNT(airtemp), SUM(airtemp), COUNT(windspeed), SUM(windspeed),
+               COUNT(airpressure), SUM(airpressure), COUNT(windspeed * winddirection),
+               SUM(windspeed * SIN(RADIANS(winddirection))), SUM(windspeed * COS(RADIANS(winddirection)))
+        FROM session_data
+        WHERE startdatetime >= lo AND startdatetime < hi
+        GROUP BY bin;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Statement triggers: compute the bins of the changed dives again
+CREATE OR REPLACE FUNCTION surface_rollup_new_rows() RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM surface_rollup_refresh(MIN(startdatetime), MAX(startdatetime)) FROM new_rows HAVING COUNT(*) > 0;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION surface_rollup_old_rows() RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM surface_rollup_refresh(MIN(startdatetime), MAX(startdatetime)) FROM old_rows HAVING COUNT(*) > 0;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER session_data_surface_rollup_insert
+    AFTER INSERT ON session_data
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION surface_rollup_new_rows();
+
+CREATE TRIGGER session_data_surface_rollup_delete
+    AFTER DELETE ON session_data
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION surface_rollup_old_rows();
+
+-- An update can move a dive to another bin, so both the old and the new bins are computed again
+CREATE TRIGGER session_data_surface_rollup_update_old
+    AFTER UPDATE ON session_data
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION surface_rollup_old_rows();
+
+CREATE TRIGGER session_data_surface_rollup_update_new
+    AFTER UPDATE ON session_data
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION surface_rollup_new_rows();
+
+
+-- Dataset summary: number of dives in total and per year, first and last dive, last ingest, kept up to date by triggers.
+-- Dives per year
+CREATE TABLE IF NOT EXISTS dataset_summary_year (
+    year SMALLINT PRIMARY KEY,
+    dives INT NOT NULL,
+    first_dive TIMESTAMP NOT NULL,
+    last_dive TIMESTAMP NOT NULL
+);
+
+-- A single row with the totals. last_ingest is the time of the last insert into session_data,
+-- updated_at of the last change of the summary (also for deletes).
+CREATE TABLE IF NOT EXISTS dataset_summary (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    dives BIGINT NOT NULL,
+    first_dive TIMESTAMP,
+    last_dive TIMESTAMP,
+    last_ingest TIMESTAMP,
+    updated_at TIMESTAMP NOT NULL
+);
+
+-- Count the years from_year .. to_year again from session_data (NULL: all years) and update the totals
+CREATE OR REPLACE FUNCTION dataset_summary_refresh(from_year INT, to_year INT, ingest BOOLEAN DEFAULT FALSE)
+RETURNS VOID AS $$
+BEGIN
+    -- One refresh at a time, so concurrent ingests see each other's dives
+    PERFORM pg_advisory_xact_lock(hashtext('dataset_summary'));
+    DELETE FROM dataset_summary_year
+    WHERE (from_year IS NULL OR year >= from_year) AND (to_year IS NULL OR year <= to_year);
+    INSERT INTO dataset_summary_year (year, dives, first_dive, last_dive)
+    SELECT EXTRACT(year FROM startdatetime), COUNT(*), MIN(startdatetime), MAX(startdatetime)
+    FROM session_data
+    WHERE (from_year IS NULL OR startdatetime >= make_timestamp(from_year, 1, 1, 0, 0, 0))
+      AND (to_year IS NULL OR startdatetime < make_timestamp(to_year + 1, 1, 1, 0, 0, 0))
+    GROUP BY 1;
+    INSERT INTO dataset_summary AS s (id, dives, first_dive, last_dive, last_ingest, updated_at)
+    SELECT TRUE, COALESCE(SUM(dives), 0), MIN(first_dive), MAX(last_dive),
+           CASE WHEN ingest THEN localtimestamp END, localtimestamp
+    FROM dataset_summary_year
+    ON CONFLICT (id) DO UPDATE
+        SET dives = EXCLUDED.dives, first_dive = EXCLUDED.first_dive, last_dive = EXCLUDED.last_dive,
+            last_ingest = COALESCE(EXCLUDED.last_ingest, s.last_ingest), updated_at = EXCLUDED.updated_at;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Statement triggers: count the years of the changed dives again
+CREATE OR REPLACE FUNCTION dataset_summary_new_rows() RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM dataset_summary_refresh(EXTRACT(year FROM MIN(startdatetime))::INT,
+                                    EXTRACT(year FROM MAX(startdatetime))::INT, TG_OP = 'INSERT')
+    FROM new_rows HAVING COUNT(*) > 0;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION dataset_summary_old_rows() RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM dataset_summary_refresh(EXTRACT(year FROM MIN(startdatetime))::INT,
+                                    EXTRACT(year FROM MAX(startdatetime))::INT)
+    FROM old_rows HAVING COUNT(*) > 0;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER session_data_summary_insert
+    AFTER INSERT ON session_data
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION dataset_summary_new_rows();
+
+CREATE TRIGGER session_data_summary_delete
+    AFTER DELETE ON session_data
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION dataset_summary_old_rows();
+
+-- An update can move a dive to another year, so both the old and the new years are counted again
+CREATE TRIGGER session_data_summary_update_old
+    AFTER UPDATE ON session_data
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION dataset_summary_old_rows();
+
+CREATE TRIGGER session_data_summary_update_new
+    AFTER UPDATE ON session_data
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION dataset_summary_new_rows();
+
+INSERT INTO dataset_summary (dives, updated_at) VALUES (0, localtimestamp);
 
 
 -- CREATE USER gabriel_read WITH PASSWORD 'your_readonly_password';
@@ -58,3 +348,4 @@ GRANT SELECT, INSERT, UPDATE, DELETE ON ALL TABLES IN SCHEMA public TO gabriel_u
 -- ALTER DEFAULT PRIVILEGES IN SCHEMA public GRANT SELECT ON TABLES TO gabriel_read;
 -- ALTER DEFAULT PRIVILEGES IN SCHEMA public GRANT SELECT, INSERT, UPDATE, DELETE ON TABLES TO gabriel_update;
 GRANT USAGE, SELECT ON ALL SEQUENCES IN SCHEMA public TO gabriel_update ;
+GRANT EXECUTE ON FUNCTION ensure_raw_timeseries_partition(TIMESTAMP) TO gabriel_update;
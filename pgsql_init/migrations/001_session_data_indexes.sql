@@ -0,0 +1,25 @@
+-- Indexes for the time range queries in webserver/utils.py.
+-- Run with: psql -d saivasdata -f pgsql_init/migrations/001_session_data_indexes.sql
+--
+-- The indexes are built CONCURRENTLY so the webserver and ingest can keep running.
+-- (CONCURRENTLY cannot run inside a transaction, so do not wrap this file in one.)
+--
+-- The unique index fails if there are duplicate dives. Find them with:
+--   SELECT devicename, profilenumber, COUNT(*) FROM session_data
+--   GROUP BY devicename, profilenumber HAVING COUNT(*) > 1;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_session_data_startdatetime
+    ON session_data(startdatetime);
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS idx_session_data_device_profile
+    ON session_data(devicename, profilenumber);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_interpolated_timeseries_covering
+    ON interpolated_timeseries(sessionid, pressure_dbar)
+    INCLUDE (temperature, salinity, oxygen, fluorescence, turbidity);
+
+-- Covered by the leading column of idx_interpolated_timeseries_covering
+DROP INDEX CONCURRENTLY IF EXISTS idx_interpolated_timeseries_sessionid;
+
+ANALYZE session_data;
+ANALYZE interpolated_timeseries;
@@ -0,0 +1,63 @@
+-- Convert raw_timeseries to a table partitioned by month on the dive time.
+-- Run with: psql -d saivasdata -f pgsql_init/migrations/002_partition_raw_timeseries.sql
+--
+-- Stop the ingest (update.sh) while this runs. The old table is kept as
+-- raw_timeseries_old; drop it when the new table has been checked:
+--   DROP TABLE raw_timeseries_old;
+
+BEGIN;
+
+ALTER TABLE raw_timeseries RENAME TO raw_timeseries_old;
+ALTER TABLE raw_timeseries_old RENAME CONSTRAINT raw_timeseries_pkey TO raw_timeseries_old_pkey;
+ALTER INDEX idx_raw_timeseries_sessionid RENAME TO idx_raw_timeseries_old_sessionid;
+
+-- Keep using the existing id sequence
+CREATE TABLE raw_timeseries (
+    id INTEGER NOT NULL DEFAULT nextval('raw_timeseries_id_seq'),
+    sessionid UUID REFERENCES session_data(sessionid) ON DELETE CASCADE,
+    startdatetime TIMESTAMP NOT NULL,
+    seq INT NOT NULL,
+    salinity FLOAT,
+    temperature FLOAT,
+    pressure_dbar FLOAT NOT NULL,
+    oxygen FLOAT,
+    fluorescence FLOAT,
+    turbidity FLOAT,
+    PRIMARY KEY (id, startdatetime)
+) PARTITION BY RANGE (startdatetime);
+ALTER SEQUENCE raw_timeseries_id_seq OWNED BY raw_timeseries.id;
+
+CREATE OR REPLACE FUNCTION ensure_raw_timeseries_partition(ts TIMESTAMP) RETURNS TEXT AS $$
+DECLARE
+    month_start TIMESTAMP := date_trunc('month', ts);
+    partition_name TEXT := 'raw_timeseries_' || to_char(month_start, 'YYYY_MM');
+BEGIN
+    IF to_regclass(partition_name) IS NULL THEN
+        EXECUTE format('CREATE TABLE IF NOT EXISTS %I PARTITION OF raw_timeseries FOR VALUES FROM (%L) TO (%L)',
+                       partition_name, month_start, month_start + INTERVAL '1 month');
+    END IF;
+    RETURN partition_name;
+END;
+$$ LANGUAGE plpgsql SECURITY DEFINER SET search_path = public;
+
+SELECT ensure_raw_timeseries_partition(month)
+FROM (SELECT DISTINCT date_trunc('month', startdatetime) AS month FROM session_data) months;
+
+-- Copy in dive time order, so the BRIN index below is tight
+INSERT INTO raw_timeseries (id, sessionid, startdatetime, seq, salinity, temperature, pressure_dbar,
+                            oxygen, fluorescence, turbidity)
+SELECT r.id, r.sessionid, sd.startdatetime, r.seq, r.salinity, r.temperature, r.pressure_dbar,
+       r.oxygen, r.fluorescence, r.turbidity
+FROM raw_timeseries_old r JOIN session_data sd USING (sessionid)
+ORDER BY sd.startdatetime, r.id;
+
+CREATE INDEX idx_raw_timeseries_sessionid ON raw_timeseries(sessionid);
+CREATE INDEX idx_raw_timeseries_startdatetime ON raw_timeseries USING BRIN (startdatetime);
+
+GRANT SELECT ON raw_timeseries TO gabriel_read;
+GRANT SELECT, INSERT, UPDATE, DELETE ON raw_timeseries TO gabriel_update;
+GRANT EXECUTE ON FUNCTION ensure_raw_timeseries_partition(TIMESTAMP) TO gabriel_update;
+
+COMMIT;
+
+ANALYZE raw_timeseries;
@@ -0,0 +1,101 @@
+-- Climatology: sums per variable, day of year and depth of all interpolated data,
+-- kept up to date by triggers, for the /api/v2/climatology and /api/v2/anomaly endpoints.
+-- Run with: psql -d saivasdata -f pgsql_init/migrations/003_climatology.sql
+--
+-- The table is filled from the existing data at the end. Inserts into
+-- interpolated_timeseries wait while this runs.
+--
+-- If interpolated_timeseries rows are deleted or changed directly (not by
+-- deleting the dive), rebuild the table with:
+--   SELECT climatology_rebuild();
+
+BEGIN;
+
+LOCK TABLE interpolated_timeseries IN SHARE MODE;
+
+-- mean = sum / n, std = sqrt((sumsq - sum^2 / n) / (n - 1)).
+-- doy is the day of year (1-366), dates after February 28 are one day later in leap years.
+CREATE TABLE IF NOT EXISTS climatology (
+    variable VARCHAR(20) NOT NULL,
+    doy SMALLINT NOT NULL,
+    pressure_dbar FLOAT NOT NULL,
+    n BIGINT NOT NULL,
+    sum DOUBLE PRECISION NOT NULL,
+    sumsq DOUBLE PRECISION NOT NULL,
+    PRIMARY KEY (variable, doy, pressure_dbar)
+);
+
+-- The variables of one interpolated row as (variable, value) rows, without missing values
+CREATE OR REPLACE FUNCTION climatology_values(temperature FLOAT, salinity FLOAT, oxygen FLOAT,
+                                              fluorescence FLOAT, turbidity FLOAT)
+RETURNS TABLE (variable VARCHAR(20), value FLOAT) AS $$
+    SELECT v.variable, v.value
+    FROM (VALUES ('temperature', temperature), ('salinity', salinity), ('oxygen', oxygen),
+                 ('fluorescence', fluorescence), ('turbidity', turbidity)) AS v(variable, value)
+    WHERE v.value IS NOT NULL AND v.value <> 'NaN';
+$$ LANGUAGE sql IMMUTABLE;
+
+-- Add the rows inserted into interpolated_timeseries (statement trigger, also for COPY)
+CREATE OR REPLACE FUNCTION climatology_add_rows() RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO climatology AS c (variable, doy, pressure_dbar, n, sum, sumsq)
+    SELECT v.variable, EXTRACT(doy FROM sd.startdatetime), r.pressure_dbar,
+           COUNT(*), SUM(v.value), SUM(v.value * v.value)
+    FROM new_rows r
+    JOIN session_data sd USING (sessionid)
+    CROSS JOIN LATERAL climatology_values(r.temperature, r.salinity, r.oxygen, r.fluorescence, r.turbidity) v
+    GROUP BY 1, 2, 3
+    ON CONFLICT (variable, doy, pressure_dbar) DO UPDATE
+        SET n = c.n + EXCLUDED.n, sum = c.sum + EXCLUDED.sum, sumsq = c.sumsq + EXCLUDED.sumsq;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Remove the interpolated rows of a dive before it is deleted (its rows go by ON DELETE CASCADE)
+CREATE OR REPLACE FUNCTION climatology_remove_session() RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE climatology c
+    SET n = c.n - d.n, sum = c.sum - d.sum, sumsq = c.sumsq - d.sumsq
+    FROM (SELECT v.variable, EXTRACT(doy FROM OLD.startdatetime) AS doy, r.pressure_dbar,
+                 COUNT(*) AS n, SUM(v.value) AS sum, SUM(v.value * v.value) AS sumsq
+          FROM interpolated_timeseries r
+          CROSS JOIN LATERAL climatology_values(r.temperature, r.salinity, r.oxygen, r.fluorescence, r.turbidity) v
+          WHERE r.sessionid = OLD.sessionid
+          GROUP BY 1, 2, 3) d
+    WHERE c.variable = d.variable AND c.doy = d.doy AND c.pressure_dbar = d.pressure_dbar;
+    RETURN OLD;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Compute the whole table again from interpolated_timeseries. Returns the number of rows.
+CREATE OR REPLACE FUNCTION climatology_rebuild() RETURNS BIGINT AS $$
+    DELETE FROM climatology;
+    INSERT INTO climatology (variable, doy, pressure_dbar, n, sum, sumsq)
+    SELECT v.variable, EXTRACT(doy FROM sd.startdatetime), r.pressure_dbar,
+           COUNT(*), SUM(v.value), SUM(v.value * v.value)
+    FROM interpolated_timeseries r
+    JOIN session_data sd USING (sessionid)
+    CROSS JOIN LATERAL climatology_values(r.temperature, r.salinity, r.oxygen, r.fluorescence, r.turbidity) v
+    GROUP BY 1, 2, 3;
+    SELECT COUNT(*) FROM climatology;
+$$ LANGUAGE sql;
+
+DROP TRIGGER IF EXISTS interpolated_timeseries_climatology ON interpolated_timeseries;
+CREATE TRIGGER interpolated_timeseries_climatology
+    AFTER INSERT ON interpolated_timeseries
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION climatology_add_rows();
+
+DROP TRIGGER IF EXISTS session_data_climatology ON session_data;
+CREATE TRIGGER session_data_climatology
+    BEFORE DELETE ON session_data
+    FOR EACH ROW EXECUTE FUNCTION climatology_remove_session();
+
+SELECT climatology_rebuild();
+
+GRANT SELECT ON climatology TO gabriel_read;
+GRANT SELECT, INSERT, UPDATE, DELETE ON climatology TO gabriel_update;
+
+COMMIT;
+
+ANALYZE climatology;
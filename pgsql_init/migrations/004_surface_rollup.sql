@@ -0,0 +1,121 @@
+-- Rollup of the surface data (air temperature, wind, air pressure) of session_data per
+-- resampling interval, kept up to date by a trigger, for the air temperature graph and the
+-- surface download.
+-- Run with: psql -d saivasdata -f pgsql_init/migrations/004_surface_rollup.sql
+--
+-- The table is filled from the existing data at the end. Writes to session_data wait while
+-- this runs. The rollup of any period can be computed again with e.g.
+--   SELECT surface_rollup_refresh('2020-01-01', now()::timestamp);
+
+BEGIN;
+
+LOCK TABLE session_data IN SHARE MODE;
+
+-- Counts and sums per bin, so averages over bins and ranges are sum / n. The wind is stored as the
+-- sums of the vector components u = windspeed * sin(direction) and v = windspeed * cos(direction),
+-- the average direction is DEGREES(ATAN2(sum_u, sum_v)).
+-- Bins are date_bin() with origin 2001-01-03 for 3H to 1W and calendar months for 1M, as in
+-- build_surface_query() in webserver/utils.py.
+CREATE TABLE IF NOT EXISTS surface_rollup (
+    resampling VARCHAR(3) NOT NULL,
+    ts TIMESTAMP NOT NULL,
+    dives INT NOT NULL,
+    n_airtemp INT NOT NULL,
+    sum_airtemp FLOAT,
+    n_windspeed INT NOT NULL,
+    sum_windspeed FLOAT,
+    n_airpressure INT NOT NULL,
+    sum_airpressure FLOAT,
+    n_wind INT NOT NULL,
+    sum_u FLOAT,
+    sum_v FLOAT,
+    PRIMARY KEY (resampling, ts)
+);
+
+-- The resampling intervals of the rollup
+CREATE OR REPLACE FUNCTION surface_rollup_intervals() RETURNS TABLE (resampling VARCHAR(3), step INTERVAL) AS $$
+    VALUES ('3H', INTERVAL '3 hours'), ('6H', INTERVAL '6 hours'), ('12H', INTERVAL '12 hours'),
+           ('1D', INTERVAL '1 day'), ('1W', INTERVAL '1 week'), ('1M', INTERVAL '1 month');
+$$ LANGUAGE sql IMMUTABLE;
+
+-- Start of the bin of ts
+CREATE OR REPLACE FUNCTION surface_rollup_bin(resampling VARCHAR(3), step INTERVAL, ts TIMESTAMP)
+RETURNS TIMESTAMP AS $$
+    SELECT CASE WHEN resampling = '1M' THEN date_trunc('month', ts)
+                ELSE date_bin(step, ts, TIMESTAMP '2001-01-03 00:00:00') END;
+$$ LANGUAGE sql IMMUTABLE;
+
+-- Compute the bins that overlap from_ts .. to_ts (inclusive) again from session_data
+CREATE OR REPLACE FUNCTION surface_rollup_refresh(from_ts TIMESTAMP, to_ts TIMESTAMP) RETURNS VOID AS $$
+DECLARE
+    r RECORD;
+    lo TIMESTAMP;
+    hi TIMESTAMP;
+BEGIN
+    -- One refresh at a time, so concurrent ingests see each other's dives
+    PERFORM pg_advisory_xact_lock(hashtext('surface_rollup'));
+    FOR r IN SELECT * FROM surface_rollup_intervals() LOOP
+        lo := surface_rollup_bin(r.resampling, r.step, from_ts);
+        hi := surface_rollup_bin(r.resampling, r.step, to_ts) + r.step;
+        DELETE FROM surface_rollup WHERE resampling = r.resampling AND ts >= lo AND ts < hi;
+        INSERT INTO surface_rollup (resampling, ts, dives, n_airtemp, sum_airtemp, n_windspeed, sum_windspeed,
+                                    n_airpressure, sum_airpressure, n_wind, sum_u, sum_v)
+        SELECT r.resampling, surface_rollup_bin(r.resampling, r.step, startdatetime) AS bin, COUNT(*),
+               COUNT(airtemp), SUM(airtemp), COUNT(windspeed), SUM(windspeed),
+               COUNT(airpressure), SUM(airpressure), COUNT(windspeed * winddirection),
+               SUM(windspeed * SIN(RADIANS(winddirection))), SUM(windspeed * COS(RADIANS(winddirection)))
+        FROM session_data
+        WHERE startdatetime >= lo AND startdatetime < hi
+        GROUP BY bin;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Statement triggers: compute the bins of the changed dives again
+CREATE OR REPLACE FUNCTION surface_rollup_new_rows() RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM surface_rollup_refresh(MIN(startdatetime), MAX(startdatetime)) FROM new_rows HAVING COUNT(*) > 0;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION surface_rollup_old_rows() RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM surface_rollup_refresh(MIN(startdatetime), MAX(startdatetime)) FROM old_rows HAVING COUNT(*) > 0;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS session_data_surface_rollup_insert ON session_data;
+CREATE TRIGGER session_data_surface_rollup_insert
+    AFTER INSERT ON session_data
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION surface_rollup_new_rows();
+
+DROP TRIGGER IF EXISTS session_data_surface_rollup_delete ON session_data;
+CREATE TRIGGER session_data_surface_rollup_delete
+    AFTER DELETE ON session_data
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION surface_rollup_old_rows();
+
+-- An update can move a dive to another bin, so both the old and the new bins are computed again
+DROP TRIGGER IF EXISTS session_data_surface_rollup_update_old ON session_data;
+CREATE TRIGGER session_data_surface_rollup_update_old
+    AFTER UPDATE ON session_data
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION surface_rollup_old_rows();
+
+DROP TRIGGER IF EXISTS session_data_surface_rollup_update_new ON session_data;
+CREATE TRIGGER session_data_surface_rollup_update_new
+    AFTER UPDATE ON session_data
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION surface_rollup_new_rows();
+
+SELECT surface_rollup_refresh(MIN(startdatetime), MAX(startdatetime)) FROM session_data HAVING COUNT(*) > 0;
+
+GRANT SELECT ON surface_rollup TO gabriel_read;
+GRANT SELECT, INSERT, UPDATE, DELETE ON surface_rollup TO gabriel_update;
+
+COMMIT;
+
+ANALYZE surface_rollup;
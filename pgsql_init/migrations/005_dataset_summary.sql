@@ -0,0 +1,107 @@
+-- Summary of session_data (number of dives in total and per year, first and last dive, last ingest),
+-- kept up to date by triggers, for the frontpage, /count and the dive index of the download page.
+-- Run with: psql -d saivasdata -f pgsql_init/migrations/005_dataset_summary.sql
+--
+-- The tables are filled from the existing data at the end. Writes to session_data wait while
+-- this runs. The summary can be computed again with
+--   SELECT dataset_summary_refresh(NULL, NULL);
+
+BEGIN;
+
+LOCK TABLE session_data IN SHARE MODE;
+
+-- Dives per year
+CREATE TABLE IF NOT EXISTS dataset_summary_year (
+    year SMALLINT PRIMARY KEY,
+    dives INT NOT NULL,
+    first_dive TIMESTAMP NOT NULL,
+    last_dive TIMESTAMP NOT NULL
+);
+
+-- A single row with the totals. last_ingest is the time of the last insert into session_data,
+-- updated_at of the last change of the summary (also for deletes).
+CREATE TABLE IF NOT EXISTS dataset_summary (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    dives BIGINT NOT NULL,
+    first_dive TIMESTAMP,
+    last_dive TIMESTAMP,
+    last_ingest TIMESTAMP,
+    updated_at TIMESTAMP NOT NULL
+);
+
+-- Count the years from_year .. to_year again from session_data (NULL: all years) and update the totals
+CREATE OR REPLACE FUNCTION dataset_summary_refresh(from_year INT, to_year INT, ingest BOOLEAN DEFAULT FALSE)
+RETURNS VOID AS $$
+BEGIN
+    -- One refresh at a time, so concurrent ingests see each other's dives
+    PERFORM pg_advisory_xact_lock(hashtext('dataset_summary'));
+    DELETE FROM dataset_summary_year
+    WHERE (from_year IS NULL OR year >= from_year) AND (to_year IS NULL OR year <= to_year);
+    INSERT INTO dataset_summary_year (year, dives, first_dive, last_dive)
+    SELECT EXTRACT(year FROM startdatetime), COUNT(*), MIN(startdatetime), MAX(startdatetime)
+    FROM session_data
+    WHERE (from_year IS NULL OR startdatetime >= make_timestamp(from_year, 1, 1, 0, 0, 0))
+      AND (to_year IS NULL OR startdatetime < make_timestamp(to_year + 1, 1, 1, 0, 0, 0))
+    GROUP BY 1;
+    INSERT INTO dataset_summary AS s (id, dives, first_dive, last_dive, last_ingest, updated_at)
+    SELECT TRUE, COALESCE(SUM(dives), 0), MIN(first_dive), MAX(last_dive),
+           CASE WHEN ingest THEN localtimestamp END, localtimestamp
+    FROM dataset_summary_year
+    ON CONFLICT (id) DO UPDATE
+        SET dives = EXCLUDED.dives, first_dive = EXCLUDED.first_dive, last_dive = EXCLUDED.last_dive,
+            last_ingest = COALESCE(EXCLUDED.last_ingest, s.last_ingest), updated_at = EXCLUDED.updated_at;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Statement triggers: count the years of the changed dives again
+CREATE OR REPLACE FUNCTION dataset_summary_new_rows() RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM dataset_summary_refresh(EXTRACT(year FROM MIN(startdatetime))::INT,
+                                    EXTRACT(year FROM MAX(startdatetime))::INT, TG_OP = 'INSERT')
+    FROM new_rows HAVING COUNT(*) > 0;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION dataset_summary_old_rows() RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM dataset_summary_refresh(EXTRACT(year FROM MIN(startdatetime))::INT,
+                                    EXTRACT(year FROM MAX(startdatetime))::INT)
+    FROM old_rows HAVING COUNT(*) > 0;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS session_data_summary_insert ON session_data;
+CREATE TRIGGER session_data_summary_insert
+    AFTER INSERT ON session_data
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION dataset_summary_new_rows();
+
+DROP TRIGGER IF EXISTS session_data_summary_delete ON session_data;
+CREATE TRIGGER session_data_summary_delete
+    AFTER DELETE ON session_data
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION dataset_summary_old_rows();
+
+-- An update can move a dive to another year, so both the old and the new years are counted again
+DROP TRIGGER IF EXISTS session_data_summary_update_old ON session_data;
+CREATE TRIGGER session_data_summary_update_old
+    AFTER UPDATE ON session_data
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION dataset_summary_old_rows();
+
+DROP TRIGGER IF EXISTS session_data_summary_update_new ON session_data;
+CREATE TRIGGER session_data_summary_update_new
+    AFTER UPDATE ON session_data
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION dataset_summary_new_rows();
+
+-- The last ingest is not known for the existing data, use the time its last dive was written
+SELECT dataset_summary_refresh(NULL, NULL);
+UPDATE dataset_summary SET last_ingest = (SELECT MAX(updated_at) FROM session_data);
+
+GRANT SELECT ON dataset_summary, dataset_summary_year TO gabriel_read;
+GRANT SELECT, INSERT, UPDATE, DELETE ON dataset_summary, dataset_summary_year TO gabriel_update;
+
+COMMIT;
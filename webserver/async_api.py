@@ -0,0 +1,258 @@
+"""
+Async variant of the read API.
+
+The Flask routes block a worker thread for the whole database round trip, so
+a few slow heatmap requests can hold all workers while quick requests like
+/count wait. This module serves the same read endpoints from an ASGI app
+(Starlette) with an async Postgres connection pool (psycopg 3), so one
+process can have many requests waiting on the database at the same time.
+
+The SQL and the post-processing are the same functions the Flask routes use
+(build_*_query and the *_graph / *_result functions in utils.py). The
+post-processing (pandas) runs in a thread, so it does not block the event loop.
+
+Endpoints (same paths, parameters and responses as in webserver.py):
+    /count
+    /api/v2/stats
+    /api/v1/graph/stats.json?max_points=
+    /api/v1/graph/airtemp.json?max_points=
+    /api/v1/heatmap/<dtype>.json
+    /resampledday/<dtype>/<YYYYMMDD>.json
+    /api/v2/resampled/<dtype>.json?start=&end=&resampling=
+    /debug/slow-queries (with debug_endpoints in config.json)
+
+All other paths are passed on to the Flask app (webserver.py) if a2wsgi is
+installed, so one process serves the whole site. Without a2wsgi only the
+endpoints above are served and the Flask app must run separately.
+
+Usage (from the webserver directory):
+    uvicorn async_api:app --host 0.0.0.0 --port 8077
+"""
+import hashlib
+import json
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+from psycopg_pool import AsyncConnectionPool
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.responses import Response
+from starlette.routing import Mount, Route
+
+import http_cache
+import querylog
+from serialize import dumps_bytes
+from utils import build_airtemp_query, build_count_query, build_freq_query, build_heatmap_query
+from utils import build_resampled_range_query, airtemp_graph, freq_graph, freq_result, heatmap_graph
+from utils import resampled_range_result, resampled_day_v1, resampled_range_columns
+from utils import get_datatype_name, heatmap_titles, load_config
+
+try:
+    from a2wsgi import WSGIMiddleware
+except ImportError:  # pragma: no cover - depends on the installation
+    WSGIMiddleware = None
+
+
+async def fetch_rows(pool, query, label='query'):
+    """
+    Async version of utils.fetch_rows(): run query = (sql_query, query_params), return (column names, rows).
+    The time is recorded in querylog.py, without a plan for slow queries.
+    """
+    sql_query, query_params = query
+    async with pool.connection() as conn:
+        async with conn.cursor() as cur:
+            t0 = time.perf_counter()
+            await cur.execute(sql_query, query_params)
+            rows = await cur.fetchall()
+            querylog.record(label, time.perf_counter() - t0, sql_query, query_params, rows=len(rows))
+            columns = [desc.name for desc in cur.description]
+    return columns, rows
+
+
+def respond(request, body, media_type, end_date=None, status_code=200):
+    """
+    Response with the same cache headers as the Flask app (see http_cache.py): immutable for
+    closed periods, otherwise no-cache with an ETag. Compression is done by GZipMiddleware.
+    """
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    headers = {}
+    if status_code == 200:
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        headers['ETag'] = etag
+        if http_cache.is_closed_period(end_date):
+            headers['Cache-Control'] = f'public, max-age={http_cache.IMMUTABLE_MAX_AGE}, immutable'
+        else:
+            headers['Cache-Control'] = 'no-cache'
+        if etag in request.headers.get('if-none-match', ''):
+            return Response(status_code=304, headers=headers)
+    return Response(body, status_code=status_code, media_type=media_type, headers=headers)
+
+
+def json_error(request, message, status_code=400):
+    return respond(request, dumps_bytes({"error": message}), 'application/json', status_code=status_code)
+
+
+def max_points_arg(request, default):
+    max_points = request.query_params.get('max_points')
+    if max_points is None:
+        return default
+    if not max_points.isdigit() or int(max_points) < 3:
+        raise ValueError("max_points must be an integer of at least 3.")
+    return int(max_points)
+
+
+async def count(request):
+    columns, rows = await fetch_rows(request.app.state.pool, build_count_query(), label='count')
+    return respond(request, 'dives {}'.format(rows[0][0]), 'text/html')
+
+
+async def stats_csv(request):
+    columns, rows = await fetch_rows(request.app.state.pool, build_freq_query(), label='freq')
+    body = await run_in_threadpool(freq_result, rows, 'csv')
+    return respond(request, body, 'text/csv')
+
+
+async def stats_graph(request):
+    try:
+        max_points = max_points_arg(request, request.app.state.graph_max_points)
+    except ValueError as e:
+        return json_error(request, str(e))
+    columns, rows = await fetch_rows(request.app.state.pool, build_freq_query(), label='freq')
+    graph = await run_in_threadpool(freq_graph, rows, 'Dykk pr dag', max_points)
+    return respond(request, dumps_bytes(graph[0]), 'application/json')
+
+
+async def airtemp(request):
+    try:
+        max_points = max_points_arg(request, request.app.state.graph_max_points)
+    except ValueError as e:
+        return json_error(request, str(e))
+    columns, rows = await fetch_rows(request.app.state.pool, build_airtemp_query(), label='airtemp')
+    graph = await run_in_threadpool(airtemp_graph, rows, 'Lufttemperatur gjennomsnitt pr døgn', max_points)
+    return respond(request, dumps_bytes(graph[0]), 'application/json')
+
+
+async def heatmap(request):
+    try:
+        dtype = get_datatype_name(request.path_params['dtype'])
+        columns, rows = await fetch_rows(request.app.state.pool, build_heatmap_query('3H', dtype), label='heatmap')
+        graph = await run_in_threadpool(heatmap_graph, columns, rows, '3H', heatmap_titles[dtype])
+    except Exception as e:
+        error_message = {
+            "error": "An error occurred while processing your request.",
+            "message": repr(e)
+        }
+        return respond(request, dumps_bytes(error_message), 'application/json', status_code=500)
+    return respond(request, dumps_bytes(graph), 'application/json')
+
+
+async def resampledday(request):
+    thisdate = request.path_params['thisdate']
+    dtype_in = get_datatype_name(request.path_params['dtype'])
+    try:
+        day = datetime.strptime(thisdate, '%Y%m%d').date()
+    except ValueError:
+        return json_error(request, "Invalid date format. Use YYYYMMDD.")
+    columns, rows = await fetch_rows(request.app.state.pool, build_resampled_range_query(day, day, dtype_in, '3H'),
+                                  label='resampled_range')
+
+    def build_body():
+        df = resampled_range_result(rows, day, day, '3H')
+        # Same output as flask.jsonify() in webserver.py (v1 clients get NaN for missing values)
+        return json.dumps(resampled_day_v1(df, dtype_in), sort_keys=True, separators=(',', ':')) + '\n'
+    body = await run_in_threadpool(build_body)
+    return respond(request, body, 'application/json', end_date=day)
+
+
+async def resampled_range(request):
+    args = request.query_params
+    try:
+        datatype = get_datatype_name(request.path_params['dtype'])
+        start, end = args.get('start'), args.get('end')
+        if not start or not end:
+            raise ValueError("The start and end parameters (YYYY-MM-DD) are required.")
+        resampling = args.get('resampling', '3H')
+        start_date, end_date = datetime.strptime(start, '%Y-%m-%d'), datetime.strptime(end, '%Y-%m-%d')
+        query = build_resampled_range_query(start_date, end_date, datatype, resampling)
+    except ValueError as e:
+        return json_error(request, str(e))
+    columns, rows = await fetch_rows(request.app.state.pool, query, label='resampled_range')
+
+    def build_body():
+        df = resampled_range_result(rows, start_date, end_date, resampling)
+        return dumps_bytes(resampled_range_columns(df, datatype, resampling))
+    body = await run_in_threadpool(build_body)
+    return respond(request, body, 'application/json', end_date=end)
+
+
+async def slow_queries(request):
+    return Response(dumps_bytes(querylog.report()), media_type='application/json')
+
+
+def create_app(dbconn, min_size=2, max_size=10, graph_max_points=None, wsgi_app=None, compress_min_size=1024,
+               debug_endpoints=False):
+    """
+    Create the ASGI app.
+
+    Args:
+        dbconn (str): Database connection string.
+        min_size, max_size (int): Size of the connection pool.
+        graph_max_points (int or None): Default max_points of the daily graphs (see downsample.py).
+        wsgi_app: WSGI app that serves all other paths (e.g. the Flask app), needs a2wsgi.
+        compress_min_size (int): Responses larger than this are gzip-compressed.
+        debug_endpoints (bool): Serve the slow query log at /debug/slow-queries (see querylog.py).
+
+    Returns:
+        Starlette
+    """
+    @asynccontextmanager
+    async def lifespan(app):
+        pool = AsyncConnectionPool(dbconn, min_size=min_size, max_size=max_size, open=False)
+        await pool.open()
+        app.state.pool = pool
+        app.state.graph_max_points = graph_max_points
+        try:
+            yield
+        finally:
+            await pool.close()
+
+    routes = [
+        Route('/count', count),
+        Route('/api/v2/stats', stats_csv),
+        Route('/api/v1/graph/stats.json', stats_graph),
+        Route('/api/v1/graph/airtemp.json', airtemp),
+        Route('/api/v1/heatmap/{dtype}.json', heatmap),
+        Route('/resampledday/{dtype}/{thisdate}.json', resampledday),
+        Route('/api/v2/resampled/{dtype}.json', resampled_range),
+    ]
+    if debug_endpoints:
+        routes.append(Route('/debug/slow-queries', slow_queries))
+    if wsgi_app is not None:
+        if WSGIMiddleware is None:
+            raise ImportError("a2wsgi is needed to serve the Flask app from the async app.")
+        routes.append(Mount('/', app=WSGIMiddleware(wsgi_app)))
+    return Starlette(routes=routes, lifespan=lifespan,
+                     middleware=[Middleware(GZipMiddleware, minimum_size=compress_min_size)])
+
+
+def create_app_from_config():
+    configdata = load_config()
+    querylog.init(slow_query_ms=configdata.get('slow_query_ms', 1000),
+                  explain=configdata.get('slow_query_explain', True))
+    wsgi_app = None
+    if WSGIMiddleware is not None and configdata.get('async_serve_flask', True):
+        from webserver import app as wsgi_app
+    return create_app(configdata['pg_conn'],
+                      min_size=configdata.get('async_pool_min_size', 2),
+                      max_size=configdata.get('async_pool_max_size', 10),
+                      graph_max_points=configdata.get('graph_max_points'),
+                      wsgi_app=wsgi_app,
+                      compress_min_size=configdata.get('compress_min_size', 1024),
+                      debug_endpoints=configdata.get('debug_endpoints', False))
+
+
+app = create_app_from_config()
@@ -0,0 +1,408 @@
+"""
+The interpolated data as a memory-mapped cube on disk, a read path that does not use Postgres.
+
+The interpolated dives are a dense regular array, one profile per dive with the values of the
+variables at the depths of depth_set. The cube keeps them in a directory as
+
+    cube.json          number of dives, depths, variables, generation, stale
+    times.<g>.i8       startdatetime of each dive (datetime64[us]), ascending
+    sessions.<g>.u1    sessionid of each dive (16 bytes)
+    values.<g>.f8      values[dive, variable, depth] (NaN: no value)
+
+processraw (interpolatedives/interpolatedives.py) appends the dives it interpolates after it has
+committed them. Dives later than the last one are appended to the files, an earlier dive or a dive
+that is already in the cube (force) writes a new generation of the files. cube.json is replaced
+last and readers map the files of the generation it names up to its number of dives, so they never
+see a partly written dive. Writers take a lock on cube.lock.
+
+The webserver maps the files read only and slices them (np.searchsorted on the times), a read does
+not copy the dives or wait for the database. When the cube is missing, stale (an append failed) or
+was built for other depths or variables, the reads return None and the callers use Postgres.
+Build it, or build it again after dives were deleted or changed in Postgres, from the webserver
+directory with
+
+    python datacube.py
+
+(datacube_dir and pg_conn are read from config.json).
+
+Usage:
+    cube = DataCube('/local/webdata/gabriel/datacube')
+    times, values = cube.series('temperature', start, end)            # None: use Postgres
+    means = cube.resample('temperature', first, 8, np.timedelta64(3, 'h'))
+"""
+import fcntl
+import json
+import logging
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+import psycopg2
+import psycopg2.extensions
+
+logger = logging.getLogger(__name__)
+
+# The depths of interpolatedives.depth_set and the variables of interpolated_timeseries
+DEPTHS = [0.5, 1.5, 2.5, 3.5, 4.5, 5.5, 6.5, 7.5, 8.5, 9.5, 10.5, 11.5, 12.5, 13.5, 14.5, 15.5, 16.5, 17.5, 18.5, 19.5]
+VARIABLES = ['temperature', 'salinity', 'oxygen', 'fluorescence', 'turbidity']
+VERSION = 1
+
+# name -> (file extension, dtype, shape of one dive)
+FILES = {
+    'times': ('i8', np.dtype('datetime64[us]'), ()),
+    'sessions': ('u1', np.dtype('uint8'), (16,)),
+    'values': ('f8', np.dtype('float64'), (len(VARIABLES), len(DEPTHS))),
+}
+
+# Rows fetched at a time when the cube is built from Postgres
+FETCH_SIZE = 50000
+
+
+class DataCube:
+    """
+    Reader and writer of the cube in the directory path.
+
+    Args:
+        path (str): Directory of the cube (created by the first build).
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.loaded_key = None
+        self.view = None  # (meta, {name: array}) of the mapped generation
+
+    # --- Files ---
+
+    def _meta_path(self):
+        return os.path.join(self.path, 'cube.json')
+
+    def _file(self, name, generation):
+        return os.path.join(self.path, f'{name}.{generation}.{FILES[name][0]}')
+
+    def _read_meta(self):
+        try:
+            with open(self._meta_path()) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _write_meta(self, meta):
+        meta = dict(meta, updated_at=datetime.now().isoformat(timespec='seconds'))
+        tmp = self._meta_path() + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._meta_path())
+
+    def _map(self, name, generation, dives, mode='r'):
+        extension, dtype, shape = FILES[name]
+        if dives == 0:
+            # A file of zero bytes can not be mapped
+            return np.empty((0,) + shape, dtype=dtype)
+        return np.memmap(self._file(name, generation), dtype=dtype, mode=mode, shape=(dives,) + shape)
+
+    @contextmanager
+    def _write_lock(self):
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, 'cube.lock'), 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    # --- Reading ---
+
+    def _load(self):
+        """
+        (meta, arrays) of the current cube, None if it can not be used.
+        """
+        try:
+            st = os.stat(self._meta_path())
+        except FileNotFoundError:
+            return None
+        # cube.json is replaced by every write, a new inode or mtime means new dives
+        key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        with self.lock:
+            if key != self.loaded_key:
+                self.view = self._open()
+                self.loaded_key = key
+            return self.view
+
+    def _open(self):
+        meta = self._read_meta()
+        if meta is None or meta.get('stale'):
+            return None
+        if meta.get('version') != VERSION or meta.get('depths') != DEPTHS or meta.get('variables') != VARIABLES:
+            logger.warning("The data cube in %s has other depths or variables, build it again", self.path)
+            return None
+        try:
+            arrays = {name: self._map(name, meta['generation'], meta['dives']) for name in FILES}
+        except (OSError, ValueError) as e:
+            logger.warning("Could not map the data cube in %s: %s", self.path, e)
+            return None
+        return meta, arrays
+
+    def available(self):
+        """
+        True if the cube can be read.
+        """
+        return self._load() is not None
+
+    def time_range(self):
+        """
+        (first, last) startdatetime in the cube as datetime64[us], None if it is empty or can not be read.
+        """
+        view = self._load()
+        if view is None or view[0]['dives'] == 0:
+            return None
+        times = view[1]['times']
+        return times[0], times[-1]
+
+    def _slice(self, start, end):
+        view = self._load()
+        if view is None:
+            return None
+        arrays = view[1]
+        times = arrays['times']
+        i0 = np.searchsorted(times, np.datetime64(start, 'us'), side='left')
+        i1 = np.searchsorted(times, np.datetime64(end, 'us'), side='left')
+        return times[i0:i1], arrays['values'][i0:i1]
+
+    def series(self, datatype, start, end, depths=None):
+        """
+        The values of datatype of the dives from start (inclusive) to end (exclusive).
+
+        Args:
+            datatype (str): One of VARIABLES.
+            start, end: datetime or datetime64.
+            depths (list): Depths to return (default: all of DEPTHS).
+
+        Returns:
+            tuple: (times, values) with values[i][j] the value at times[i] and depths[j], views of the
+            mapped files (the values are copied when depths are given). None if the cube can not be read.
+
+        Raises:
+            ValueError: For an unknown datatype or depth.
+        """
+        variable = VARIABLES.index(datatype) if datatype in VARIABLES else None
+        if variable is None:
+            raise ValueError(f"Invalid datatype: {datatype}. Valid options are: {VARIABLES}")
+        columns = depth_indices(depths) if depths is not None else slice(None)
+        found = self._slice(start, end)
+        if found is None:
+            return None
+        times, values = found
+        return times, values[:, variable, columns]
+
+    def resample(self, datatype, first, bins, step, depths=None, start=None, end=None):
+        """
+        Mean of datatype per time bin and depth. Bin k covers first + k * step up to first + (k + 1) * step,
+        the same as date_bin() in Postgres when first is on a bin boundary.
+
+        Args:
+            datatype (str): One of VARIABLES.
+            first: Start of the first bin (datetime or datetime64).
+            bins (int): Number of bins.
+            step: Length of a bin (timedelta or timedelta64).
+            depths (list): Depths to return (default: all of DEPTHS).
+            start, end: Only use the dives from start (inclusive) to end (exclusive) (default: all
+                dives in the bins).
+
+        Returns:
+            np.ndarray: means[k][j] for bin k and depths[j], NaN where there are no values.
+            None if the cube can not be read.
+        """
+        first = np.datetime64(first, 'us')
+        step = np.timedelta64(step, 'us')
+        start = max(first, np.datetime64(start, 'us')) if start is not None else first
+        end = min(first + bins * step, np.datetime64(end, 'us')) if end is not None else first + bins * step
+        found = self.series(datatype, start, end, depths=depths)
+        if found is None:
+            return None
+        times, values = found
+        depths = values.shape[1]
+        k = ((times - first) // step).astype(np.int64)
+        valid = ~np.isnan(values)
+        cells = (k[:, None] * depths + np.arange(depths))[valid]
+        counts = np.bincount(cells, minlength=bins * depths)
+        sums = np.bincount(cells, weights=values[valid], minlength=bins * depths)
+        with np.errstate(invalid='ignore'):
+            return (sums / counts).reshape(bins, depths)
+
+    # --- Writing ---
+
+    def append(self, dives):
+        """
+        Add dives to the cube, a dive that is already in it is replaced. Does nothing (with a warning) when
+        the cube has not been built or is stale, as it would then be incomplete.
+
+        Args:
+            dives (list): (sessionid, startdatetime, values) with values[variable][depth] in the order of
+                VARIABLES and DEPTHS.
+
+        Returns:
+            int: Number of dives in the cube, None if nothing was written.
+        """
+        if not dives:
+            return None
+        sessionids, times, values = zip(*dives)
+        new = {
+            'times': np.array([np.datetime64(t, 'us') for t in times]),
+            'sessions': session_bytes(sessionids),
+            'values': np.asarray(values, dtype=np.float64).reshape((len(dives),) + FILES['values'][2]),
+        }
+        order = np.argsort(new['times'], kind='stable')
+        new = {name: array[order] for name, array in new.items()}
+        with self._write_lock():
+            meta = self._read_meta()
+            if meta is None or meta.get('stale'):
+                logger.warning("The data cube in %s is missing or stale, build it with datacube.py", self.path)
+                return None
+            generation, count = meta['generation'], meta['dives']
+            old = {name: self._map(name, generation, count) for name in FILES}
+            if count == 0 or new['times'][0] > old['times'][-1]:
+                # Later than all dives in the cube: write the new rows after the first count rows
+                for name in FILES:
+                    dtype, shape = FILES[name][1], FILES[name][2]
+                    row_size = dtype.itemsize * int(np.prod(shape, dtype=np.int64))
+                    with open(self._file(name, generation), 'ab') as f:
+                        # Drops what an interrupted append left after the last complete dive
+                        f.truncate(count * row_size)
+                        f.write(np.ascontiguousarray(new[name]).tobytes())
+                        f.flush()
+                        os.fsync(f.fileno())
+                count += len(dives)
+                self._write_meta(dict(meta, dives=count))
+            else:
+                replaced = {s.tobytes() for s in new['sessions']}
+                keep = np.array([s.tobytes() not in replaced for s in old['sessions']], dtype=bool)
+                merged = {name: np.concatenate([old[name][keep], new[name]]) for name in FILES}
+                order = np.argsort(merged['times'], kind='stable')
+                count = self._write_generation(meta, {name: array[order] for name, array in merged.items()})
+        return count
+
+    def _write_generation(self, meta, arrays):
+        """
+        Write arrays as the next generation of the files and make it the current one. Returns the number of dives.
+        """
+        generation = meta['generation'] + 1 if meta else 1
+        for name in FILES:
+            with open(self._file(name, generation), 'wb') as f:
+                f.write(np.ascontiguousarray(arrays[name]).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+        self._write_meta({'version': VERSION, 'generation': generation, 'dives': len(arrays['times']),
+                          'depths': DEPTHS, 'variables': VARIABLES, 'stale': False})
+        if meta:
+            # Readers that still map the old files keep them until they load the new generation
+            self._remove_generation(meta['generation'])
+        return len(arrays['times'])
+
+    def _remove_generation(self, generation):
+        for name in FILES:
+            try:
+                os.remove(self._file(name, generation))
+            except FileNotFoundError:
+                pass
+
+    def mark_stale(self):
+        """
+        Stop the readers from using the cube (after a failed append) until it is built again.
+        """
+        with self._write_lock():
+            meta = self._read_meta()
+            if meta is not None:
+                self._write_meta(dict(meta, stale=True))
+
+    def rebuild(self, dbconn):
+        """
+        Build the cube again from interpolated_timeseries, in one snapshot of the database.
+
+        Args:
+            dbconn (str): Database connection string.
+
+        Returns:
+            int: Number of dives.
+        """
+        with self._write_lock():
+            conn = psycopg2.connect(dbconn)
+            try:
+                conn.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ, readonly=True)
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        SELECT sessionid, startdatetime FROM session_data s
+                        WHERE EXISTS (SELECT 1 FROM interpolated_timeseries i WHERE i.sessionid = s.sessionid)
+                        ORDER BY startdatetime, sessionid;
+                    """)
+                    dives = cur.fetchall()
+                index = {sessionid: i for i, (sessionid, startdatetime) in enumerate(dives)}
+                depth_index = {depth: j for j, depth in enumerate(DEPTHS)}
+                values = np.full((len(dives),) + FILES['values'][2], np.nan)
+                # A named cursor fetches the rows in parts from the server
+                with conn.cursor(name='datacube_rebuild') as cur:
+                    cur.itersize = FETCH_SIZE
+                    cur.execute(f"SELECT sessionid, pressure_dbar, {', '.join(VARIABLES)} FROM interpolated_timeseries;")
+                    while True:
+                        rows = cur.fetchmany(FETCH_SIZE)
+                        if not rows:
+                            break
+                        dive = np.array([index[row[0]] for row in rows])
+                        depth = np.array([depth_index.get(row[1], -1) for row in rows])
+                        # None (NULL) becomes NaN
+                        data = np.array([row[2:] for row in rows], dtype=np.float64)
+                        found = depth >= 0
+                        values[dive[found], :, depth[found]] = data[found]
+                conn.rollback()
+            finally:
+                conn.close()
+            arrays = {
+                'times': np.array([np.datetime64(startdatetime, 'us') for sessionid, startdatetime in dives],
+                                  dtype=FILES['times'][1]),
+                'sessions': session_bytes([sessionid for sessionid, startdatetime in dives]),
+                'values': values,
+            }
+            return self._write_generation(self._read_meta(), arrays)
+
+
+def session_bytes(sessionids):
+    """
+    The sessionids (UUID or str) as a (dives x 16) uint8 array.
+    """
+    data = b''.join(uuid.UUID(str(sessionid)).bytes for sessionid in sessionids)
+    return np.frombuffer(data, dtype=np.uint8).reshape(len(sessionids), 16)
+
+
+def depth_indices(depths):
+    """
+    Column indices of depths in DEPTHS.
+
+    Raises:
+        ValueError: For a depth that is not in DEPTHS.
+    """
+    indices = []
+    for depth in depths:
+        if depth not in DEPTHS:
+            raise ValueError(f"Invalid depth: {depth}. Valid options are: {DEPTHS}")
+        indices.append(DEPTHS.index(depth))
+    return indices
+
+
+if __name__ == "__main__":
+    import argparse
+    from utils import load_config
+
+    logging.basicConfig(level=logging.INFO)
+    configdata = load_config()
+    parser = argparse.ArgumentParser(description="Build the data cube from the interpolated data in Postgres.")
+    parser.add_argument('path', nargs='?', default=configdata.get('datacube_dir'),
+                        help="directory of the cube (default: datacube_dir in config.json)")
+    args = parser.parse_args()
+    if not args.path:
+        parser.error("Give the directory of the cube or set datacube_dir in config.json")
+    count = DataCube(args.path).rebuild(configdata['pg_conn'])
+    print("Built the data cube with {} dives".format(count))
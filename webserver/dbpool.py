@@ -0,0 +1,87 @@
+"""
+Pool of database connections for the Flask app.
+
+Opening a Postgres connection costs a few milliseconds and a backend process,
+which is a large part of quick requests like /count. The query functions in
+utils.py take their connections from a psycopg2 ThreadedConnectionPool per
+connection string instead. When all connections are in use a request waits
+for one (ThreadedConnectionPool itself raises an error), the wait time and
+the number of connections in use are recorded in metrics.py.
+
+Streamed exports (utils.iter_query_chunks) keep a connection for as long as
+the download runs and use their own connections, so a few large downloads
+cannot take all pooled connections from the quick queries.
+
+Usage:
+    init(max_size=10)
+    with connection(dbconn) as conn:
+        with conn.cursor() as cur:
+            ...
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+from psycopg2.pool import ThreadedConnectionPool
+
+import metrics
+
+_settings = {'min_size': 1, 'max_size': 10}
+_pools = {}  # dbconn -> (ThreadedConnectionPool, threading.BoundedSemaphore)
+_pools_lock = threading.Lock()
+
+
+def init(min_size=None, max_size=None):
+    """
+    Change the pool size. Applies to pools created after the call.
+    """
+    if min_size is not None:
+        _settings['min_size'] = min_size
+    if max_size is not None:
+        _settings['max_size'] = max_size
+
+
+def _get_pool(dbconn):
+    with _pools_lock:
+        if dbconn not in _pools:
+            pool = ThreadedConnectionPool(_settings['min_size'], _settings['max_size'], dbconn)
+            _pools[dbconn] = (pool, threading.BoundedSemaphore(_settings['max_size']))
+            metrics.inc('db_pool_connections_max', _settings['max_size'])
+        return _pools[dbconn]
+
+
+@contextmanager
+def connection(dbconn):
+    """
+    A pooled connection, used like `with psycopg2.connect(dbconn) as conn`: the transaction is
+    committed on success and rolled back on an error. The connection is then returned to the pool.
+    """
+    pool, slots = _get_pool(dbconn)
+    t0 = time.perf_counter()
+    slots.acquire()
+    try:
+        conn = pool.getconn()
+    except Exception:
+        slots.release()
+        raise
+    metrics.observe('db_pool_wait_seconds', time.perf_counter() - t0)
+    metrics.inc('db_pool_connections_in_use')
+    try:
+        with conn:
+            yield conn
+    finally:
+        # Broken connections are closed instead of reused
+        pool.putconn(conn, close=bool(conn.closed))
+        metrics.inc('db_pool_connections_in_use', -1)
+        slots.release()
+
+
+def close_all():
+    """
+    Close all pools, e.g. after forking a worker process.
+    """
+    with _pools_lock:
+        for pool, slots in _pools.values():
+            pool.closeall()
+            metrics.inc('db_pool_connections_max', -pool.maxconn)
+        _pools.clear()
@@ -0,0 +1,130 @@
+"""
+In-memory index of the number of dives per day.
+
+The download page needs the number of dives in the selected period on every
+date picker change and zoom/pan of the overview graph. Instead of running
+GROUP BY DATE(startdatetime) each time, the per-day counts are kept in memory
+together with their prefix sums, so the count for a range is two binary
+searches. The index is rebuilt only when the dives have changed (dataset_summary).
+
+Usage:
+    index = get_dive_index(dbconn)
+    index.count('2025-01-01', '2025-01-31')
+    index.dataframe()   # same as get_freq(dbconn, format='dataframe')
+"""
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import metrics
+from dbpool import connection
+from utils import get_freq
+
+
+class DiveCountIndex:
+    """
+    Per-day dive counts with prefix sums.
+
+    Args:
+        dbconn (str): Database connection string.
+        check_interval (float): Minimum number of seconds between checks for new dives.
+    """
+    def __init__(self, dbconn, check_interval=60):
+        self.dbconn = dbconn
+        self.check_interval = check_interval
+        # (days, counts, cumulative, marker), replaced as a whole so readers always see matching arrays.
+        # cumulative[i] = sum(counts[:i]). None until the first build.
+        self._state = None
+        self.last_check = None
+        # lock guards last_check (taken by every request), rebuild_lock the marker query and rebuild
+        self.lock = threading.Lock()
+        self.rebuild_lock = threading.Lock()
+
+    def _latest_marker(self):
+        """
+        Cheap query that changes when dives are added or deleted.
+        """
+        with connection(self.dbconn) as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT updated_at FROM dataset_summary;")
+                row = cur.fetchone()
+                return row[0] if row else None
+
+    def refresh(self, force=False):
+        """
+        Rebuild the index if new dives have arrived (checked at most every check_interval seconds).
+        Requests during a check use the previous index, only the first build is waited for.
+        """
+        now = time.monotonic()
+        with self.lock:
+            due = force or self.last_check is None or now - self.last_check >= self.check_interval
+            if due:
+                self.last_check = now
+        if not due and self._state is not None:
+            metrics.cache_event('dive_index', hit=True)
+            return
+        with self.rebuild_lock:
+            state = self._state
+            if not due and state is not None:
+                # Built by another request while this one waited
+                metrics.cache_event('dive_index', hit=True)
+                return
+            marker = self._latest_marker()
+            if not force and state is not None and marker == state[3] and marker is not None:
+                metrics.cache_event('dive_index', hit=True)
+                return
+            metrics.cache_event('dive_index', hit=False)
+            df = get_freq(self.dbconn, format='dataframe')
+            if df.empty:
+                days = np.array([], dtype='datetime64[D]')
+                counts = np.array([], dtype=np.int64)
+            else:
+                days = df.index.values.astype('datetime64[D]')
+                counts = df['dives'].to_numpy(dtype=np.int64)
+            self._state = (days, counts, np.concatenate(([0], np.cumsum(counts))), marker)
+
+    def _snapshot(self):
+        self.refresh()
+        return self._state
+
+    def count(self, start_date, end_date):
+        """
+        Number of dives from start_date to end_date, both inclusive.
+        Dates can be strings ('YYYY-MM-DD', a time part is ignored), dates or timestamps.
+        """
+        days, counts, cumulative, marker = self._snapshot()
+        if start_date is None or end_date is None:
+            return 0
+        start = np.datetime64(pd.Timestamp(start_date).date(), 'D')
+        end = np.datetime64(pd.Timestamp(end_date).date(), 'D')
+        lo = np.searchsorted(days, start, side='left')
+        hi = np.searchsorted(days, end, side='right')
+        if hi <= lo:
+            return 0
+        return int(cumulative[hi] - cumulative[lo])
+
+    def total(self):
+        days, counts, cumulative, marker = self._snapshot()
+        return int(cumulative[-1])
+
+    def dataframe(self):
+        """
+        Dives per day as a DataFrame with a 'date' index and a 'dives' column.
+        """
+        days, counts, cumulative, marker = self._snapshot()
+        return pd.DataFrame({'dives': counts}, index=pd.DatetimeIndex(days, name='date'))
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_dive_index(dbconn):
+    """
+    Shared DiveCountIndex for a database connection string.
+    """
+    with _indexes_lock:
+        if dbconn not in _indexes:
+            _indexes[dbconn] = DiveCountIndex(dbconn)
+        return _indexes[dbconn]
@@ -1,12 +1,17 @@
 import io
+from functools import partial
 import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
-from dash import Dash, dcc, html, Input, Output, State, callback_context, no_update
+from dash import Dash, dcc, html, Input, Output, Patch, State, callback_context, no_update
 import dash_bootstrap_components as dbc
 from flask import jsonify
-import zipfile
-from utils import get_freq, get_download_data, get_surface_data, get_data_raw, get_data_sessions, load_config, load_translator
+from urllib.parse import urlencode
+from utils import get_download_data, get_surface_data, load_config, load_translator
+from utils import build_download_query, build_surface_query, build_raw_query
+from dive_index import get_dive_index
+from downsample import downsample
+from exports import export_formats, write_export, write_raw_zip, write_raw_xlsx
 
 class DownloadFrontend:
     """
@@ -21,17 +26,37 @@ class DownloadFrontend:
 
     Args:
         dbconn: Database connection object.
-        language: Language code for translations (default 'no').
+        language: Default language for translations (default 'no').
+        languages: Languages served by the app. The language is taken from the first path segment
+            after requests_pathname_prefix (e.g. /download/en/), the default language is used otherwise.
         requests_pathname_prefix: Path prefix for Dash app (default '/download/').
+        stream_url_prefix: Path prefix of the streaming download routes in webserver.py
+            (e.g. '/api/v2/download/'). If set, CSV downloads are streamed from these routes
+            instead of being built in memory by the Dash callbacks.
+        export_jobs: ExportJobs instance (see export_jobs.py). If set, raw exports of more than
+            job_threshold_dives dives are run as background jobs.
+        export_url_prefix: Path prefix of the export job routes in webserver.py (e.g. '/api/v2/export/').
+        job_threshold_dives: Size (in dives) above which raw exports are run as background jobs.
+        overview_max_points: Maximum number of points in the dives per day graph (None: all points).
     """
-    def __init__(self, dbconn, language='no', requests_pathname_prefix='/download/'):
+    def __init__(self, dbconn, language='no', requests_pathname_prefix='/download/', stream_url_prefix=None,
+                 export_jobs=None, export_url_prefix=None, job_threshold_dives=2000, overview_max_points=None,
+                 languages=('no', 'en')):
         """
         Initialize the DownloadFrontend app.
+        One Dash app serves all languages, the translation is chosen per page load.
         """
         self.dbconn = dbconn
+        self.dive_index = get_dive_index(dbconn)
         self.language = language
+        self.languages = list(languages) if language in languages else [language] + list(languages)
         self.requests_pathname_prefix = requests_pathname_prefix
-        self.setup_language(language)
+        self.stream_url_prefix = stream_url_prefix
+        self.export_jobs = export_jobs
+        self.export_url_prefix = export_url_prefix
+        self.job_threshold_dives = job_threshold_dives
+        self.overview_max_points = overview_max_points
+        self.setup_language()
         self.app = Dash(__name__,
                         requests_pathname_prefix=self.requests_pathname_prefix,
                         external_stylesheets=[dbc.themes.FLATLY])
@@ -40,35 +65,58 @@ class DownloadFrontend:
         self.setup_callbacks()
         self.app.server.errorhandler(404)(self.dash_page_not_found)
 
-    def setup_language(self, language):
-        self.t = load_translator(language)
+    def setup_language(self):
+        """
+        Load the translations of all languages, and the option lists that do not depend on the language.
+        """
+        self.translators = {lang: load_translator(lang) for lang in self.languages}
+        self.t = self.translators[self.language]
         self.depth_set = [0.5, 1.5, 2.5, 3.5, 4.5, 5.5, 6.5, 7.5, 8.5, 9.5, 10.5, 11.5, 12.5, 13.5, 14.5, 15.5, 16.5, 17.5, 18.5, 19.5]
         self.depth_marks = {str(depth): str(depth) for depth in self.depth_set}
 
-        resampling_keys = ['all', '3H', '6H', '12H', '1D', '1W', '1M']
-        self.resampling_intervals_dict = {k: self.t('resampling_intervals', k) for k in resampling_keys}
+        self.resampling_keys = ['all', '3H', '6H', '12H', '1D', '1W', '1M']
+        self.depth_aggregation_keys = ['all_selected', 'average']
+        # Parquet and Arrow are only offered when pyarrow is installed
+        self.download_format_keys = ['xlsx'] + [key for key in export_formats if key != 'xlsx']
+        self.parameter_keys = ['oxygen', 'temperature', 'turbidity', 'salinity', 'fluorescence']
+        self.surface_parameter_keys = ['airtemp', 'windspeed', 'winddirection', 'airpressure']
 
-        depth_aggregation_keys = ['all_selected', 'average']
-        self.depth_aggregation_dict = {k: self.t('depth_aggregation', k) for k in depth_aggregation_keys}
+        self.all_parameter_values = list(self.parameter_keys)
+        self.all_surface_parameter_values = list(self.surface_parameter_keys)
+        self.page_layouts = {}
 
-        download_format_keys = ['xlsx', 'csv']
-        self.download_formats_dict = {k: self.t('download_formats', k) for k in download_format_keys}
+    def translator(self, language):
+        """
+        Translation function for language (the default language if unknown).
+        """
+        return self.translators.get(language, self.t)
 
-        parameter_keys = ['oxygen', 'temperature', 'turbidity', 'salinity', 'fluorescence']
-        self.parameters_dict = {k: self.t('parameters', k) for k in parameter_keys}
+    def language_from_path(self, pathname):
+        """
+        Language given by the first path segment after requests_pathname_prefix, e.g. /download/en/ -> 'en'.
+        """
+        if pathname and pathname.startswith(self.requests_pathname_prefix):
+            pathname = pathname[len(self.requests_pathname_prefix):]
+        segment = (pathname or '').strip('/').split('/')[0]
+        return segment if segment in self.translators else self.language
 
-        surface_parameter_keys = ['airtemp', 'windspeed', 'winddirection', 'airpressure']
-        self.surface_parameters_dict = {k: self.t('surface_parameters', k) for k in surface_parameter_keys}
+    def stream_url(self, name, **params):
+        """
+        URL of a streaming download route, with params as the query string.
+        """
+        return f"{self.stream_url_prefix}{name}?{urlencode(params, doseq=True)}"
 
-        self.all_parameter_values = list(self.parameters_dict.keys())
-        self.all_surface_parameter_values = list(self.surface_parameters_dict.keys())
-        self.app = Dash(__name__,
-                        requests_pathname_prefix=self.requests_pathname_prefix,
-                        external_stylesheets=[dbc.themes.FLATLY])
-        self.app.title = self.t('navbar', 'brand')
-        self.setup_layout()
-        self.setup_callbacks()
-        self.app.server.errorhandler(404)(self.dash_page_not_found)
+    def count_dives(self, start_date, end_date):
+        """
+        Number of dives between start_date and end_date (inclusive).
+        """
+        return self.dive_index.count(start_date, end_date)
+
+    def no_data_download(self, t):
+        """
+        Download data for a text file with the 'no data' message, for a selection without data.
+        """
+        return dcc.send_string(t('download_status', 'no_data_period_parameters'), filename='no_data.txt')
 
     def dash_page_not_found(self, e):
         """
@@ -78,10 +126,29 @@ class DownloadFrontend:
 
     def setup_layout(self):
         """
-        Define the Dash app layout (UI components).
+        Define the Dash app layout: a shell where the page for the requested language is filled in.
+        """
+        self.app.layout = html.Div([
+            dcc.Location(id='url', refresh=False),
+            dcc.Store(id='language'),
+            html.Div(id='page-content'),
+        ])
+        # Lets Dash validate the callbacks against the components of the page
+        self.app.validation_layout = html.Div([self.app.layout, self.page_layout(self.language)])
+
+    def page_layout(self, language):
+        """
+        The download page (UI components) for a language. Built once per language.
         """
-        t = self.t
-        self.app.layout = dbc.Container([
+        if language in self.page_layouts:
+            return self.page_layouts[language]
+        t = self.translator(language)
+        resampling_intervals_dict = {k: t('resampling_intervals', k) for k in self.resampling_keys}
+        depth_aggregation_dict = {k: t('depth_aggregation', k) for k in self.depth_aggregation_keys}
+        download_formats_dict = {k: t('download_formats', k) for k in self.download_format_keys}
+        parameters_dict = {k: t('parameters', k) for k in self.parameter_keys}
+        surface_parameters_dict = {k: t('surface_parameters', k) for k in self.surface_parameter_keys}
+        layout = dbc.Container([
             dbc.Row([
                 dbc.Col(dbc.NavbarSimple(
                     children=[
@@ -153,7 +220,7 @@ class DownloadFrontend:
                                     html.H6(t('accordion', 'resampling_interval')),
                                     dbc.RadioItems(
                                         id='resampling-interval-radio',
-                                        options=[{'label': value, 'value': key} for key, value in self.resampling_intervals_dict.items()],
+                                        options=[{'label': value, 'value': key} for key, value in resampling_intervals_dict.items()],
                                         value='3H',
                                         inline=True,
                                         className="mb-3"
@@ -161,7 +228,7 @@ class DownloadFrontend:
                                     html.H6(t('accordion', 'depth_data_display')),
                                     dbc.RadioItems(
                                         id='depth-aggregation-radio',
-                                        options=[{'label': value, 'value': key} for key, value in self.depth_aggregation_dict.items()],
+                                        options=[{'label': value, 'value': key} for key, value in depth_aggregation_dict.items()],
                                         value='all_selected',
                                         inline=True,
                                         className="mb-3"
@@ -171,7 +238,7 @@ class DownloadFrontend:
                                         dbc.Col(
                                             dbc.Checklist(
                                                 id='parameter-checklist',
-                                                options=[{'label': label, 'value': value} for value, label in self.parameters_dict.items()],
+                                                options=[{'label': label, 'value': value} for value, label in parameters_dict.items()],
                                                 value=self.all_parameter_values,
                                                 inline=True,
                                                 labelStyle={'margin-right': '10px'}
@@ -182,7 +249,7 @@ class DownloadFrontend:
                                     html.H6(t('accordion', 'download_format')),
                                     dbc.RadioItems(
                                         id='download-format-radio',
-                                        options=[{'label': value, 'value': key} for key, value in self.download_formats_dict.items()],
+                                        options=[{'label': value, 'value': key} for key, value in download_formats_dict.items()],
                                         value='xlsx',
                                         inline=True,
                                         className="mb-3"
@@ -194,6 +261,7 @@ class DownloadFrontend:
                                         className="mb-3"
                                     ),
                                     dcc.Download(id="download-resampled-data"),
+                                    dcc.Location(id="download-resampled-location", refresh=True),
                                 ]),
                                 title=t('accordion', 'download_resampled_title'),
                                 item_id="item-resampled",
@@ -203,7 +271,7 @@ class DownloadFrontend:
                                     html.H6(t('accordion', 'resampling_interval')),
                                     dbc.RadioItems(
                                         id='surface-resampling-interval-radio',
-                                        options=[{'label': value, 'value': key} for key, value in self.resampling_intervals_dict.items()],
+                                        options=[{'label': value, 'value': key} for key, value in resampling_intervals_dict.items()],
                                         value='all',
                                         inline=True,
                                         className="mb-3"
@@ -213,7 +281,7 @@ class DownloadFrontend:
                                         dbc.Col(
                                             dbc.Checklist(
                                                 id='surface-parameter-checklist',
-                                                options=[{'label': label, 'value': value} for value, label in self.surface_parameters_dict.items()],
+                                                options=[{'label': label, 'value': value} for value, label in surface_parameters_dict.items()],
                                                 value=self.all_surface_parameter_values,
                                                 inline=True,
                                                 labelStyle={'margin-right': '10px'}
@@ -224,7 +292,7 @@ class DownloadFrontend:
                                     html.H6(t('accordion', 'download_format')),
                                     dbc.RadioItems(
                                         id='surface-download-format-radio',
-                                        options=[{'label': value, 'value': key} for key, value in self.download_formats_dict.items()],
+                                        options=[{'label': value, 'value': key} for key, value in download_formats_dict.items()],
                                         value='xlsx',
                                         inline=True,
                                         className="mb-3"
@@ -236,6 +304,7 @@ class DownloadFrontend:
                                         className="mb-3"
                                     ),
                                     dcc.Download(id="download-surface-data"),
+                                    dcc.Location(id="download-surface-location", refresh=True),
                                 ]),
                                 title=t('accordion', 'download_surface_title'),
                                 item_id="item-surface",
@@ -245,7 +314,7 @@ class DownloadFrontend:
                                     html.H6(t('accordion', 'download_format')),
                                     dbc.RadioItems(
                                         id='raw-download-format-radio',
-                                        options=[{'label': value, 'value': key} for key, value in self.download_formats_dict.items()],
+                                        options=[{'label': value, 'value': key} for key, value in download_formats_dict.items()],
                                         value='xlsx',
                                         inline=True,
                                         className="mb-3"
@@ -257,6 +326,10 @@ class DownloadFrontend:
                                         className="mb-3"
                                     ),
                                     dcc.Download(id="download-raw-data"),
+                                    dcc.Location(id="download-raw-location", refresh=True),
+                                    dcc.Store(id="raw-export-job"),
+                                    dcc.Interval(id="raw-export-interval", interval=2000, disabled=True),
+                                    html.Div(id="raw-export-status"),
                                 ]),
                                 title=t('accordion', 'download_raw_title'),
                                 item_id="item-raw",
@@ -271,16 +344,29 @@ class DownloadFrontend:
                 )
             ]),
         ], fluid=True)
+        self.page_layouts[language] = layout
+        return layout
 
     def setup_callbacks(self):
         """
         Register Dash callbacks for interactivity and data download.
+        The callbacks get the language of the page from the 'language' store.
         """
         app = self.app
-        t = self.t
+
+        @app.callback(
+            Output('page-content', 'children'),
+            Output('language', 'data'),
+            Input('url', 'pathname'),
+        )
+        def render_page(pathname):
+            language = self.language_from_path(pathname)
+            return self.page_layout(language), language
+
         # --- Download callbacks: only update download data ---
         @app.callback(
             Output("download-resampled-data", "data"),
+            Output("download-resampled-location", "href"),
             Input("download-button", "n_clicks"),
             State("date-picker-range", "start_date"),
             State("date-picker-range", "end_date"),
@@ -289,12 +375,34 @@ class DownloadFrontend:
             State("depth-aggregation-radio", "value"),
             State("parameter-checklist", "value"),
             State("download-format-radio", "value"),
+            State("language", "data"),
             prevent_initial_call=True,
         )
         def func_download_resampled_data(n_clicks, start_date, end_date, depth_range,
-                                         resampling_interval, depth_aggregation, parameters, download_format):
+                                         resampling_interval, depth_aggregation, parameters, download_format,
+                                         language):
+            t = self.translator(language)
             if not n_clicks:
-                return no_update
+                return no_update, no_update
+            # Check the selection here, the streaming route can only fail after the browser left the page
+            try:
+                query = build_download_query(start_date, end_date, depth_range, resampling_interval,
+                                             depth_aggregation, parameters)
+            except ValueError:
+                return self.no_data_download(t), no_update
+            if query is None or self.count_dives(start_date, end_date) == 0:
+                return self.no_data_download(t), no_update
+            if download_format in export_formats and self.stream_url_prefix:
+                # Let the browser fetch the streaming route instead of building the file here
+                return no_update, self.stream_url(f'resampled.{download_format}', start=start_date, end=end_date,
+                                                  depth_min=depth_range[0], depth_max=depth_range[1],
+                                                  resampling=resampling_interval, aggregation=depth_aggregation,
+                                                  parameters=parameters, n=n_clicks)
+            filename = f"resampled_data_{start_date}_to_{end_date}.{download_format}"
+            if download_format in ('parquet', 'arrow', 'xlsx'):
+                buffer = io.BytesIO()
+                write_export(self.dbconn, query, download_format, buffer)
+                return dcc.send_bytes(buffer.getvalue(), filename=filename), no_update
             df_to_download = get_download_data(
                 dbconn=self.dbconn,
                 start_date_str=start_date,
@@ -305,33 +413,44 @@ class DownloadFrontend:
                 selected_parameters_list=parameters
             )
             if df_to_download is None or df_to_download.empty:
-                return dcc.send_string(t('download_status', 'no_data_period_parameters'))
-            filename = f"resampled_data_{start_date}_to_{end_date}.{download_format}"
+                return self.no_data_download(t), no_update
             if download_format == 'csv':
-                return dcc.send_data_frame(df_to_download.to_csv, filename=filename)
-            elif download_format == 'xlsx':
-                buffer = io.BytesIO()
-                df_to_download.to_excel(buffer, index=True, sheet_name='Resampled Data')
-                buffer.seek(0)
-                return dcc.send_bytes(buffer.getvalue(), filename=filename)
+                return dcc.send_data_frame(df_to_download.to_csv, filename=filename), no_update
             else:
                 print(f"Unsupported download format: {download_format}")
-                return no_update
+                return no_update, no_update
 
         @app.callback(
             Output("download-surface-data", "data"),
+            Output("download-surface-location", "href"),
             Input("download-surface-button", "n_clicks"),
             State("date-picker-range", "start_date"),
             State("date-picker-range", "end_date"),
             State("surface-resampling-interval-radio", "value"),
             State("surface-parameter-checklist", "value"),
             State("surface-download-format-radio", "value"),
+            State("language", "data"),
             prevent_initial_call=True,
         )
         def func_download_surface_data(n_clicks, start_date, end_date,
-                                       resampling_interval, parameters, download_format):
+                                       resampling_interval, parameters, download_format, language):
+            t = self.translator(language)
             if not n_clicks:
-                return no_update
+                return no_update, no_update
+            try:
+                query = build_surface_query(start_date, end_date, resampling_interval, parameters)
+            except ValueError:
+                return self.no_data_download(t), no_update
+            if self.count_dives(start_date, end_date) == 0:
+                return self.no_data_download(t), no_update
+            if download_format in export_formats and self.stream_url_prefix:
+                return no_update, self.stream_url(f'surface.{download_format}', start=start_date, end=end_date,
+                                                  resampling=resampling_interval, parameters=parameters, n=n_clicks)
+            filename = f"surface_data_{start_date}_to_{end_date}.{download_format}"
+            if download_format in ('parquet', 'arrow', 'xlsx'):
+                buffer = io.BytesIO()
+                write_export(self.dbconn, query, download_format, buffer)
+                return dcc.send_bytes(buffer.getvalue(), filename=filename), no_update
             df_to_download = get_surface_data(
                 dbconn=self.dbconn,
                 start_date_str=start_date,
@@ -340,74 +459,86 @@ class DownloadFrontend:
                 selected_parameters_list=parameters
             )
             if df_to_download is None or df_to_download.empty:
-                return dcc.send_string(t('download_status', 'no_data_period_parameters'))
-            filename = f"surface_data_{start_date}_to_{end_date}.{download_format}"
+                return self.no_data_download(t), no_update
             if download_format == 'csv':
-                return dcc.send_data_frame(df_to_download.to_csv, filename=filename)
-            elif download_format == 'xlsx':
-                buffer = io.BytesIO()
-                df_to_download.to_excel(buffer, index=True, sheet_name='Surface Data')
-                buffer.seek(0)
-                return dcc.send_bytes(buffer.getvalue(), filename=filename)
-            return no_update
+                return dcc.send_data_frame(df_to_download.to_csv, filename=filename), no_update
+            return no_update, no_update
 
         @app.callback(
             Output("download-raw-data", "data"),
+            Output("raw-export-job", "data"),
+            Output("download-raw-location", "href"),
             Input("download-raw-button", "n_clicks"),
             State("date-picker-range", "start_date"),
             State("date-picker-range", "end_date"),
             State("raw-download-format-radio", "value"),
+            State("language", "data"),
             prevent_initial_call=True,
         )
-        def func_download_raw_data(n_clicks, start_date, end_date, download_format):
+        def func_download_raw_data(n_clicks, start_date, end_date, download_format, language):
+            t = self.translator(language)
             if not n_clicks:
-                return no_update
+                return no_update, no_update, no_update
             filename_base = f"raw_data_{start_date}_to_{end_date}"
-            df_sessions = get_data_sessions(self.dbconn, start_date, end_date)
-            df_raw = get_data_raw(self.dbconn, start_date, end_date)
-            if (df_sessions is None or df_sessions.empty) and (df_raw is None or df_raw.empty):
-                return dcc.send_string(t('download_status', 'no_data_period_parameters'))
-            if download_format == 'csv':
-                zip_filename = f"{filename_base}.zip"
-                zip_buffer = io.BytesIO()
-                with zipfile.ZipFile(zip_buffer, mode="w", compression=zipfile.ZIP_DEFLATED) as zf:
-                    sessions_csv_buffer = io.StringIO()
-                    if not df_sessions.empty:
-                        df_sessions.to_csv(sessions_csv_buffer, index=False)
-                        zf.writestr("session_data.csv", sessions_csv_buffer.getvalue())
-                    else:
-                        zf.writestr("session_data.csv", t('download_status', 'no_session_data_period'))
-                    sessions_csv_buffer.close()
-                    raw_csv_buffer = io.StringIO()
-                    if not df_raw.empty:
-                        df_raw.to_csv(raw_csv_buffer, index=False)
-                        zf.writestr("raw_timeseries_data.csv", raw_csv_buffer.getvalue())
-                    else:
-                        zf.writestr("raw_timeseries_data.csv", t('download_status', 'no_raw_timeseries_data_period'))
-                    raw_csv_buffer.close()
-                zip_buffer.seek(0)
-                return dcc.send_bytes(zip_buffer.getvalue(), filename=zip_filename)
-            elif download_format == 'xlsx':
-                xlsx_filename = f"{filename_base}.xlsx"
-                buffer = io.BytesIO()
-                with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
-                    if not df_sessions.empty:
-                        df_sessions.to_excel(writer, sheet_name=t('sheet_names', 'session_data'), index=False)
-                    else:
-                        pd.DataFrame([t('download_status', 'no_session_data_period')]).to_excel(
-                            writer, sheet_name=t('sheet_names', 'session_data'), index=False, header=False
-                        )
-                    if not df_raw.empty:
-                        df_raw.to_excel(writer, sheet_name=t('sheet_names', 'raw_timeseries_data'), index=False)
-                    else:
-                        pd.DataFrame([t('download_status', 'no_raw_timeseries_data_period')]).to_excel(
-                            writer, sheet_name=t('sheet_names', 'raw_timeseries_data'), index=False, header=False
-                        )
-                buffer.seek(0)
-                return dcc.send_bytes(buffer.getvalue(), filename=xlsx_filename)
-            return no_update
+            if download_format == 'xlsx':
+                filename = f"{filename_base}.xlsx"
+                write_raw = write_raw_xlsx
+            elif download_format in export_formats:
+                filename = f"{filename_base}.zip"
+                write_raw = partial(write_raw_zip, download_format=download_format)
+            else:
+                return no_update, no_update, no_update
+            try:
+                build_raw_query(start_date, end_date)
+            except ValueError:
+                return self.no_data_download(t), no_update, no_update
+            dives_count = self.count_dives(start_date, end_date)
+            if dives_count == 0:
+                return self.no_data_download(t), no_update, no_update
+            if self.export_jobs is not None and dives_count > self.job_threshold_dives:
+                # Large export: write it in the background and let the status callback show progress
+                def write_func(fileobj, progress):
+                    write_raw(self.dbconn, start_date, end_date, fileobj, t,
+                              expected_sessions=dives_count, progress=progress)
+                job_id = self.export_jobs.submit(write_func, filename)
+                return no_update, job_id, no_update
+            if self.stream_url_prefix:
+                # Let the browser fetch the streaming route instead of building the file here
+                return no_update, no_update, self.stream_url(f'raw_export.{download_format}', start=start_date, end=end_date,
+                                                             lang=language or self.language, n=n_clicks)
+            buffer = io.BytesIO()
+            write_raw(self.dbconn, start_date, end_date, buffer, t)
+            return dcc.send_bytes(buffer.getvalue(), filename=filename), no_update, no_update
+
+        @app.callback(
+            Output("raw-export-status", "children"),
+            Output("raw-export-interval", "disabled"),
+            Input("raw-export-interval", "n_intervals"),
+            Input("raw-export-job", "data"),
+            State("language", "data"),
+            prevent_initial_call=True,
+        )
+        def update_raw_export_status(n_intervals, job_id, language):
+            t = self.translator(language)
+            job = self.export_jobs.status(job_id) if (self.export_jobs is not None and job_id) else None
+            if job is None:
+                return None, True
+            percent = int(100 * job['progress'])
+            if job['state'] in ('queued', 'running'):
+                return html.Div([
+                    html.P(t('export_job', job['state'])),
+                    dbc.Progress(value=percent, label=f"{percent}%", className="mb-3"),
+                ]), False
+            if job['state'] == 'done':
+                return html.P([
+                    t('export_job', 'done') + ' ',
+                    html.A(job['filename'], href=f"{self.export_url_prefix}{job_id}/download"),
+                ]), True
+            return html.P(t('export_job', 'failed')), True
 
         # --- Graph and date picker update callback ---
+        # The figure is sent once, afterwards only its x-range is changed with a Patch, so the
+        # dive counts are not sent back and forth on each change of the period.
         @app.callback(
             Output('time-series-graph', 'figure'),
             Output('date-picker-range', 'start_date'),
@@ -416,27 +547,30 @@ class DownloadFrontend:
             Input('date-picker-range', 'start_date'),
             Input('date-picker-range', 'end_date'),
             Input('time-series-graph', 'relayoutData'),
-            State('time-series-graph', 'figure')
+            State('language', 'data'),
         )
-        def update_graph_and_date_picker(picker_start_date, picker_end_date, relayoutData, current_figure):
+        def update_graph_and_date_picker(picker_start_date, picker_end_date, relayoutData, language):
+            t = self.translator(language)
             ctx = callback_context
             if not ctx.triggered:
                 try:
-                    df_stats = get_freq(self.dbconn, format='dataframe')
+                    df_stats = self.dive_index.dataframe()
                     if df_stats.empty:
-                        raise ValueError("Empty data from get_freq for initial load")
+                        raise ValueError("Empty data from the dive index for initial load")
                 except Exception as e:
                     dates = pd.date_range(start='2023-01-01', end='2023-12-31', freq='D')
                     data = {'dives': np.random.randint(1, 20, len(dates))}
                     df_stats = pd.DataFrame(data, index=dates)
                 fig = go.Figure()
                 if not df_stats.empty and 'dives' in df_stats.columns:
-                    fig.add_trace(go.Scatter(x=df_stats.index, y=df_stats['dives'], mode='markers', name='Dives'))
+                    # The dive counts below come from the full index, only the plotted points are reduced
+                    x, y = downsample(df_stats.index.values, df_stats['dives'].to_numpy(), self.overview_max_points)
+                    fig.add_trace(go.Scatter(x=x, y=y, mode='markers', name='Dives'))
                 else:
                     fig.add_trace(go.Scatter(x=[], y=[], mode='markers', name='No data'))
                 fig.update_layout(
-                    xaxis_title=self.t('date_picker', 'select_date_range'),
-                    yaxis_title=self.t('graph', 'title'),
+                    xaxis_title=t('date_picker', 'select_date_range'),
+                    yaxis_title=t('graph', 'title'),
                     xaxis=dict(rangeslider=dict(visible=True), type="date"),
                     margin=dict(l=20, r=20, t=40, b=20)
                 )
@@ -447,18 +581,6 @@ class DownloadFrontend:
                 dives_text = f"{t('graph', 'dives_in_period')}: {dives_count}"
                 return fig, initial_start, initial_end, dives_text
             trigger_id = ctx.triggered[0]['prop_id'].split('.')[0]
-            if current_figure is not None and 'xaxis' in current_figure['layout'] and \
-               'rangeslider' in current_figure['layout']['xaxis'] and \
-               'yaxis' in current_figure['layout']['xaxis']['rangeslider']:
-                updated_figure_dict = current_figure.copy()
-                updated_layout = updated_figure_dict['layout'].copy()
-                updated_rangeslider = updated_layout['xaxis']['rangeslider'].copy()
-                del updated_rangeslider['yaxis']
-                updated_layout['xaxis']['rangeslider'] = updated_rangeslider
-                updated_figure_dict['layout'] = updated_layout
-                fig = go.Figure(updated_figure_dict)
-            else:
-                fig = go.Figure(current_figure) if current_figure else go.Figure()
             if trigger_id == 'time-series-graph':
                 graph_start_date = None
                 graph_end_date = None
@@ -472,18 +594,16 @@ class DownloadFrontend:
                 if graph_start_date and graph_end_date:
                     new_picker_start = pd.to_datetime(graph_start_date).strftime('%Y-%m-%d')
                     new_picker_end = pd.to_datetime(graph_end_date).strftime('%Y-%m-%d')
-                    df_stats = get_freq(self.dbconn, format='dataframe')
-                    mask = (df_stats.index >= new_picker_start) & (df_stats.index <= new_picker_end)
-                    dives_count = int(df_stats.loc[mask, 'dives'].sum()) if not df_stats.empty and 'dives' in df_stats.columns else 0
+                    dives_count = self.count_dives(new_picker_start, new_picker_end)
                     dives_text = f"{t('graph', 'dives_in_period')}: {dives_count}"
-                    return fig, new_picker_start, new_picker_end, dives_text
+                    # The graph already shows the range
+                    return no_update, new_picker_start, new_picker_end, dives_text
                 else:
                     return no_update, no_update, no_update, no_update
             elif trigger_id == 'date-picker-range':
-                fig.update_xaxes(range=[picker_start_date, picker_end_date])
-                df_stats = get_freq(self.dbconn, format='dataframe')
-                mask = (df_stats.index >= picker_start_date) & (df_stats.index <= picker_end_date)
-                dives_count = int(df_stats.loc[mask, 'dives'].sum()) if not df_stats.empty and 'dives' in df_stats.columns else 0
+                fig = Patch()
+                fig['layout']['xaxis']['range'] = [picker_start_date, picker_end_date]
+                dives_count = self.count_dives(picker_start_date, picker_end_date)
                 dives_text = f"{t('graph', 'dives_in_period')}: {dives_count}"
                 return fig, picker_start_date, picker_end_date, dives_text
             return no_update, no_update, no_update, no_update
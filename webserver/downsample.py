@@ -0,0 +1,125 @@
+"""
+Downsampling of long x/y series before they are sent to the browser.
+
+The daily series (air temperature, dives per day) grow by one point per day
+for the lifetime of the buoy. Plotting a few thousand points gives the same
+picture as plotting all of them, so the graphs can be limited to max_points
+points to keep the payload and the rendering time fixed.
+
+Two methods are available:
+    lttb    Largest-Triangle-Three-Buckets, keeps the points that carry the
+            visual shape of the series (default).
+    minmax  Keeps the minimum and maximum of each bucket, so no peak is lost.
+
+Usage:
+    x, y = downsample(days, airtemps, max_points=1000)
+"""
+import numpy as np
+import pandas as pd
+
+
+def _as_float(x):
+    """
+    x as a float array, dates and timestamps are converted to microseconds.
+    """
+    x = np.asarray(x)
+    if x.dtype.kind == 'O':
+        x = pd.to_datetime(x).values
+    if x.dtype.kind == 'M':
+        return x.astype('datetime64[us]').astype(np.int64).astype(float)
+    return x.astype(float)
+
+
+def lttb_indices(x, y, max_points):
+    """
+    Indices of the points selected by Largest-Triangle-Three-Buckets.
+
+    The first and last points are always kept. The rest of the series is split
+    into max_points - 2 buckets, and from each bucket the point forming the
+    largest triangle with the previous selected point and the average of the
+    next bucket is kept.
+
+    Args:
+        x, y: Sorted x values (numbers or dates) and y values of the same length.
+        max_points (int): Number of points to keep (at least 3).
+
+    Returns:
+        np.ndarray: Sorted indices into x and y.
+    """
+    n = len(y)
+    if max_points is None or n <= max_points or max_points < 3:
+        return np.arange(n)
+    xf = _as_float(x)
+    yf = np.asarray(y, dtype=float)
+
+    # Bucket edges for the points between the first and the last
+    edges = np.linspace(1, n - 1, max_points - 1).astype(int)
+    # Averages of all buckets (and the last point) in one go
+    sums_x = np.add.reduceat(xf[1:n - 1], edges[:-1] - 1)
+    sums_y = np.add.reduceat(yf[1:n - 1], edges[:-1] - 1)
+    sizes = np.diff(edges)
+    avg_x = np.append(sums_x / sizes, xf[-1])
+    avg_y = np.append(sums_y / sizes, yf[-1])
+
+    selected = np.empty(max_points, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i in range(max_points - 2):
+        lo, hi = edges[i], edges[i + 1]
+        # Twice the triangle area, the constant factor does not change the argmax
+        area = np.abs((xf[a] - avg_x[i + 1]) * (yf[lo:hi] - yf[a]) -
+                      (xf[a] - xf[lo:hi]) * (avg_y[i + 1] - yf[a]))
+        # NaN values are never selected unless the whole bucket is NaN
+        a = lo + (int(np.nanargmax(area)) if not np.isnan(area).all() else 0)
+        selected[i + 1] = a
+    return selected
+
+
+def minmax_indices(y, max_points):
+    """
+    Indices of the minimum and maximum of each of max_points // 2 buckets, in order.
+    """
+    n = len(y)
+    if max_points is None or n <= max_points or max_points < 2:
+        return np.arange(n)
+    yf = np.asarray(y, dtype=float)
+    buckets = max_points // 2
+    edges = np.linspace(0, n, buckets + 1).astype(int)
+    # Pad the buckets to the same size so the arg-min/max is one vectorized call
+    width = int(np.diff(edges).max())
+    idx = edges[:-1, None] + np.arange(width)[None, :]
+    valid = idx < edges[1:, None]
+    idx = np.where(valid, idx, edges[1:, None] - 1)
+    values = yf[idx]
+    low = np.where(valid & ~np.isnan(values), values, np.inf)
+    high = np.where(valid & ~np.isnan(values), values, -np.inf)
+    rows = np.arange(buckets)
+    selected = np.concatenate((idx[rows, low.argmin(axis=1)], idx[rows, high.argmax(axis=1)]))
+    return np.unique(selected)
+
+
+def downsample(x, y, max_points, method='lttb'):
+    """
+    Reduce the series to at most max_points points.
+
+    Args:
+        x, y: Sorted x values and the y values (lists or arrays of the same length).
+        max_points (int or None): Maximum number of points. None (or a series that
+            is already short enough) returns x and y unchanged.
+        method (str): 'lttb' or 'minmax'.
+
+    Returns:
+        tuple: (x, y) as NumPy arrays, or unchanged.
+
+    Raises:
+        ValueError: For an unknown method.
+    """
+    if method not in ('lttb', 'minmax'):
+        raise ValueError(f"Invalid downsampling method: {method}. Valid options are: ['lttb', 'minmax']")
+    if max_points is None or len(y) <= max_points:
+        return x, y
+    if method == 'lttb':
+        idx = lttb_indices(x, y, max_points)
+    else:
+        idx = minmax_indices(y, max_points)
+    return np.asarray(x)[idx], np.asarray(y)[idx]
@@ -0,0 +1,175 @@
+"""
+New dives pushed to the browser as server-sent events.
+
+The ingest sends a Postgres NOTIFY on the `new_dive` channel when a dive is
+stored (fetchdata/saivas.py, event "dive") and when it is interpolated
+(interpolatedives/interpolatedives.py, event "profile", with the values per
+depth). The notifications are delivered when the ingest commits. One thread
+per process LISTENs on a connection of its own and passes each notification
+to the queues of the connected clients, /api/v2/events streams them as
+
+    id: 12
+    event: profile
+    data: {"event": "profile", "sessionid": "...", "startdatetime": "...", "depth": [...], ...}
+
+Each client holds a worker thread while it is connected, so the number of
+clients per process is limited (max_clients). The last events are kept, so a
+client that reconnects with Last-Event-ID gets the ones it missed (as long as
+it reconnects to the same process). A client that does not keep up is
+disconnected and catches up the same way.
+
+Usage:
+    events = DiveEvents(dbconn, max_clients=20)
+    stream = events.stream(request.headers.get('Last-Event-ID'))
+    if stream is None:
+        ...  # too many clients
+    return Response(stream, mimetype='text/event-stream')
+"""
+import json
+import logging
+import queue
+import select
+import threading
+import time
+from collections import deque
+
+import psycopg2
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'new_dive'
+
+
+class DiveEvents:
+    """
+    Fan-out of the new_dive notifications to the connected clients.
+
+    Args:
+        dbconn (str): Database connection string.
+        max_clients (int): Maximum number of connected clients per process.
+        keepalive (float): Seconds between keepalive comments when there are no events.
+        history (int): Number of recent events kept for reconnecting clients.
+        max_queue (int): Number of events a client may lag behind before it is disconnected.
+    """
+    def __init__(self, dbconn, max_clients=20, keepalive=15, history=100, max_queue=100):
+        self.dbconn = dbconn
+        self.max_clients = max_clients
+        self.keepalive = keepalive
+        self.max_queue = max_queue
+        self.recent = deque(maxlen=history)  # (id, event, data)
+        self.last_id = 0
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def _start(self):
+        # Called with self.lock held
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._listen, name='dive-events', daemon=True)
+            self.thread.start()
+
+    def _listen(self):
+        backoff = 1
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(self.dbconn)
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute(f"LISTEN {CHANNEL};")
+                backoff = 1
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        self.publish(conn.notifies.pop(0).payload)
+            except (psycopg2.Error, OSError) as e:
+                logger.warning("Listening for new dives failed, trying again in %d s: %s", backoff, e)
+            finally:
+                if conn is not None:
+                    conn.close()
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 60)
+
+    def publish(self, payload):
+        """
+        Send a notification payload (JSON with an "event" name) to all clients.
+        """
+        try:
+            message = json.loads(payload)
+            event = str(message.get('event', 'message'))
+        except (ValueError, AttributeError):
+            logger.warning("Ignoring notification that is not a JSON object: %.100s", payload)
+            return
+        # On one line, an event stream data line ends at a newline
+        data = json.dumps(message, separators=(',', ':'))
+        with self.lock:
+            self.last_id += 1
+            entry = (self.last_id, event, data)
+            self.recent.append(entry)
+            for subscriber in list(self.subscribers):
+                try:
+                    subscriber.put_nowait(entry)
+                except queue.Full:
+                    # Disconnect it, it gets the missed events when it reconnects
+                    self.subscribers.discard(subscriber)
+                    while not subscriber.empty():
+                        subscriber.get_nowait()
+                    subscriber.put_nowait(None)
+        metrics.inc('sse_events_total', event=event)
+
+    def subscribe(self, last_event_id=None):
+        """
+        Queue for a new client, with the events after last_event_id already in it. None if there are
+        max_clients clients.
+        """
+        subscriber = queue.Queue(maxsize=self.max_queue)
+        with self.lock:
+            if len(self.subscribers) >= self.max_clients:
+                return None
+            self._start()
+            if last_event_id is not None and last_event_id.isdigit():
+                for entry in self.recent:
+                    if entry[0] > int(last_event_id) and not subscriber.full():
+                        subscriber.put_nowait(entry)
+            self.subscribers.add(subscriber)
+        metrics.inc('sse_clients')
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+        metrics.inc('sse_clients', -1)
+
+    def stream(self, last_event_id=None):
+        """
+        Generator of the text/event-stream body for a new client, None if there are too many clients.
+        """
+        with self.lock:
+            if len(self.subscribers) >= self.max_clients:
+                return None
+
+        def generate():
+            # Subscribed when the body is sent, a generator that is never started does not run its finally
+            subscriber = self.subscribe(last_event_id)
+            if subscriber is None:
+                return
+            try:
+                # Browsers reconnect after retry milliseconds
+                yield 'retry: 5000\n\n'
+                while True:
+                    try:
+                        entry = subscriber.get(timeout=self.keepalive)
+                    except queue.Empty:
+                        yield ': keepalive\n\n'
+                        continue
+                    if entry is None:
+                        return
+                    event_id, event, data = entry
+                    yield f'id: {event_id}\nevent: {event}\ndata: {data}\n\n'
+            finally:
+                self.unsubscribe(subscriber)
+        return generate()
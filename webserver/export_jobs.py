@@ -0,0 +1,166 @@
+"""
+Background export jobs.
+
+Large downloads are written to disk by a small local worker pool instead of
+inside the Dash callback, so one long export does not hold a web worker for
+minutes. The frontend polls the job status and gets a download link when the
+file is ready.
+
+Usage:
+    jobs = ExportJobs(export_dir='/tmp/exports', max_workers=2)
+    job_id = jobs.submit(write_func, filename='raw_data.zip')
+    jobs.status(job_id)   # {'state': 'running', 'progress': 0.4, ...}
+    jobs.path(job_id)     # path of the finished file
+
+Here write_func(fileobj, progress) writes the export to fileobj and calls
+progress(done, total) as it goes.
+
+The job status is kept next to the file as <id>.json, so every worker process
+that shares export_dir can answer the status and download requests, not only
+the one that runs the job.
+"""
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class ExportJobs:
+    """
+    Queue of export jobs run by a thread pool, with the results and their status kept in export_dir.
+
+    Args:
+        export_dir: Directory for finished exports (default: a new temporary directory, which is
+            only seen by this process; give a shared directory when there are several processes).
+        max_workers: Number of exports running at the same time.
+        max_age_hours: Finished jobs and their files are removed after this many hours.
+    """
+    def __init__(self, export_dir=None, max_workers=2, max_age_hours=24):
+        if export_dir:
+            os.makedirs(export_dir, exist_ok=True)
+        self.export_dir = export_dir or tempfile.mkdtemp(prefix='skramdykk_export_')
+        self.max_age = max_age_hours * 3600
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='export')
+        # The jobs run by this process, their status is written to <id>.json on every change
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def submit(self, write_func, filename):
+        """
+        Queue an export. Returns the job id.
+        """
+        self.cleanup()
+        job_id = uuid.uuid4().hex
+        job = {
+            'id': job_id,
+            'filename': filename,
+            'state': 'queued',
+            'progress': 0.0,
+            'error': None,
+            'created': time.time(),
+            'finished': None,
+        }
+        with self.lock:
+            self.jobs[job_id] = job
+            self._write_status(job)
+        self.executor.submit(self._run, job_id, write_func)
+        return job_id
+
+    def _run(self, job_id, write_func):
+        self._update(job_id, state='running')
+        path = self._job_path(job_id)
+        tmp_path = path + '.part'
+
+        def progress(done, total):
+            if total:
+                self._update(job_id, progress=min(done / total, 1.0))
+
+        try:
+            with open(tmp_path, 'wb') as fileobj:
+                write_func(fileobj, progress)
+            os.replace(tmp_path, path)
+            self._update(job_id, state='done', progress=1.0, finished=time.time())
+        except Exception as e:
+            logger.exception("Export job %s failed", job_id)
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            self._update(job_id, state='failed', error=repr(e), finished=time.time())
+
+    def _update(self, job_id, **values):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return
+            job.update(values)
+            self._write_status(job)
+            if job['finished'] is not None:
+                del self.jobs[job['id']]
+
+    def _write_status(self, job):
+        # Replace the file in one step, a reader sees the old or the new status
+        path = self._status_path(job['id'])
+        with open(path + '.tmp', 'w') as f:
+            json.dump(job, f)
+        os.replace(path + '.tmp', path)
+
+    def _job_path(self, job_id):
+        return os.path.join(self.export_dir, job_id)
+
+    def _status_path(self, job_id):
+        return os.path.join(self.export_dir, f'{job_id}.json')
+
+    def status(self, job_id):
+        """
+        Return the job status, or None for an unknown job.
+        """
+        # Job ids come from URLs, only accept the ones submit() makes
+        if not isinstance(job_id, str) or not re.fullmatch(r'[0-9a-f]{32}', job_id):
+            return None
+        try:
+            with open(self._status_path(job_id)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def path(self, job_id):
+        """
+        Return the path of a finished export, or None if it is not ready.
+        """
+        job = self.status(job_id)
+        if job is None or job['state'] != 'done':
+            return None
+        return self._job_path(job_id)
+
+    def cleanup(self):
+        """
+        Remove jobs that finished (or started, for jobs of a process that stopped) more than
+        max_age_hours ago and their files.
+        """
+        now = time.time()
+        with self.lock:
+            running = set(self.jobs)
+        for name in os.listdir(self.export_dir):
+            job_id = name[:-len('.json')]
+            if not name.endswith('.json') or job_id in running:
+                continue
+            job = self.status(job_id)
+            if job is None or now - (job['finished'] or job['created']) <= self.max_age:
+                continue
+            for path in (self._job_path(job_id), self._job_path(job_id) + '.part', self._status_path(job_id)):
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+
+    def shutdown(self, remove_files=False):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        if remove_files:
+            shutil.rmtree(self.export_dir, ignore_errors=True)
@@ -0,0 +1,510 @@
+"""
+Writers for the data downloads.
+
+The writers take the (description, rows) chunks from utils.iter_query_chunks()
+and produce the output incrementally, so a download never holds the whole
+result in memory.
+"""
+import csv
+import io
+import itertools
+import math
+import tempfile
+import time
+import zipfile
+from datetime import datetime, time as time_of_day
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:  # pragma: no cover - depends on the installation
+    pa = None
+
+from utils import build_raw_query, build_sessions_query, export_snapshot, iter_query_chunks
+
+# Rows per Excel worksheet, including the header row
+XLSX_MAX_ROWS = 1048576
+
+
+def _csv_nan(value):
+    # NaN as an empty field
+    return '' if value != value else value
+
+
+def _csv_date(value):
+    # A datetime column without times is written as dates
+    if isinstance(value, datetime) and value.time() == time_of_day.min and value.tzinfo is None:
+        return value.date()
+    return value
+
+
+def _csv_any(value):
+    if isinstance(value, float):
+        return _csv_nan(value)
+    return value
+
+
+def _csv_converters(rows, columns):
+    """
+    Per column a function that formats a value as DataFrame.to_csv() does, or None to write it as it is.
+    Decided from the first chunk: float columns write NaN as an empty field, datetime columns where all
+    the values are at midnight (1D, 1W and 1M bins) are written as dates. Columns without values in the
+    first chunk are checked per value for NaN.
+    """
+    converters = []
+    for i in range(columns):
+        values = [row[i] for row in rows if row[i] is not None]
+        if not values:
+            converters.append(_csv_any)
+        elif isinstance(values[0], float):
+            converters.append(_csv_nan)
+        elif isinstance(values[0], datetime) and all(
+                isinstance(v, datetime) and v.time() == time_of_day.min and v.tzinfo is None for v in values):
+            converters.append(_csv_date)
+        else:
+            converters.append(None)
+    return converters
+
+
+def iter_csv(chunks):
+    """
+    Yield CSV text for the query chunks, starting with a header row.
+
+    The values are written as DataFrame.to_csv() writes them for the same query (with the index
+    columns first, as they are selected first by the query builders): NaN as an empty field and
+    datetimes without a time part as dates. Whether a datetime column has times is decided from
+    the first chunk.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    converters = None
+    for description, rows in chunks:
+        if converters is None:
+            writer.writerow([col[0] for col in description])
+            converters = _csv_converters(rows, len(description))
+            convert = [(i, f) for i, f in enumerate(converters) if f is not None]
+        if convert:
+            rows = [list(row) for row in rows]
+            for row in rows:
+                for i, f in convert:
+                    row[i] = f(row[i])
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+
+
+class StreamBuffer(io.RawIOBase):
+    """
+    Write-only file object that collects what is written until drain() is called.
+    Used to turn the pyarrow and zipfile writers into generators.
+    """
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+
+# PostgreSQL type oids (cursor.description type_code) and the arrow types they are written as.
+# Other types (uuid, text, geometry, ...) are written as strings.
+_ARROW_TYPES = {
+    16: 'bool',
+    20: 'int64', 21: 'int16', 23: 'int32',
+    700: 'float32', 701: 'float64', 1700: 'float64',
+    1082: 'date32',
+    1114: 'timestamp',
+    1184: 'timestamptz',
+}
+
+
+def arrow_schema(description):
+    """
+    Arrow schema for a cursor description. Duplicate column names get a numbered suffix.
+    """
+    fields = []
+    seen = {}
+    for col in description:
+        name = col[0]
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}_{seen[name]}"
+        else:
+            seen[name] = 0
+        type_name = _ARROW_TYPES.get(col[1], 'string')
+        if type_name == 'timestamp':
+            arrow_type = pa.timestamp('us')
+        elif type_name == 'timestamptz':
+            arrow_type = pa.timestamp('us', tz='UTC')
+        else:
+            arrow_type = getattr(pa, type_name)()
+        fields.append(pa.field(name, arrow_type))
+    return pa.schema(fields)
+
+
+def _record_batch(schema, rows):
+    columns = list(zip(*rows)) if rows else [()] * len(schema)
+    arrays = []
+    for field, values in zip(schema, columns):
+        if pa.types.is_string(field.type):
+            values = [None if v is None else str(v) for v in values]
+        elif pa.types.is_floating(field.type):
+            values = [None if v is None else float(v) for v in values]
+        arrays.append(pa.array(values, type=field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def _iter_arrow_writer(chunks, open_writer):
+    sink = StreamBuffer()
+    writer = None
+    for description, rows in chunks:
+        if writer is None:
+            schema = arrow_schema(description)
+            writer = open_writer(sink, schema)
+        if rows:
+            writer.write_batch(_record_batch(schema, rows))
+        yield sink.drain()
+    if writer is not None:
+        writer.close()
+    yield sink.drain()
+
+
+def iter_parquet(chunks, compression='zstd'):
+    """
+    Yield a Parquet file for the query chunks, one row group per chunk.
+    """
+    return _iter_arrow_writer(chunks, lambda sink, schema: pa.parquet.ParquetWriter(
+        sink, schema, compression=compression))
+
+
+def iter_arrow(chunks, compression='zstd'):
+    """
+    Yield an Arrow IPC file (Feather v2) for the query chunks, one record batch per chunk.
+    """
+    return _iter_arrow_writer(chunks, lambda sink, schema: pa.ipc.new_file(
+        sink, schema, options=pa.ipc.IpcWriteOptions(compression=compression)))
+
+
+def _iter_csv_bytes(chunks):
+    for text in iter_csv(chunks):
+        yield text.encode('utf-8')
+
+
+def _xlsx_converters(description):
+    """
+    Per column a function that makes the value writable to Excel, or None if it already is.
+    """
+    def float_value(v):
+        # Excel has no NaN, leave the cell empty as DataFrame.to_excel() does
+        return None if v is None or math.isnan(v) else v
+
+    def naive_datetime(v):
+        # Excel does not support time zones
+        return None if v is None else v.replace(tzinfo=None)
+
+    def text(v):
+        return None if v is None else str(v)
+
+    converters = []
+    for col in description:
+        type_name = _ARROW_TYPES.get(col[1], 'string')
+        if type_name in ('float32', 'float64'):
+            converters.append(float_value)
+        elif type_name == 'timestamptz':
+            converters.append(naive_datetime)
+        elif type_name == 'string':
+            # uuid and other types openpyxl does not know
+            converters.append(text)
+        else:
+            converters.append(None)
+    return converters
+
+
+def write_xlsx_sheets(workbook, sheet_name, chunks, empty_message=None):
+    """
+    Append the query chunks to a write-only openpyxl workbook, with a header row on each sheet.
+    A sheet that reaches XLSX_MAX_ROWS is continued on a new sheet named "sheet_name (2)", "(3)", ...
+    If the query has no rows, a sheet with empty_message is written instead (if given).
+
+    Returns:
+        int: Number of data rows written.
+    """
+    sheet = None
+    sheet_rows = 0
+    sheets = 0
+    rows_written = 0
+    header = None
+    converters = None
+    for description, rows in chunks:
+        if header is None:
+            header = [col[0] for col in description]
+            converters = _xlsx_converters(description)
+            if not any(converters):
+                converters = None
+        for row in rows:
+            if sheet is None or sheet_rows >= XLSX_MAX_ROWS:
+                sheets += 1
+                title = sheet_name if sheets == 1 else f"{sheet_name[:25]} ({sheets})"
+                sheet = workbook.create_sheet(title=title[:31])
+                sheet.append(header)
+                sheet_rows = 1
+            if converters is not None:
+                row = [value if converter is None else converter(value) for converter, value in zip(converters, row)]
+            sheet.append(row)
+            sheet_rows += 1
+        rows_written += len(rows)
+    if sheet is None:
+        sheet = workbook.create_sheet(title=sheet_name[:31])
+        if empty_message is not None:
+            sheet.append([empty_message])
+        elif header is not None:
+            sheet.append(header)
+    return rows_written
+
+
+def iter_xlsx(chunks, sheet_name='Data'):
+    """
+    Yield an Excel workbook for the query chunks.
+
+    The rows go through openpyxl in write-only mode, which keeps them in a temporary
+    file instead of in memory. A workbook is a zip file that can only be written as
+    a whole, so it is yielded when all rows are written.
+    """
+    # Imported here, it is slow to import and only needed for Excel downloads
+    import openpyxl
+    workbook = openpyxl.Workbook(write_only=True)
+    write_xlsx_sheets(workbook, sheet_name, chunks)
+    return _iter_workbook(workbook)
+
+
+def _iter_workbook(workbook, block_size=1 << 20):
+    with tempfile.TemporaryFile() as fh:
+        workbook.save(fh)
+        fh.seek(0)
+        while True:
+            data = fh.read(block_size)
+            if not data:
+                break
+            yield data
+
+
+# download format -> (generator of bytes, mimetype, rows per chunk)
+export_formats = {
+    'csv': (_iter_csv_bytes, 'text/csv', 5000),
+    'xlsx': (iter_xlsx, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 5000),
+}
+if pa is not None:
+    export_formats['parquet'] = (iter_parquet, 'application/vnd.apache.parquet', 50000)
+    export_formats['arrow'] = (iter_arrow, 'application/vnd.apache.arrow.file', 50000)
+
+
+def iter_export(dbconn, query, download_format):
+    """
+    Run query (sql_query, query_params) with a server-side cursor and yield the
+    result as bytes in download_format.
+    """
+    iter_func, mimetype, chunk_size = export_formats[download_format]
+    sql_query, query_params = query
+    return iter_func(iter_query_chunks(dbconn, sql_query, query_params, chunk_size=chunk_size))
+
+
+def write_export(dbconn, query, download_format, fileobj):
+    """
+    Write the result of query to fileobj in download_format.
+    """
+    for data in iter_export(dbconn, query, download_format):
+        fileobj.write(data)
+
+
+def _raw_parts(start_date_str, end_date_str, t):
+    """
+    (name, query, message if empty) of the two parts of the raw export.
+    """
+    return [
+        ('session_data', t('sheet_names', 'session_data'), build_sessions_query(start_date_str, end_date_str),
+         t('download_status', 'no_session_data_period')),
+        ('raw_timeseries_data', t('sheet_names', 'raw_timeseries_data'), build_raw_query(start_date_str, end_date_str),
+         t('download_status', 'no_raw_timeseries_data_period')),
+    ]
+
+
+def iter_raw_zip(dbconn, start_date_str, end_date_str, t, download_format='csv',
+                 expected_sessions=None, progress=None):
+    """
+    Yield the raw export (session_data and raw_timeseries_data) as a zip file
+    with one member per table in download_format.
+
+    Both tables are read in one REPEATABLE READ snapshot (utils.export_snapshot()),
+    so the dives and the raw data agree even if new dives arrive meanwhile. Each
+    member is compressed and yielded chunk by chunk as it is read, so memory use
+    does not depend on the size of the export.
+
+    Args:
+        dbconn (str): Database connection string.
+        start_date_str (str): Start date in 'YYYY-MM-DD' format.
+        end_date_str (str): End date in 'YYYY-MM-DD' format.
+        t: Translation function from utils.load_translator().
+        download_format (str): A key of export_formats.
+        expected_sessions (int): Number of dives in the period, used for progress reporting.
+        progress: Optional callable progress(done, total), called after each chunk.
+
+    Yields:
+        bytes: The zip file. The generator returns the number of data rows written.
+    """
+    chunk_size = export_formats[download_format][2]
+    tracker = _SessionProgress(expected_sessions, progress)
+    rows_written = 0
+    sink = StreamBuffer()
+    with export_snapshot(dbconn) as conn:
+        # The sink is not seekable, so zipfile writes the sizes after each member
+        with zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_DEFLATED) as zf:
+            for name, sheet_name, (sql_query, query_params), empty_message in _raw_parts(start_date_str, end_date_str, t):
+                chunks = tracker.track(iter_query_chunks(dbconn, sql_query, query_params, chunk_size=chunk_size,
+                                                         conn=conn))
+                rows_written += yield from iter_zip_member(zf, sink, f"{name}.{download_format}", chunks,
+                                                           download_format, empty_message)
+    yield sink.drain()
+    return rows_written
+
+
+def write_raw_zip(dbconn, start_date_str, end_date_str, fileobj, t, download_format='csv',
+                  expected_sessions=None, progress=None):
+    """
+    Write the raw export to fileobj, see iter_raw_zip().
+
+    Returns:
+        int: Number of data rows written.
+    """
+    parts = iter_raw_zip(dbconn, start_date_str, end_date_str, t, download_format, expected_sessions, progress)
+    return _write_all(parts, fileobj)
+
+
+def _write_all(parts, fileobj):
+    # Write the bytes yielded by parts to fileobj, return the return value of the generator
+    while True:
+        try:
+            fileobj.write(next(parts))
+        except StopIteration as stop:
+            return stop.value
+
+
+def iter_zip_member(zf, sink, member, chunks, download_format, empty_message=None):
+    """
+    Write the query chunks in download_format to a new member of the zip file zf,
+    yielding what is written to sink (the file object of zf) after each chunk.
+    For CSV, empty_message is written instead if the query has no rows.
+
+    Yields:
+        bytes: Parts of the zip file. The generator returns the number of data rows written.
+    """
+    iter_func = export_formats[download_format][0]
+    chunks = iter(chunks)
+    description, rows = next(chunks)
+    if not rows and download_format == 'csv' and empty_message is not None:
+        zf.writestr(member, empty_message)
+        yield sink.drain()
+        return 0
+    rows_written = 0
+
+    def count_rows(chunks):
+        nonlocal rows_written
+        for description, rows in chunks:
+            rows_written += len(rows)
+            yield description, rows
+
+    zinfo = zipfile.ZipInfo(member, date_time=time.localtime()[:6])
+    # Parquet, Arrow and xlsx are compressed already
+    zinfo.compress_type = zipfile.ZIP_DEFLATED if download_format == 'csv' else zipfile.ZIP_STORED
+    # The size is not known in advance, and a member over 2 GB needs zip64 from the start
+    with zf.open(zinfo, mode='w', force_zip64=True) as fh:
+        for data in iter_func(count_rows(itertools.chain([(description, rows)], chunks))):
+            fh.write(data)
+            yield sink.drain()
+    yield sink.drain()
+    return rows_written
+
+
+def iter_raw_xlsx(dbconn, start_date_str, end_date_str, t, expected_sessions=None, progress=None):
+    """
+    Yield the raw export as an Excel workbook with a session data and a raw data sheet,
+    read in one snapshot like iter_raw_zip(). The raw data continues on more sheets past
+    Excel's row limit (see write_xlsx_sheets()). The workbook is yielded when it is complete.
+
+    Args: see iter_raw_zip().
+
+    Yields:
+        bytes: The workbook. The generator returns the number of data rows written.
+    """
+    chunk_size = export_formats['xlsx'][2]
+    tracker = _SessionProgress(expected_sessions, progress)
+    import openpyxl
+    workbook = openpyxl.Workbook(write_only=True)
+    rows_written = 0
+    with export_snapshot(dbconn) as conn:
+        for name, sheet_name, (sql_query, query_params), empty_message in _raw_parts(start_date_str, end_date_str, t):
+            chunks = tracker.track(iter_query_chunks(dbconn, sql_query, query_params, chunk_size=chunk_size,
+                                                     conn=conn))
+            rows_written += write_xlsx_sheets(workbook, sheet_name, chunks, empty_message)
+    yield from _iter_workbook(workbook)
+    return rows_written
+
+
+def write_raw_xlsx(dbconn, start_date_str, end_date_str, fileobj, t, expected_sessions=None, progress=None):
+    """
+    Write the raw export as an Excel workbook to fileobj, see iter_raw_xlsx().
+
+    Returns:
+        int: Number of data rows written.
+    """
+    return _write_all(iter_raw_xlsx(dbconn, start_date_str, end_date_str, t, expected_sessions, progress), fileobj)
+
+
+def iter_raw_export(dbconn, start_date_str, end_date_str, t, download_format='csv'):
+    """
+    Yield the raw export in download_format: a workbook for xlsx, otherwise a zip with one member per table.
+    """
+    if download_format == 'xlsx':
+        return iter_raw_xlsx(dbconn, start_date_str, end_date_str, t)
+    return iter_raw_zip(dbconn, start_date_str, end_date_str, t, download_format)
+
+
+class _SessionProgress:
+    """
+    Progress of an export measured in dives: each export part (sessions, raw data)
+    counts the distinct sessionids it has written against the number of dives
+    expected in the period.
+    """
+    def __init__(self, expected_sessions, progress):
+        self.expected_sessions = expected_sessions or 0
+        self.progress = progress
+        self.parts = 0
+        self.done = 0
+
+    def track(self, chunks):
+        self.parts += 1
+        last_sessionid = None
+        for description, rows in chunks:
+            if self.progress is not None and rows:
+                col = [d[0] for d in description].index('sessionid')
+                for row in rows:
+                    if row[col] != last_sessionid:
+                        last_sessionid = row[col]
+                        self.done += 1
+                total = max(2 * self.expected_sessions, self.done)
+                self.progress(self.done, total)
+            yield description, rows
@@ -0,0 +1,150 @@
+"""
+HTTP caching headers and response compression.
+
+Data for a period that ended more than `immutable_after_days` days ago does
+not change any more (the update job only processes files up to 7 days old),
+so those responses are sent with a long max-age and marked immutable, and a
+front proxy or the browser can serve them without asking again. All other
+GET responses get `Cache-Control: no-cache` and an ETag, so clients
+revalidate and get a 304 when nothing has changed.
+
+Text responses (JSON, CSV, HTML) larger than `compress_min_size` bytes are
+compressed with brotli (if the brotli package is installed) or gzip. Streamed
+CSV downloads are gzip-compressed chunk by chunk. Parquet and Arrow files are
+already compressed and are sent as they are.
+
+Usage:
+    init_app(app, immutable_after_days=8, compress_min_size=1024)
+
+    @app.route('/resampledday/<dtype>/<thisdate>.json')
+    def resampleddayjson(dtype, thisdate):
+        ...
+        return cache_period(jsonify(res), day)
+"""
+import gzip
+import zlib
+from datetime import date, timedelta
+
+import pandas as pd
+from flask import request
+
+import metrics
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - depends on the installation
+    brotli = None
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+COMPRESSIBLE_MIMETYPES = {'application/json', 'text/csv', 'text/html', 'text/plain', 'text/javascript',
+                          'application/javascript'}
+# Streamed responses of these types are compressed on the fly, others (files, event streams) are left alone
+STREAM_COMPRESSIBLE_MIMETYPES = {'text/csv'}
+
+_settings = {'immutable_after_days': 8, 'compress_min_size': 1024}
+
+
+def is_closed_period(end_date):
+    """
+    True if the period ending on end_date (inclusive, date or 'YYYY-MM-DD'/'YYYYMMDD' string)
+    is old enough that its data can no longer change.
+    """
+    if end_date is None:
+        return False
+    try:
+        end_date = pd.Timestamp(end_date).date()
+    except (ValueError, TypeError):
+        return False
+    return end_date < date.today() - timedelta(days=_settings['immutable_after_days'])
+
+
+def cache_period(response, end_date):
+    """
+    Mark a successful response for a period ending on end_date as immutable if the period is closed.
+    Other responses are left to the default revalidation headers.
+    """
+    if response.status_code == 200 and is_closed_period(end_date):
+        response.cache_control.public = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    return response
+
+
+def _accepted_encoding():
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+
+def _iter_gzip(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31: gzip container
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def finalize_response(response):
+    """
+    after_request hook: add revalidation headers and compress the response body.
+    """
+    if response.status_code != 200 or 'Content-Encoding' in response.headers:
+        return response
+    compressible = response.mimetype in COMPRESSIBLE_MIMETYPES
+
+    if response.is_streamed or response.direct_passthrough:
+        if request.method in ('GET', 'HEAD') and 'Cache-Control' not in response.headers:
+            response.cache_control.no_cache = True
+        if response.mimetype in STREAM_COMPRESSIBLE_MIMETYPES and not response.direct_passthrough:
+            response.vary.add('Accept-Encoding')
+            if request.accept_encodings['gzip']:
+                response.response = _iter_gzip(response.response)
+                response.headers['Content-Encoding'] = 'gzip'
+                response.headers.pop('Content-Length', None)
+        return response
+
+    encoding = None
+    if compressible:
+        response.vary.add('Accept-Encoding')
+        if response.calculate_content_length() >= _settings['compress_min_size']:
+            encoding = _accepted_encoding()
+
+    if request.method in ('GET', 'HEAD'):
+        if 'Cache-Control' not in response.headers:
+            response.cache_control.no_cache = True
+        # A compressed body needs its own ETag, so add the encoding to the tag of the plain body
+        response.add_etag()
+        if encoding is not None:
+            etag, weak = response.get_etag()
+            response.set_etag(f"{etag}-{encoding}", weak=weak)
+        response.make_conditional(request)
+        if request.if_none_match:
+            metrics.cache_event('http_etag', hit=response.status_code == 304)
+        if response.status_code != 200:
+            return response
+
+    if encoding is not None:
+        data = response.get_data()
+        if encoding == 'br':
+            response.set_data(brotli.compress(data, quality=5))
+        else:
+            response.set_data(gzip.compress(data, compresslevel=6))
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def init_app(app, immutable_after_days=None, compress_min_size=None):
+    """
+    Register finalize_response on a Flask app (also works for the Flask server of a Dash app).
+    """
+    if immutable_after_days is not None:
+        _settings['immutable_after_days'] = immutable_after_days
+    if compress_min_size is not None:
+        _settings['compress_min_size'] = compress_min_size
+    app.after_request(finalize_response)
@@ -0,0 +1,69 @@
+"""
+Small in-process caches for computed responses.
+
+Hits and misses are counted in metrics.py (cache_requests_total) under the
+name of the cache. The caches are per process, so each worker keeps its own.
+With `ttl` entries expire after that many seconds, for values that change
+without a key change (e.g. the dataset summary).
+
+Usage:
+    tiles = LRUCache(maxsize=256, name='heatmap_tile')
+    body = tiles.get(key)
+    if body is None:
+        body = ...
+        tiles.put(key, body)
+"""
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+
+class LRUCache:
+    """
+    Thread safe cache that drops the least recently used entry when full.
+
+    Args:
+        maxsize (int): Maximum number of entries (0: cache nothing).
+        name (str): Name of the cache in the metrics.
+        ttl (float): Seconds an entry is kept (None: until it is dropped as least recently used).
+    """
+    def __init__(self, maxsize=128, name='cache', ttl=None):
+        self.maxsize = maxsize
+        self.name = name
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (entry[1] is None or entry[1] > time.monotonic()):
+                self.entries.move_to_end(key)
+                value = entry[0]
+                hit = True
+            else:
+                if entry is not None:
+                    del self.entries[key]
+                value = default
+                hit = False
+        metrics.cache_event(self.name, hit)
+        return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            self.entries[key] = (value, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,203 @@
+"""
+Runtime metrics in the Prometheus text format.
+
+Records per route (and per Dash callback) request latency and response size
+histograms, requests in progress, database pool use and wait time, query
+time per query label (see querylog.py), cache hits and misses, the
+clients and events of the event stream (see events.py) and the reads from the
+data cube (see datacube.py). The
+metrics are served at /metrics and kept in memory per process, so with
+several worker processes each worker reports its own numbers (scrape the
+workers separately, or run one process with threads).
+
+Usage:
+    init_app(app)                        # Flask app
+    init_app(dash_app.server, dash_app=dash_app)
+    cache_event('dive_index', hit=True)
+    observe('db_pool_wait_seconds', 0.002)
+
+The text format is written here, so no client library is needed.
+"""
+import threading
+import time
+from bisect import bisect_left
+
+from flask import Response, current_app, g, request
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+DASH_CALLBACK_PATH = '_dash-update-component'
+
+_lock = threading.Lock()
+# name -> (type, help, buckets or None)
+_definitions = {
+    'http_request_duration_seconds': ('histogram', 'Request latency per route (streamed responses until the last chunk).',
+                                      LATENCY_BUCKETS),
+    'http_response_size_bytes': ('histogram', 'Response body size per route, after compression.', SIZE_BUCKETS),
+    'http_requests_in_progress': ('gauge', 'Requests being handled.', None),
+    'db_query_duration_seconds': ('histogram', 'Database query time per query label.', LATENCY_BUCKETS),
+    'db_pool_wait_seconds': ('histogram', 'Time spent waiting for a connection from the pool.', LATENCY_BUCKETS),
+    'db_pool_connections_in_use': ('gauge', 'Pooled database connections in use.', None),
+    'db_pool_connections_max': ('gauge', 'Size of the database connection pool.', None),
+    'cache_requests_total': ('counter', 'Cache lookups per cache and result (hit or miss).', None),
+    'sse_clients': ('gauge', 'Clients connected to the event stream.', None),
+    'sse_events_total': ('counter', 'New dive events sent to the event stream, per event.', None),
+    'datacube_reads_total': ('counter', 'Reads of interpolated data per source (cube or database).', None),
+}
+# name -> {labels (tuple of (key, value)): value}, histograms: {labels: [bucket counts..., sum, count]}
+_values = {name: {} for name in _definitions}
+
+
+def _key(labels):
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+def observe(name, value, **labels):
+    """
+    Add an observation to the histogram name.
+    """
+    buckets = _definitions[name][2]
+    key = _key(labels)
+    with _lock:
+        series = _values[name].get(key)
+        if series is None:
+            series = _values[name][key] = [0] * (len(buckets) + 2)
+        if value <= buckets[-1]:
+            series[bisect_left(buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+
+def inc(name, amount=1, **labels):
+    """
+    Add amount to the counter or gauge name.
+    """
+    key = _key(labels)
+    with _lock:
+        _values[name][key] = _values[name].get(key, 0) + amount
+
+
+def set_value(name, value, **labels):
+    with _lock:
+        _values[name][_key(labels)] = value
+
+
+def cache_event(cache, hit):
+    inc('cache_requests_total', cache=cache, result='hit' if hit else 'miss')
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def render():
+    """
+    All metrics in the Prometheus text exposition format.
+    """
+    lines = []
+    with _lock:
+        values = {name: {k: list(v) if isinstance(v, list) else v for k, v in series.items()}
+                  for name, series in _values.items()}
+    for name, (kind, help_text, buckets) in _definitions.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for key, value in sorted(values[name].items()):
+            if kind != 'histogram':
+                lines.append(f'{name}{_format_labels(key)} {value}')
+                continue
+            cumulative = 0
+            for bound, n in zip(buckets, value):
+                cumulative += n
+                lines.append(f'{name}_bucket{_format_labels(key, [("le", bound)])} {cumulative}')
+            lines.append(f'{name}_bucket{_format_labels(key, [("le", "+Inf")])} {value[-1]}')
+            lines.append(f'{name}_sum{_format_labels(key)} {value[-2]}')
+            lines.append(f'{name}_count{_format_labels(key)} {value[-1]}')
+    return '\n'.join(lines) + '\n'
+
+
+def _route_label():
+    """
+    The route rule (e.g. /api/v1/heatmap/<dtype>.json), or the Dash callback outputs for callback requests.
+    """
+    prefix = request.script_root or ''
+    if request.path.endswith(DASH_CALLBACK_PATH):
+        body = request.get_json(silent=True)
+        output = body.get('output') if isinstance(body, dict) else None
+        # The body comes from the client, only the outputs of registered callbacks become labels
+        callbacks = getattr(current_app.extensions.get('metrics_dash_app'), 'callback_map', {})
+        if isinstance(output, str) and output in callbacks:
+            output = output.strip('.').replace('...', ',')
+        else:
+            output = 'unknown'
+        return f'{prefix}/{DASH_CALLBACK_PATH}', output
+    rule = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    return prefix + rule, ''
+
+
+def _before_request():
+    g.metrics_start = time.perf_counter()
+    inc('http_requests_in_progress')
+
+
+def _teardown_request(exc):
+    if g.pop('metrics_start', None) is not None or g.pop('metrics_done', False):
+        inc('http_requests_in_progress', -1)
+
+
+def _iter_counted(chunks, labels, start):
+    size = 0
+    try:
+        for chunk in chunks:
+            size += len(chunk)
+            yield chunk
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+        observe('http_request_duration_seconds', time.perf_counter() - start, **labels)
+        observe('http_response_size_bytes', size, **labels)
+
+
+def _after_request(response):
+    start = g.pop('metrics_start', None)
+    if start is None:
+        return response
+    g.metrics_done = True
+    route, callback = _route_label()
+    labels = dict(route=route, method=request.method, status=str(response.status_code))
+    if callback:
+        labels['callback'] = callback
+    if response.is_streamed:
+        # Measure until the last chunk has been sent
+        response.response = _iter_counted(response.response, labels, start)
+        return response
+    observe('http_request_duration_seconds', time.perf_counter() - start, **labels)
+    size = 0 if response.status_code == 304 else response.calculate_content_length() or 0
+    observe('http_response_size_bytes', size, **labels)
+    return response
+
+
+def metrics_response():
+    return Response(render(), mimetype='text/plain; version=0.0.4')
+
+
+def init_app(app, endpoint=None, dash_app=None):
+    """
+    Record the requests of a Flask app (also works for the Flask server of a Dash app).
+    Register init_app before http_cache.init_app, so the sizes are measured after compression.
+
+    Args:
+        app (Flask): The app.
+        endpoint (str): Path to serve the metrics at (e.g. '/metrics'), None: do not serve them from this app.
+        dash_app (Dash): The Dash app served by app, its callbacks are recorded per output.
+    """
+    if dash_app is not None:
+        app.extensions['metrics_dash_app'] = dash_app
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    if endpoint is not None:
+        app.add_url_rule(endpoint, 'metrics', metrics_response)
@@ -0,0 +1,169 @@
+"""
+Timing of database queries and a log of slow queries.
+
+The download queries are built from many option combinations (depth range,
+resampling, aggregation, parameters), and some combinations are much slower
+than others. All queries in utils.py are run through execute(), which records
+the time per query label (the function that built the query). A query slower
+than `slow_query_ms` is kept in a short list of recent slow queries together
+with its SQL, parameters and `EXPLAIN (ANALYZE, BUFFERS)` plan.
+
+EXPLAIN ANALYZE runs the query a second time, so a plan is captured at most
+once per `explain_interval` seconds per label. Streamed exports (named
+cursors) only get a plain EXPLAIN, their cost is in the transfer anyway.
+
+The list is shown at /debug/slow-queries when `debug_endpoints` is set in
+config.json.
+
+Usage:
+    init(slow_query_ms=1000, explain=True)
+
+    with conn.cursor() as cur:
+        execute(cur, sql_query, query_params, label='download')
+        rows = cur.fetchall()
+"""
+import logging
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+import psycopg2
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+_settings = {'slow_query_ms': 1000, 'explain': True, 'explain_interval': 60, 'max_entries': 50}
+_lock = threading.Lock()
+_slow_queries = deque(maxlen=_settings['max_entries'])
+_stats = {}  # label -> {'count', 'total_ms', 'max_ms', 'slow'}
+_last_explain = {}  # label -> time.monotonic() of the last EXPLAIN
+
+
+def init(slow_query_ms=None, explain=None, explain_interval=None, max_entries=None):
+    """
+    Change the settings. slow_query_ms=0 logs every query as slow.
+    """
+    global _slow_queries
+    if slow_query_ms is not None:
+        _settings['slow_query_ms'] = slow_query_ms
+    if explain is not None:
+        _settings['explain'] = explain
+    if explain_interval is not None:
+        _settings['explain_interval'] = explain_interval
+    if max_entries is not None:
+        _settings['max_entries'] = max_entries
+        with _lock:
+            _slow_queries = deque(_slow_queries, maxlen=max_entries)
+
+
+def _query_text(cur, sql_query, query_params):
+    try:
+        return cur.mogrify(sql_query, query_params).decode()
+    except (AttributeError, psycopg2.Error, TypeError, ValueError):
+        return sql_query
+
+
+def _wants_explain(label):
+    if not _settings['explain']:
+        return False
+    now = time.monotonic()
+    with _lock:
+        last = _last_explain.get(label)
+        if last is not None and now - last < _settings['explain_interval']:
+            return False
+        _last_explain[label] = now
+    return True
+
+
+def _explain(conn, sql_query, query_params, analyze=True):
+    """
+    Plan of the query as text, run in a savepoint on conn so a failure does not abort its transaction.
+    """
+    options = '(ANALYZE, BUFFERS)' if analyze else ''
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SAVEPOINT querylog_explain;")
+            try:
+                cur.execute(f"EXPLAIN {options} {sql_query}", query_params)
+                plan = '\n'.join(row[0] for row in cur.fetchall())
+            except psycopg2.Error as e:
+                cur.execute("ROLLBACK TO SAVEPOINT querylog_explain;")
+                plan = f"EXPLAIN failed: {e}"
+            cur.execute("RELEASE SAVEPOINT querylog_explain;")
+    except psycopg2.Error as e:
+        plan = f"EXPLAIN failed: {e}"
+    return plan
+
+
+def record(label, seconds, sql_query=None, query_params=None, query_text=None, rows=None,
+           conn=None, analyze=True):
+    """
+    Record the time of one query. If it is slow, keep it in the slow query list,
+    with a plan if conn (psycopg2 connection) is given.
+
+    Args:
+        label (str): Name of the query, e.g. the function that built it.
+        seconds (float): Time spent on the query.
+        sql_query (str), query_params: The query, for the plan and the log.
+        query_text (str): The query with the parameters filled in (default: sql_query).
+        rows (int): Number of rows returned, if known.
+        conn: psycopg2 connection to run EXPLAIN on (None: no plan).
+        analyze (bool): Use EXPLAIN (ANALYZE, BUFFERS), otherwise a plain EXPLAIN.
+    """
+    ms = seconds * 1000
+    slow = ms >= _settings['slow_query_ms']
+    metrics.observe('db_query_duration_seconds', seconds, query=label)
+    with _lock:
+        stats = _stats.setdefault(label, {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'slow': 0})
+        stats['count'] += 1
+        stats['total_ms'] += ms
+        stats['max_ms'] = max(stats['max_ms'], ms)
+        stats['slow'] += slow
+    logger.debug("%s: %.1f ms", label, ms)
+    if not slow:
+        return
+
+    plan = None
+    if conn is not None and sql_query is not None and _wants_explain(label):
+        plan = _explain(conn, sql_query, query_params, analyze=analyze)
+    entry = {
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'label': label,
+        'duration_ms': round(ms, 1),
+        'rows': rows,
+        'query': query_text or sql_query,
+        'params': [str(p) for p in query_params] if query_params else [],
+        'plan': plan,
+    }
+    with _lock:
+        _slow_queries.append(entry)
+    logger.warning("Slow query %s: %.1f ms", label, ms)
+
+
+def execute(cur, sql_query, query_params=None, label='query'):
+    """
+    cur.execute(sql_query, query_params) with timing, see record().
+    The rows of a client side cursor are already fetched when execute() returns.
+    """
+    t0 = time.perf_counter()
+    cur.execute(sql_query, query_params)
+    seconds = time.perf_counter() - t0
+    if seconds * 1000 >= _settings['slow_query_ms']:
+        record(label, seconds, sql_query, query_params, query_text=_query_text(cur, sql_query, query_params),
+               rows=cur.rowcount, conn=cur.connection)
+    else:
+        record(label, seconds)
+
+
+def report():
+    """
+    Settings, timing per label and the recent slow queries (newest first), for the debug endpoint.
+    """
+    with _lock:
+        stats = {label: dict(s, mean_ms=round(s['total_ms'] / s['count'], 1), total_ms=round(s['total_ms'], 1),
+                             max_ms=round(s['max_ms'], 1))
+                 for label, s in sorted(_stats.items())}
+        slow = list(reversed(_slow_queries))
+    return {'settings': dict(_settings), 'stats': stats, 'slow_queries': slow}
@@ -0,0 +1,81 @@
+"""
+JSON serialization for the graph and API endpoints.
+
+orjson writes NumPy arrays, datetimes and NaN (as null) directly, which is
+much faster than plotly's PlotlyJSONEncoder walking the data element by
+element. If orjson is not installed we fall back to the plotly encoder, which
+produces equivalent JSON.
+
+Usage:
+    from serialize import dumps, json_response
+    graphJSON = dumps(graph)                 # str, e.g. for templates
+    return json_response(graph)              # flask.Response
+"""
+import decimal
+
+import numpy as np
+import pandas as pd
+from flask import Response
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - depends on the installation
+    orjson = None
+
+_ORJSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY if orjson is not None else 0
+
+
+def _default(obj):
+    """
+    Convert the objects orjson does not handle natively.
+    """
+    if isinstance(obj, (pd.Index, pd.Series)):
+        return np.ascontiguousarray(obj.to_numpy())
+    if isinstance(obj, np.ndarray):
+        # Numeric and datetime arrays are only written natively when C-contiguous
+        if obj.dtype.kind in 'fiubM' and not obj.flags['C_CONTIGUOUS']:
+            return np.ascontiguousarray(obj)
+        if obj.dtype.kind == 'M':
+            return obj.astype('datetime64[us]').tolist()
+        return obj.tolist()
+    if isinstance(obj, pd.Timestamp):
+        return obj.to_pydatetime()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    if obj is pd.NaT:
+        return None
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+def dumps_bytes(obj):
+    """
+    Serialize obj to UTF-8 encoded JSON.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, default=_default, option=_ORJSON_OPTIONS)
+    return _dumps_plotly(obj).encode('utf-8')
+
+
+def dumps(obj):
+    """
+    Serialize obj to a JSON string.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, default=_default, option=_ORJSON_OPTIONS).decode('utf-8')
+    return _dumps_plotly(obj)
+
+
+def json_response(obj, status=200):
+    """
+    Return a flask Response with obj serialized as JSON.
+    """
+    return Response(dumps_bytes(obj), status=status, mimetype='application/json')
+
+
+def _dumps_plotly(obj):
+    # Imported here, plotly is slow to import and only needed for the fallback
+    import json
+    import plotly
+    return json.dumps(obj, cls=plotly.utils.PlotlyJSONEncoder)
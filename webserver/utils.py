@@ -1,7 +1,19 @@
 import psycopg2
+import psycopg2.extensions
+import numpy as np
 import pandas as pd
 import os
 import json
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from downsample import downsample
+import metrics
+import querylog
+from dbpool import connection
+from querylog import execute
 
 timeframe_sql_map = {
     "3H": "3 hours",
@@ -11,6 +23,14 @@ timeframe_sql_map = {
     "1W": "1 week",
     "1M": "1 month"
 }
+# Length of the fixed length timeframes (date_bin does not support months)
+timeframe_step_map = {
+    "3H": pd.Timedelta(hours=3),
+    "6H": pd.Timedelta(hours=6),
+    "12H": pd.Timedelta(hours=12),
+    "1D": pd.Timedelta(days=1),
+    "1W": pd.Timedelta(weeks=1),
+}
     
 valid_datatypes = [ "temperature", "salinity", "fluorescence", "turbidity", "oxygen"]
 # For api v1 compatibility
@@ -35,18 +55,35 @@ def get_datatype_name(param):
 depth_set = [0.5, 1.5, 2.5, 3.5, 4.5, 5.5, 6.5, 7.5, 8.5, 9.5, 10.5, 11.5, 12.5, 13.5, 14.5, 15.5, 16.5, 17.5, 18.5, 19.5]
 
 # v2 api
-def get_freq(dbconn, format='json'):
-    # Get the number of dives per day
-    with psycopg2.connect(dbconn) as conn:
+# The read endpoints are split in a query builder and a function that turns the rows into the
+# response, so the async API (async_api.py) can run the same SQL with an async driver.
+
+def fetch_rows(dbconn, query, label='query'):
+    """
+    Run query = (sql_query, query_params) and return (column names, rows).
+    label names the query in the query timing (see querylog.py).
+    """
+    sql_query, query_params = query
+    with connection(dbconn) as conn:
         with conn.cursor() as cur:
-            cur.execute("""
+            execute(cur, sql_query, query_params, label=label)
+            rows = cur.fetchall()
+            columns = [desc.name for desc in cur.description]
+    return columns, rows
+
+def build_freq_query():
+    # Number of dives per day
+    return """
                         SELECT DATE(startdatetime) as date, COUNT(sessionid) as dives 
                         FROM session_data 
                         GROUP BY DATE(startdatetime) 
                         ORDER BY DATE(startdatetime);
-            """)
-            rows = cur.fetchall()
-    
+            """, None
+
+def freq_result(rows, format='json'):
+    """
+    Dives per day from the rows of build_freq_query() as a DataFrame, CSV or a dict of lists (see get_freq).
+    """
     df = pd.DataFrame(rows, columns=['date', 'dives'])
     if not df.empty:
         df['date'] = pd.to_datetime(df['date'])
@@ -64,20 +101,20 @@ def get_freq(dbconn, format='json'):
         counts_list = df['dives'].tolist()
         return {"dates": dates_list, "counts": counts_list}
 
+def get_freq(dbconn, format='json'):
+    # Get the number of dives per day
+    columns, rows = fetch_rows(dbconn, build_freq_query(), label='freq')
+    return freq_result(rows, format)
+
 # v1 api and fig
-def generate_freq(title, dbconn):
-    with psycopg2.connect(dbconn) as conn:
-        with conn.cursor() as cur:
-            # Fetch the number of dives per day
-            cur.execute("""
-                        SELECT DATE(startdatetime), COUNT(sessionid) as dives 
-                        FROM session_data 
-                        GROUP BY DATE(startdatetime) 
-                        ORDER BY DATE(startdatetime);
-            """)
-            rows = cur.fetchall()
+def freq_graph(rows, title, max_points=None):
+    """
+    Dives per day graph from the rows of build_freq_query().
+    """
     dates = [row[0] for row in rows]
     counts = [row[1] for row in rows]
+    # Limit the number of points sent to the browser (LTTB)
+    dates, counts = downsample(dates, counts, max_points)
     graphs = [
         dict(
             data=[
@@ -95,32 +132,54 @@ def generate_freq(title, dbconn):
     ]
     return graphs
 
+def generate_freq(title, dbconn, max_points=None):
+    columns, rows = fetch_rows(dbconn, build_freq_query(), label='freq')
+    return freq_graph(rows, title, max_points)
+
 def get_valid_years(dbconn):
-    with psycopg2.connect(dbconn) as conn:
+    with connection(dbconn) as conn:
         with conn.cursor() as cur:
-            cur.execute("""
-                        SELECT DISTINCT EXTRACT(year FROM startdatetime) as YR FROM session_data ORDER BY YR;
-            """)
+            execute(cur, """
+                        SELECT year FROM dataset_summary_year ORDER BY year;
+            """, label='valid_years')
             years = [int(row[0]) for row in cur.fetchall()]
     return years
 
-def get_download_data(dbconn, start_date_str, end_date_str, depth_range_bounds_list,
-                      resampling_interval_str, depth_aggregation_str, selected_parameters_list):
+def get_dataset_summary(dbconn):
     """
-    Fetch downloadable data from the interpolated_timeseries table
-    based on specified parameters.
-    
+    Summary of the dives, from the dataset_summary tables kept up to date by triggers on session_data.
+
     Args:
         dbconn (str): Database connection string.
-        start_date_str (str): Start date in 'YYYY-MM-DD' format.
-        end_date_str (str): End date in 'YYYY-MM-DD' format.
-        depth_range_bounds_list (list): List containing two numbers [min_depth, max_depth].
-        resampling_interval_str (str): Resampling interval key (e.g., '3H', '1D', 'all').
-        depth_aggregation_str (str): Depth aggregation method ('all_selected' or 'average').
-        selected_parameters_list (list): List of frontend parameter names to download.
 
     Returns:
-        pandas.DataFrame: DataFrame containing the requested data.
+        dict: dives (total), first_dive, last_dive, last_ingest, updated_at (datetimes or None) and
+              years ({year: {'dives', 'first_dive', 'last_dive'}}, in order).
+    """
+    with connection(dbconn) as conn:
+        with conn.cursor() as cur:
+            execute(cur, """
+                        SELECT dives, first_dive, last_dive, last_ingest, updated_at FROM dataset_summary;
+            """, label='dataset_summary')
+            row = cur.fetchone()
+            execute(cur, """
+                        SELECT year, dives, first_dive, last_dive FROM dataset_summary_year ORDER BY year;
+            """, label='dataset_summary')
+            years = {int(year): {'dives': dives, 'first_dive': first_dive, 'last_dive': last_dive}
+                     for year, dives, first_dive, last_dive in cur.fetchall()}
+    summary = dict(zip(['dives', 'first_dive', 'last_dive', 'last_ingest', 'updated_at'], row or [0, None, None, None, None]))
+    summary['years'] = years
+    return summary
+
+def build_download_query(start_date_str, end_date_str, depth_range_bounds_list,
+                         resampling_interval_str, depth_aggregation_str, selected_parameters_list):
+    """
+    Build the SQL query used by get_download_data().
+
+    Args: see get_download_data().
+
+    Returns:
+        tuple: (sql_query, query_params), or None if no depths are within the depth range.
 
     Raises:
         ValueError: If input parameters are invalid.
@@ -141,24 +200,7 @@ def get_download_data(dbconn, start_date_str, end_date_str, depth_range_bounds_l
 
     actual_depths_to_query = sorted([d for d in depth_set if depth_range_bounds_list[0] <= d <= depth_range_bounds_list[1]])
     if not actual_depths_to_query:
-        # Return an empty DataFrame with expected columns if no depths match
-        # This helps prevent errors in the frontend if it expects a DataFrame
-        print(f"Warning: No valid depths found in the range {depth_range_bounds_list} based on available depths: {depth_set}. Returning empty DataFrame.")
-        
-        # Construct expected column names for the empty DataFrame
-        expected_cols = ['ts']
-        if depth_aggregation_str == 'all_selected':
-            expected_cols.append('pressure_dbar')
-        for p_frontend in selected_parameters_list:
-            expected_cols.append(p_frontend)
-        
-        # Create an empty DataFrame with appropriate index
-        idx = pd.MultiIndex(levels=[[], []], codes=[[], []], names=['ts', 'pressure_dbar']) if depth_aggregation_str == 'all_selected' else pd.Index([], name='ts')
-        # Remove 'ts' and 'pressure_dbar' from expected_cols as they are handled by index
-        data_cols = [col for col in expected_cols if col not in ['ts', 'pressure_dbar']]
-        
-        return pd.DataFrame(index=idx, columns=data_cols)
-
+        return None
 
     if resampling_interval_str != 'all' and resampling_interval_str not in timeframe_sql_map:
         raise ValueError(f"Invalid resampling_interval_str: {resampling_interval_str}. Valid options are 'all' or {list(timeframe_sql_map.keys())}")
@@ -210,9 +252,10 @@ def get_download_data(dbconn, start_date_str, end_date_str, depth_range_bounds_l
     
     sql_query = f"SELECT {', '.join(final_select_clauses)} " \
                 f"FROM interpolated_timeseries it JOIN session_data sd USING(sessionid) " \
-                f"WHERE DATE(sd.startdatetime) BETWEEN %s AND %s"
+                f"WHERE sd.startdatetime >= %s AND sd.startdatetime < %s"
     
-    query_params = [start_date, end_date]
+    # Half-open range on the timestamp itself, so the index on startdatetime can be used
+    query_params = [start_date, end_date + timedelta(days=1)]
 
     if actual_depths_to_query: # Only add depth filter if there are depths to query
         sql_query += " AND it.pressure_dbar = ANY(%s::real[])" # Explicit cast for array parameter
@@ -233,11 +276,56 @@ def get_download_data(dbconn, start_date_str, end_date_str, depth_range_bounds_l
     
     sql_query += f" ORDER BY {', '.join(order_by_clause_parts)};"
 
+    return sql_query, query_params
+
+def get_download_data(dbconn, start_date_str, end_date_str, depth_range_bounds_list,
+                      resampling_interval_str, depth_aggregation_str, selected_parameters_list):
+    """
+    Fetch downloadable data from the interpolated_timeseries table
+    based on specified parameters.
+    
+    Args:
+        dbconn (str): Database connection string.
+        start_date_str (str): Start date in 'YYYY-MM-DD' format.
+        end_date_str (str): End date in 'YYYY-MM-DD' format.
+        depth_range_bounds_list (list): List containing two numbers [min_depth, max_depth].
+        resampling_interval_str (str): Resampling interval key (e.g., '3H', '1D', 'all').
+        depth_aggregation_str (str): Depth aggregation method ('all_selected' or 'average').
+        selected_parameters_list (list): List of frontend parameter names to download.
+
+    Returns:
+        pandas.DataFrame: DataFrame containing the requested data.
+
+    Raises:
+        ValueError: If input parameters are invalid.
+    """
+    query = build_download_query(start_date_str, end_date_str, depth_range_bounds_list,
+                                 resampling_interval_str, depth_aggregation_str, selected_parameters_list)
+    if query is None:
+        # Return an empty DataFrame with expected columns if no depths match
+        # This helps prevent errors in the frontend if it expects a DataFrame
+        print(f"Warning: No valid depths found in the range {depth_range_bounds_list} based on available depths: {depth_set}. Returning empty DataFrame.")
+        
+        # Construct expected column names for the empty DataFrame
+        expected_cols = ['ts']
+        if depth_aggregation_str == 'all_selected':
+            expected_cols.append('pressure_dbar')
+        for p_frontend in selected_parameters_list:
+            expected_cols.append(p_frontend)
+        
+        # Create an empty DataFrame with appropriate index
+        idx = pd.MultiIndex(levels=[[], []], codes=[[], []], names=['ts', 'pressure_dbar']) if depth_aggregation_str == 'all_selected' else pd.Index([], name='ts')
+        # Remove 'ts' and 'pressure_dbar' from expected_cols as they are handled by index
+        data_cols = [col for col in expected_cols if col not in ['ts', 'pressure_dbar']]
+        
+        return pd.DataFrame(index=idx, columns=data_cols)
+
+    sql_query, query_params = query
+
     # 3. Execute query and fetch data
-    with psycopg2.connect(dbconn) as conn:
+    with connection(dbconn) as conn:
         with conn.cursor() as cur:
-            # print("Executing SQL:", cur.mogrify(sql_query, tuple(query_params)).decode()) # For debugging
-            cur.execute(sql_query, tuple(query_params))
+            execute(cur, sql_query, tuple(query_params), label='download')
             rows = cur.fetchall()
             colnames = [desc[0] for desc in cur.description]
     
@@ -274,87 +362,571 @@ def get_download_data(dbconn, start_date_str, end_date_str, depth_range_bounds_l
             raise
     return df
 
-def get_resampled_day(day, datatype, timeframe, dbconn):
+def build_resampled_range_query(start_date, end_date, datatype, timeframe):
+    """
+    Build the SQL query used by get_resampled_range().
 
+    Returns:
+        tuple: (sql_query, query_params)
+
+    Raises:
+        ValueError: For an invalid datatype, timeframe or date range.
+    """
     if datatype not in valid_datatypes:
         raise ValueError(f"Invalid datatype: {datatype}. Valid options are: {valid_datatypes}")
-    if timeframe not in timeframe_sql_map:
-        raise ValueError(f"Invalid timeframe: {timeframe}. Valid options are: {list(timeframe_sql_map.keys())}")
-    # Parse YYYYMMDD format to a date object
+    if timeframe not in timeframe_step_map:
+        raise ValueError(f"Invalid timeframe: {timeframe}. Valid options are: {list(timeframe_step_map.keys())}")
+    start_time = pd.Timestamp(start_date).normalize()
+    end_time = pd.Timestamp(end_date).normalize() + pd.Timedelta(days=1)
+    if end_time <= start_time:
+        raise ValueError("The end date must be the same as or after the start date.")
+    sql_query = f"""
+                        SELECT date_bin('{timeframe_sql_map[timeframe]}', startdatetime, '2001-01-01 00:00') as ts,
+                        pressure_dbar, AVG(NULLIF({datatype}, 'NaN')) as val
+                        FROM interpolated_timeseries 
+                        JOIN session_data USING(sessionid)
+                        WHERE startdatetime >= %s AND startdatetime < %s
+                        GROUP BY pressure_dbar, ts;
+            """
+    return sql_query, (start_time.to_pydatetime(), end_time.to_pydatetime())
+
+def resampled_range_periods(start_date, end_date, timeframe):
+    """
+    The periods of get_resampled_range(): the date_bin bins (origin 2001-01-01) that overlap the range.
+    """
+    start_time = pd.Timestamp(start_date).normalize()
+    end_time = pd.Timestamp(end_date).normalize() + pd.Timedelta(days=1)
+    step = timeframe_step_map[timeframe]
+    origin = pd.Timestamp('2001-01-01')
+    first = origin + ((start_time - origin) // step) * step
+    return pd.date_range(start=first, end=end_time - pd.Timedelta(microseconds=1), freq=step, name='ts')
+
+def resampled_range_result(rows, start_date, end_date, timeframe):
+    """
+    The (period x depth) DataFrame of get_resampled_range() from the rows of build_resampled_range_query().
+    """
+    periods = resampled_range_periods(start_date, end_date, timeframe)
+
+    # Scatter the rows straight into a (period x depth) grid instead of pivot + reindex
+    values = np.full((len(periods), len(depth_set)), np.nan)
+    if rows:
+        ts, pressure, val = zip(*rows)
+        ti = periods.get_indexer(pd.DatetimeIndex(ts))
+        di = pd.Index(depth_set).get_indexer(np.asarray(pressure, dtype=float))
+        found = (ti >= 0) & (di >= 0)
+        values[ti[found], di[found]] = np.asarray(val, dtype=float)[found]
+    return pd.DataFrame(values, index=periods, columns=depth_set)
+
+def cube_resampled_range(cube, start_date, end_date, datatype, timeframe):
+    """
+    The DataFrame of get_resampled_range() from the data cube (see datacube.py), None if the cube
+    can not be read.
+    """
+    periods = resampled_range_periods(start_date, end_date, timeframe)
+    # Only the dives in the range, like the WHERE of build_resampled_range_query()
+    start_time = pd.Timestamp(start_date).normalize()
+    end_time = pd.Timestamp(end_date).normalize() + pd.Timedelta(days=1)
+    values = cube.resample(datatype, periods[0], len(periods), timeframe_step_map[timeframe],
+                           start=start_time, end=end_time)
+    if values is None:
+        return None
+    return pd.DataFrame(values, index=periods, columns=depth_set)
+
+def get_resampled_range(start_date, end_date, datatype, timeframe, dbconn, cube=None):
+    """
+    Get the resampled data for one datatype from start_date to end_date (both inclusive) as a
+    DataFrame with one row per period (index ts) and one column per depth in depth_set.
+    Periods and depths without data are NaN.
+
+    Args:
+        start_date, end_date: First and last day (date or 'YYYY-MM-DD').
+        datatype (str): One of valid_datatypes.
+        timeframe (str): One of timeframe_step_map.
+        dbconn (str): Database connection string.
+        cube (DataCube): Read from this data cube when it is available, otherwise from the database.
+
+    Returns:
+        pd.DataFrame
+
+    Raises:
+        ValueError: For an invalid datatype, timeframe or date range.
+    """
+    query = build_resampled_range_query(start_date, end_date, datatype, timeframe)
+    if cube is not None:
+        df = cube_resampled_range(cube, start_date, end_date, datatype, timeframe)
+        metrics.inc('datacube_reads_total', source='cube' if df is not None else 'database')
+        if df is not None:
+            return df
+    columns, rows = fetch_rows(dbconn, query, label='resampled_range')
+    return resampled_range_result(rows, start_date, end_date, timeframe)
+
+
+def resampled_day_v1(df, datatype):
+    """
+    The v1 /resampledday response: one dict per period with the value at every depth.
+    Uses the old (v1) datatype names. Built from plain lists, iterrows() is far too slow for this.
+    """
+    dtype_out = names_new_to_old_map.get(datatype)
+    depths = df.columns.tolist()
+    timestamps = df.index.strftime('%Y-%m-%d %H:%M:%S').tolist()
+    return [{'datatype': dtype_out,
+             'ts': ts,
+             'divedata': [{'pressure(dBAR)': k, dtype_out: v} for k, v in zip(depths, row)]}
+            for ts, row in zip(timestamps, df.to_numpy().tolist())]
+
+def resampled_range_columns(df, datatype, resampling):
+    """
+    The columnar /api/v2/resampled response, values[i][j] is the value at ts[i] and depth[j].
+    """
+    return {'datatype': datatype,
+            'resampling': resampling,
+            'ts': df.index.values,
+            'depth': df.columns.values,
+            'values': df.to_numpy()}
+
+def get_resampled_day(day, datatype, timeframe, dbconn, cube=None):
+    """
+    Resampled data for one day given as YYYYMMDD, see get_resampled_range.
+    Returns None if the date can not be parsed.
+    """
     try:
         start_time = pd.to_datetime(day, format='%Y%m%d').date()
     except ValueError:
-        return None, "Invalid date format. Use YYYYMMDD."
-    
-    with psycopg2.connect(dbconn) as conn:
-        with conn.cursor() as cur:
-            # Fetch the data for the specified day and datatype
-            cur.execute(f"""
-                        SELECT AVG({datatype}) as val, pressure_dbar, 
-                        date_bin('{timeframe_sql_map[timeframe]}', startdatetime, '2001-01-01 00:00') as ts
-                        FROM interpolated_timeseries 
+        return None
+    return get_resampled_range(start_time, start_time, datatype, timeframe, dbconn, cube=cube)
+
+# Series of one datatype at a few depths, per dive (resampling 'all') or averaged per period, for line charts.
+# Read from the data cube (see datacube.py) when it is available, otherwise from the database, where the
+# covering index on interpolated_timeseries (sessionid, pressure_dbar) gives the values of a depth.
+
+def series_depths(depths):
+    """
+    The requested depths as floats in depth_set order.
+
+    Raises:
+        ValueError: For no depths or a depth that is not in depth_set.
+    """
+    try:
+        values = {float(depth) for depth in depths}
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid depth. Valid options are: {depth_set}")
+    if not values:
+        raise ValueError(f"At least one depth is required. Valid options are: {depth_set}")
+    invalid = values.difference(depth_set)
+    if invalid:
+        raise ValueError(f"Invalid depth: {sorted(invalid)[0]}. Valid options are: {depth_set}")
+    return [depth for depth in depth_set if depth in values]
+
+def build_series_query(start_date, end_date, datatype, depths, resampling='all'):
+    """
+    Build the SQL query used by get_series().
+
+    Returns:
+        tuple: (sql_query, query_params)
+
+    Raises:
+        ValueError: For an invalid datatype, depth, resampling or date range.
+    """
+    if datatype not in valid_datatypes:
+        raise ValueError(f"Invalid datatype: {datatype}. Valid options are: {valid_datatypes}")
+    if resampling != 'all' and resampling not in timeframe_step_map:
+        raise ValueError(f"Invalid resampling: {resampling}. Valid options are 'all' or {list(timeframe_step_map.keys())}")
+    depths = series_depths(depths)
+    start_time = pd.Timestamp(start_date).normalize()
+    end_time = pd.Timestamp(end_date).normalize() + pd.Timedelta(days=1)
+    if end_time <= start_time:
+        raise ValueError("The end date must be the same as or after the start date.")
+    # Missing values (NULL or NaN) are left out, as in the data cube: a dive is in the series when it has a
+    # value at one of the depths, and the means are over the values
+    if resampling == 'all':
+        # One row per dive and depth, sessionid keeps dives with the same start time apart
+        sql_query = f"""
+                        SELECT startdatetime as ts, sessionid, pressure_dbar, {datatype} as val
+                        FROM interpolated_timeseries
                         JOIN session_data USING(sessionid)
-                        WHERE DATE(startdatetime) = %s
-                        GROUP BY pressure_dbar, ts
-                        ORDER BY ts, pressure_dbar DESC;
-            """, (start_time,))
-            rows = cur.fetchall()
+                        WHERE startdatetime >= %s AND startdatetime < %s AND pressure_dbar = ANY(%s)
+                        AND {datatype} IS NOT NULL AND {datatype} <> 'NaN'
+                        ORDER BY startdatetime, sessionid;
+            """
+    else:
+        sql_query = f"""
+                        SELECT date_bin('{timeframe_sql_map[resampling]}', startdatetime, '2001-01-01 00:00') as ts,
+                        NULL as sessionid, pressure_dbar, AVG({datatype}) as val
+                        FROM interpolated_timeseries
+                        JOIN session_data USING(sessionid)
+                        WHERE startdatetime >= %s AND startdatetime < %s AND pressure_dbar = ANY(%s)
+                        AND {datatype} IS NOT NULL AND {datatype} <> 'NaN'
+                        GROUP BY pressure_dbar, ts;
+            """
+    return sql_query, (start_time.to_pydatetime(), end_time.to_pydatetime(), depths)
 
-    end_time = start_time + pd.Timedelta(days=1)
+def series_result(rows, start_date, end_date, depths, resampling='all'):
+    """
+    (ts, values) of get_series() from the rows of build_series_query().
+    """
+    depths = series_depths(depths)
+    if resampling == 'all':
+        # The rows are ordered by dive, a new dive starts where ts or sessionid changes
+        starts = [i == 0 or rows[i][:2] != rows[i - 1][:2] for i in range(len(rows))]
+        dive = np.cumsum(starts, dtype=np.int64) - 1
+        ts = np.array([row[0] for row, start in zip(rows, starts) if start], dtype='datetime64[us]')
+    else:
+        ts = resampled_range_periods(start_date, end_date, resampling).values
+        dive = pd.DatetimeIndex(ts).get_indexer(pd.DatetimeIndex([row[0] for row in rows])) if rows else []
+    values = np.full((len(depths), len(ts)), np.nan)
+    if rows:
+        di = pd.Index(depths).get_indexer(np.asarray([row[2] for row in rows], dtype=float))
+        val = np.asarray([row[3] for row in rows], dtype=float)
+        dive = np.asarray(dive)
+        found = (dive >= 0) & (di >= 0)
+        values[di[found], dive[found]] = val[found]
+    return ts, values
+
+def cube_series(cube, start_date, end_date, datatype, depths, resampling='all'):
+    """
+    (ts, values) of get_series() from the data cube, None if the cube can not be read.
+    """
+    depths = series_depths(depths)
+    start_time = pd.Timestamp(start_date).normalize()
+    end_time = pd.Timestamp(end_date).normalize() + pd.Timedelta(days=1)
+    if resampling == 'all':
+        found = cube.series(datatype, start_time, end_time, depths=depths)
+        if found is None:
+            return None
+        ts, values = found
+        # Like the query, only the dives with a value (not NaN) at one of these depths
+        found = ~np.isnan(values).all(axis=1)
+        return ts[found], values[found].T
+    periods = resampled_range_periods(start_date, end_date, resampling)
+    values = cube.resample(datatype, periods[0], len(periods), timeframe_step_map[resampling], depths=depths,
+                           start=start_time, end=end_time)
+    if values is None:
+        return None
+    return periods.values, values.T
+
+def get_series(start_date, end_date, datatype, depths, dbconn, resampling='all', cube=None):
+    """
+    One datatype at the given depths from start_date to end_date (both inclusive), one value per dive
+    (resampling 'all') or the mean per period (a key of timeframe_step_map, all periods of the range).
 
-    df = pd.DataFrame(rows, columns=[desc.name for desc in cur.description])
-    df2 = df.pivot(index='pressure_dbar', columns='ts', values='val')
-    # Fill in missing periods and depths with NaN 
-    df2 = df2.reindex(pd.date_range(start=start_time, 
-                                    end=end_time, 
-                                    freq=timeframe)[:-1], 
-                                    axis='columns')
-    df2 = df2.reindex(depth_set, axis='index')  # Reindex to include all depths
-    df2 = df2.sort_index(axis='columns')  # Sort columns by timestamp
-    df2 = df2.sort_index(axis='index')  # Sort index by pressure_dbar
-    # Fill NaN values with None for JSON serialization
-    # df2 = df2.where(pd.notnull(df2), None)
-    return df2.transpose()
+    Args:
+        start_date, end_date: First and last day (date or 'YYYY-MM-DD').
+        datatype (str): One of valid_datatypes.
+        depths (list): Depths from depth_set.
+        dbconn (str): Database connection string.
+        resampling (str): 'all' or a key of timeframe_step_map.
+        cube (DataCube): Read from this data cube when it is available, otherwise from the database.
 
+    Returns:
+        tuple: (ts, values) with values[j][i] the value at depth j and ts[i] (NaN: no data).
 
+    Raises:
+        ValueError: For an invalid datatype, depth, resampling or date range.
+    """
+    query = build_series_query(start_date, end_date, datatype, depths, resampling)
+    if cube is not None:
+        found = cube_series(cube, start_date, end_date, datatype, depths, resampling)
+        metrics.inc('datacube_reads_total', source='cube' if found is not None else 'database')
+        if found is not None:
+            return found
+    columns, rows = fetch_rows(dbconn, query, label='series')
+    return series_result(rows, start_date, end_date, depths, resampling)
+
+def series_columns(ts, values, datatype, depths, resampling):
+    """
+    The columnar /api/v2/series response, values[j][i] is the value at depth[j] and ts[i].
+    """
+    return {'datatype': datatype,
+            'resampling': resampling,
+            'depth': series_depths(depths),
+            'ts': ts,
+            'values': np.ascontiguousarray(values)}
+
+# Heatmap tiles: 3H data in calendar month tiles ('YYYY-MM'), 1D data in calendar year tiles ('YYYY')
+heatmap_tile_formats = {
+    "3H": "%Y-%m",
+    "1D": "%Y",
+}
+
+def heatmap_tile_range(resampling, tile):
+    """
+    First and last day of a heatmap tile.
+
+    Args:
+        resampling (str): A key of heatmap_tile_formats.
+        tile (str): 'YYYY-MM' for 3H tiles, 'YYYY' for 1D tiles.
+
+    Returns:
+        tuple: (first_day, last_day) as pd.Timestamp
+
+    Raises:
+        ValueError: For an invalid resampling or tile.
+    """
+    if resampling not in heatmap_tile_formats:
+        raise ValueError(f"Invalid resampling: {resampling}. Valid options are: {list(heatmap_tile_formats.keys())}")
+    tile_format = heatmap_tile_formats[resampling]
+    try:
+        first_day = pd.Timestamp(datetime.strptime(tile, tile_format))
+    except ValueError:
+        first_day = None
+    if first_day is None or first_day.strftime(tile_format) != tile:
+        raise ValueError(f"Invalid tile: {tile}. Use YYYY-MM for 3H and YYYY for 1D tiles.")
+    if resampling == '3H':
+        last_day = first_day + pd.offsets.MonthEnd(1)
+    else:
+        last_day = first_day + pd.offsets.YearEnd(1)
+    return first_day, last_day
+
+def heatmap_tile(df, datatype, resampling, tile):
+    """
+    A heatmap tile from the DataFrame of get_resampled_range() for the tile period.
+    z[j][i] is the value at depth[j] and ts[i], so the tiles of a range can be joined along ts.
+    """
+    return {'datatype': datatype,
+            'resampling': resampling,
+            'tile': tile,
+            'ts': df.index.values,
+            'depth': df.columns.values,
+            'z': np.ascontiguousarray(df.to_numpy().T.round(4))}
+
+# Climatology (see pgsql_init/migrations/003_climatology.sql): n, sum and sum of squares per
+# variable, day of year (1-366) and depth of all interpolated data, kept up to date by triggers.
+
+def build_climatology_query(datatype):
+    """
+    Build the query for the climatology sums of one datatype.
+
+    Returns:
+        tuple: (sql_query, query_params)
+
+    Raises:
+        ValueError: For an invalid datatype.
+    """
+    if datatype not in valid_datatypes:
+        raise ValueError(f"Invalid datatype: {datatype}. Valid options are: {valid_datatypes}")
+    return """
+                        SELECT doy, pressure_dbar, n, sum, sumsq
+                        FROM climatology
+                        WHERE variable = %s;
+            """, (datatype,)
+
+def climatology_sums(rows):
+    """
+    The rows of build_climatology_query() as (n, sum, sumsq) arrays of shape (366, len(depth_set)),
+    row d is day of year d + 1.
+    """
+    sums = np.zeros((3, 366, len(depth_set)))
+    if rows:
+        doy, pressure, n, total, sumsq = zip(*rows)
+        di = pd.Index(depth_set).get_indexer(np.asarray(pressure, dtype=float))
+        ti = np.asarray(doy, dtype=int) - 1
+        found = (di >= 0) & (ti >= 0) & (ti < 366)
+        for k, values in enumerate((n, total, sumsq)):
+            sums[k, ti[found], di[found]] = np.asarray(values, dtype=float)[found]
+    return sums
+
+def mean_std(n, total, sumsq):
+    """
+    Mean and sample standard deviation from counts, sums and sums of squares (NaN without data).
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(n > 0, total / n, np.nan)
+        variance = np.where(n > 1, (sumsq - total * mean) / (n - 1), np.nan)
+    return mean, np.sqrt(np.clip(variance, 0, None))
+
+def climatology_window(sums, window):
+    """
+    Sum the climatology over a centered moving window of window days (wrapping around the new year).
+    """
+    if window <= 1:
+        return sums
+    offsets = np.arange(window) - window // 2
+    return sum(np.roll(sums, -offset, axis=1) for offset in offsets)
+
+def climatology_result(rows, datatype, window=1):
+    """
+    The /api/v2/climatology response: mean[d][j], std[d][j] and n[d][j] for day of year doy[d]
+    and depth[j], over a window of window days centered on each day.
+    """
+    n, total, sumsq = climatology_window(climatology_sums(rows), window)
+    mean, std = mean_std(n, total, sumsq)
+    return {'datatype': datatype,
+            'window': window,
+            'doy': np.arange(1, 367),
+            'depth': np.array(depth_set),
+            'mean': mean.round(4),
+            'std': std.round(4),
+            'n': n.astype(np.int64)}
+
+def anomaly_period(end_date, window):
+    """
+    The days of an anomaly period: window days ending on end_date, as (first day, last day).
 
-def generate_datasets(timeframe, datatype, title, dbconn):
+    Raises:
+        ValueError: For an invalid date or window.
+    """
+    try:
+        last_day = pd.Timestamp(datetime.strptime(end_date, '%Y-%m-%d'))
+    except (TypeError, ValueError):
+        raise ValueError("Invalid date format. Use YYYY-MM-DD.")
+    if window < 1 or window > 366:
+        raise ValueError("The window must be from 1 to 366 days.")
+    return last_day - pd.Timedelta(days=window - 1), last_day
+
+def build_anomaly_query(datatype, first_day, last_day):
+    """
+    Build the query for n, sum and sum of squares per depth of one datatype in a period.
+    Only the dives in the period are read.
+
+    Returns:
+        tuple: (sql_query, query_params)
 
+    Raises:
+        ValueError: For an invalid datatype.
+    """
+    if datatype not in valid_datatypes:
+        raise ValueError(f"Invalid datatype: {datatype}. Valid options are: {valid_datatypes}")
+    sql_query = f"""
+                        SELECT pressure_dbar, COUNT({datatype}) AS n, SUM({datatype}) AS sum,
+                        SUM({datatype} * {datatype}) AS sumsq
+                        FROM interpolated_timeseries
+                        JOIN session_data USING(sessionid)
+                        WHERE startdatetime >= %s AND startdatetime < %s
+                          AND {datatype} IS NOT NULL AND {datatype} <> 'NaN'
+                        GROUP BY pressure_dbar;
+            """
+    return sql_query, (first_day.to_pydatetime(), (last_day + pd.Timedelta(days=1)).to_pydatetime())
+
+def anomaly_result(climatology_rows, period_rows, datatype, first_day, last_day):
+    """
+    The /api/v2/anomaly response: the mean per depth in the period, the climatology of the same
+    days of the year in the other years (the period itself is subtracted) and the difference.
+    """
+    days = pd.date_range(first_day, last_day, freq='D')
+    doy_index = np.unique(days.dayofyear.values - 1)
+    n, total, sumsq = climatology_sums(climatology_rows)[:, doy_index, :].sum(axis=1)
+
+    period = np.zeros((3, len(depth_set)))
+    if period_rows:
+        pressure, pn, ptotal, psumsq = zip(*period_rows)
+        di = pd.Index(depth_set).get_indexer(np.asarray(pressure, dtype=float))
+        found = di >= 0
+        for k, values in enumerate((pn, ptotal, psumsq)):
+            period[k, di[found]] = np.asarray([v if v is not None else 0 for v in values], dtype=float)[found]
+    current, current_std = mean_std(*period)
+    # The climatology includes the period itself, compare with the other years only
+    n, total, sumsq = n - period[0], total - period[1], sumsq - period[2]
+    mean, std = mean_std(n, total, sumsq)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        zscore = np.where(std > 0, (current - mean) / std, np.nan)
+    return {'datatype': datatype,
+            'start': first_day.strftime('%Y-%m-%d'),
+            'end': last_day.strftime('%Y-%m-%d'),
+            'depth': np.array(depth_set),
+            'mean': current.round(4),
+            'n': period[0].astype(np.int64),
+            'climatology_mean': mean.round(4),
+            'climatology_std': std.round(4),
+            'climatology_n': np.round(n).astype(np.int64),
+            'anomaly': (current - mean).round(4),
+            'zscore': zscore.round(3)}
+
+
+# Titles of the v1 heatmaps
+heatmap_titles = {'temperature' : 'temperatur vs dybde over tid',
+                  'oxygen' : 'oksygen vs dybde over tid',
+                  'salinity' : 'saltholdighet vs dybde over tid',
+                  'fluorescence' : 'fluorescens vs dybde over tid',
+                  'turbidity' : 'turbiditet vs dybde over tid'}
+
+def build_heatmap_query(timeframe, datatype):
+    """
+    Build the SQL query used by generate_datasets().
+
+    Returns:
+        tuple: (sql_query, query_params)
+
+    Raises:
+        ValueError: For an invalid timeframe or datatype.
+    """
     # Error handling for invalid timeframe or datatype
     if timeframe not in timeframe_sql_map:
         raise ValueError(f"Invalid timeframe: {timeframe}. Valid options are: {list(timeframe_sql_map.keys())}")
     if datatype not in valid_datatypes:
         raise ValueError(f"Invalid datatype: {datatype}. Valid options are: {valid_datatypes}")
 
-    with psycopg2.connect(dbconn) as conn:
-        with conn.cursor() as cur:
-            # Fetch the data for the specified timeframe and datatype
-            cur.execute(f"""
-                        SELECT AVG({datatype}) as val, pressure_dbar, 
+    # Fetch the data for the specified timeframe and datatype
+    sql_query = f"""
+                        SELECT AVG(NULLIF({datatype}, 'NaN')) as val, pressure_dbar, 
                         date_bin('{timeframe_sql_map[timeframe]}', startdatetime, '2001-01-01 00:00') as ts
                         FROM interpolated_timeseries 
                         JOIN session_data USING(sessionid)
                         WHERE STARTDATETIME >= '2025-01-01 00:00:00'
                         GROUP BY pressure_dbar, ts
                         ORDER BY ts, pressure_dbar ASC;
-            """, {'datatype': datatype, 'timeframe': timeframe})
-            rows = cur.fetchall()
-
-    df = pd.DataFrame(rows, columns=[desc.name for desc in cur.description])
+            """
+    return sql_query, None
+
+def generate_datasets(timeframe, datatype, title, dbconn, cube=None):
+    if cube is not None:
+        graph = cube_heatmap_graph(cube, timeframe, datatype, title)
+        metrics.inc('datacube_reads_total', source='cube' if graph is not None else 'database')
+        if graph is not None:
+            return graph
+    columns, rows = fetch_rows(dbconn, build_heatmap_query(timeframe, datatype), label='heatmap')
+    return heatmap_graph(columns, rows, timeframe, title)
+
+def cube_heatmap_graph(cube, timeframe, datatype, title):
+    """
+    The heatmap graph of generate_datasets() from the data cube (see datacube.py), for the same period
+    as build_heatmap_query(). None if the cube can not be read or has no data for the period.
+    """
+    time_range = cube.time_range()
+    if time_range is None:
+        return None
+    step = timeframe_step_map[timeframe]
+    # Bins with origin 2001-01-01 for the dives from 2025-01-01 up to the last dive
+    start = pd.Timestamp('2025-01-01')
+    origin = pd.Timestamp('2001-01-01')
+    first = origin + ((start - origin) // step) * step
+    periods = pd.date_range(start=first, end=pd.Timestamp(time_range[1]), freq=step)
+    values = cube.resample(datatype, first, len(periods), step, start=start) if len(periods) else None
+    dives = cube.series(datatype, start, first + len(periods) * step) if values is not None else None
+    if dives is None:
+        return None
+    # Like the query, from the first to the last period with dives (their values may all be NaN)
+    bins = ((dives[0] - np.datetime64(first, 'us')) // np.timedelta64(step, 'us')).astype(np.int64)
+    found = np.flatnonzero(np.bincount(bins, minlength=len(periods)))
+    if len(found) == 0:
+        return None
+    df2 = pd.DataFrame(values[found[0]:found[-1] + 1].T, index=depth_set, columns=periods[found[0]:found[-1] + 1])
+    return heatmap_figure(df2, title)
+
+def heatmap_graph(columns, rows, timeframe, title):
+    """
+    Heatmap graph (depth vs time) from the rows of build_heatmap_query().
+    """
+    df = pd.DataFrame(rows, columns=columns)
     df2 = df.pivot(index='pressure_dbar', columns='ts', values='val')
 
     # Fill inn missing periods with NaN to make plotly happy
     df2 = df2.reindex(pd.date_range(start=df2.columns.min(), 
                                       end=df2.columns.max(), 
-                                      freq=timeframe), 
+                                      freq=timeframe_step_map[timeframe]), 
                                       axis='columns')
     df2 = df2.reindex(depth_set, axis='index')  # include all depths
     df2 = df2.sort_index(axis='columns')  # Sort columns by timestamp
     df2 = df2.sort_index(axis='index')  # Sort index by depth
+    return heatmap_figure(df2, title)
 
-    x = df2.columns    # timestamps
-    y = (-1 * df2.index).tolist()      # depths
-    z = df2.values.round(4).tolist()   # values for the datatype
+def heatmap_figure(df2, title):
+    """
+    Heatmap graph from a (depth x ts) DataFrame with all periods and depths.
+    """
+    # Keep numpy arrays, the serializer writes them directly
+    x = df2.columns.values                # timestamps
+    y = -1 * df2.index.values             # depths
+    z = df2.values.round(4)               # values for the datatype
 
     graph = dict(
         data=[
@@ -377,20 +949,27 @@ def generate_datasets(timeframe, datatype, title, dbconn):
     return graph
 
 
-def get_airtemp(title,dbconn):
-    with psycopg2.connect(dbconn) as conn:
-        with conn.cursor() as cur:
-            # Fetch the average air temperature per day
-            cur.execute("""
-                        SELECT DATE(startdatetime) AS day, AVG(airtemp) AS airtemp 
-                        FROM session_data 
-                        WHERE airtemp IS NOT NULL 
-                        GROUP BY day 
+def build_airtemp_query():
+    # Average air temperature per day, from the daily sums in surface_rollup
+    return """
+                        SELECT DATE(ts) AS day, sum_airtemp / n_airtemp AS airtemp
+                        FROM surface_rollup
+                        WHERE resampling = '1D' AND n_airtemp > 0
                         ORDER BY day;
-            """)
-            rows = cur.fetchall()
+            """, None
+
+def get_airtemp(title, dbconn, max_points=None):
+    columns, rows = fetch_rows(dbconn, build_airtemp_query(), label='airtemp')
+    return airtemp_graph(rows, title, max_points)
+
+def airtemp_graph(rows, title, max_points=None):
+    """
+    Air temperature per day graph from the rows of build_airtemp_query().
+    """
     days = [row[0] for row in rows]
     airtemps = [round(row[1],2) for row in rows]
+    # Limit the number of points sent to the browser (LTTB)
+    days, airtemps = downsample(days, airtemps, max_points)
     
     graphs = [
         dict(
@@ -420,30 +999,64 @@ def get_airtemp(title,dbconn):
     ]
     return graphs
 
+def build_count_query():
+    # Kept up to date by triggers on session_data
+    return """
+                        SELECT dives as count
+                        FROM dataset_summary;
+            """, None
+
 def get_count(dbconn):
-    with psycopg2.connect(dbconn) as conn:
-        with conn.cursor() as cur:
-            cur.execute("""
-                        SELECT COUNT(sessionid) as count 
-                        FROM session_data;
-            """)
-            count = cur.fetchone()[0]
-    return count
+    columns, rows = fetch_rows(dbconn, build_count_query(), label='count')
+    return rows[0][0] if rows else 0
 
 
-def get_surface_data(dbconn, start_date_str, end_date_str, resampling_interval_str, selected_parameters_list):
+# Averages of the surface parameters from the sums in surface_rollup
+surface_rollup_columns = {
+    'airtemp': "sum_airtemp / NULLIF(n_airtemp, 0)",
+    'windspeed': "sum_windspeed / NULLIF(n_windspeed, 0)",
+    'airpressure': "sum_airpressure / NULLIF(n_airpressure, 0)",
+    # Direction of the average wind vector
+    'winddirection': "CASE WHEN n_wind > 0 THEN DEGREES(ATAN2(sum_u, sum_v)) END",
+}
+
+def surface_rollup_range(start, end, resampling_interval_str):
     """
-    Downloads surface data (e.g., air temperature, wind speed) based on specified parameters.
+    The whole surface_rollup bins within a date range.
 
     Args:
-        dbconn (str): Database connection string.
-        start_date_str (str): Start date in 'YYYY-MM-DD' format.
-        end_date_str (str): End date in 'YYYY-MM-DD' format.
-        resampling_interval_str (str): Resampling interval key (e.g., '3H', '1D', 'all').
-        selected_parameters_list (list): List of surface parameter names to download.
-                                         (e.g., ['airtemp', 'windspeed'])
+        start (date): First day of the range.
+        end (date): Day after the range.
+        resampling_interval_str (str): One of timeframe_sql_map.
+
     Returns:
-        pandas.DataFrame: DataFrame containing the requested surface data with a 'ts' DatetimeIndex.
+        tuple: (first, last) datetimes, the bins from first up to last lie within the range.
+               If there are none, both are the end of the range.
+    """
+    start = pd.Timestamp(start)
+    end = pd.Timestamp(end)
+    if resampling_interval_str == '1M':
+        first = pd.offsets.MonthBegin().rollforward(start)
+        last = pd.offsets.MonthBegin().rollback(end)
+    else:
+        # The date_bin bins of build_surface_query() and surface_rollup
+        step = timeframe_step_map[resampling_interval_str]
+        origin = pd.Timestamp('2001-01-03')
+        first = origin - ((origin - start) // step) * step
+        last = origin + ((end - origin) // step) * step
+    if first >= last:
+        return end.to_pydatetime(), end.to_pydatetime()
+    return first.to_pydatetime(), last.to_pydatetime()
+
+def build_surface_query(start_date_str, end_date_str, resampling_interval_str, selected_parameters_list):
+    """
+    Build the SQL query used by get_surface_data().
+
+    Args: see get_surface_data().
+
+    Returns:
+        tuple: (sql_query, query_params)
+
     Raises:
         ValueError: If input parameters are invalid.
     """
@@ -502,21 +1115,56 @@ def get_surface_data(dbconn, start_date_str, end_date_str, resampling_interval_s
 
     sql_query = f"SELECT {', '.join(final_select_clauses)} " \
                 f"FROM session_data " \
-                f"WHERE DATE(startdatetime) BETWEEN %s AND %s"
+                f"WHERE startdatetime >= %s AND startdatetime < %s"
 
-    query_params = [start_date, end_date]
+    query_params = [start_date, end_date + timedelta(days=1)]
 
     if group_by_terms: # Add GROUP BY only if there are terms (i.e., not 'all' or 'all' with specific grouping)
         sql_query += f" GROUP BY {', '.join(group_by_terms)}"
 
+    if resampling_interval_str != 'all':
+        # Whole bins are read from surface_rollup, only the bins cut by the start or end date
+        # are aggregated from session_data
+        first, last = surface_rollup_range(query_params[0], query_params[1], resampling_interval_str)
+        rollup_clauses = ["ts"] + [f'{surface_rollup_columns[p]} AS "{p}"' for p in selected_parameters_list]
+        sql_query = f"SELECT {', '.join(rollup_clauses)} " \
+                    f"FROM surface_rollup " \
+                    f"WHERE resampling = %s AND ts >= %s AND ts < %s " \
+                    f"UNION ALL " \
+                    f"SELECT {', '.join(final_select_clauses)} " \
+                    f"FROM session_data " \
+                    f"WHERE (startdatetime >= %s AND startdatetime < %s) OR (startdatetime >= %s AND startdatetime < %s) " \
+                    f"GROUP BY {', '.join(group_by_terms)}"
+        query_params = [resampling_interval_str, first, last, query_params[0], first, last, query_params[1]]
+
     order_by_terms = ['ts'] 
     sql_query += f" ORDER BY {', '.join(order_by_terms)};"
 
+    return sql_query, query_params
+
+def get_surface_data(dbconn, start_date_str, end_date_str, resampling_interval_str, selected_parameters_list):
+    """
+    Downloads surface data (e.g., air temperature, wind speed) based on specified parameters.
+
+    Args:
+        dbconn (str): Database connection string.
+        start_date_str (str): Start date in 'YYYY-MM-DD' format.
+        end_date_str (str): End date in 'YYYY-MM-DD' format.
+        resampling_interval_str (str): Resampling interval key (e.g., '3H', '1D', 'all').
+        selected_parameters_list (list): List of surface parameter names to download.
+                                         (e.g., ['airtemp', 'windspeed'])
+    Returns:
+        pandas.DataFrame: DataFrame containing the requested surface data with a 'ts' DatetimeIndex.
+    Raises:
+        ValueError: If input parameters are invalid.
+    """
+    sql_query, query_params = build_surface_query(start_date_str, end_date_str,
+                                                  resampling_interval_str, selected_parameters_list)
+
     # 3. Execute query and fetch data
-    with psycopg2.connect(dbconn) as conn:
+    with connection(dbconn) as conn:
         with conn.cursor() as cur:
-            # print("Executing Surface SQL:", cur.mogrify(sql_query, tuple(query_params)).decode()) # For debugging
-            cur.execute(sql_query, tuple(query_params))
+            execute(cur, sql_query, tuple(query_params), label='surface')
             rows = cur.fetchall()
             colnames = [desc[0] for desc in cur.description]
 
@@ -538,17 +1186,12 @@ def get_surface_data(dbconn, start_date_str, end_date_str, resampling_interval_s
 
     return df
 
-def get_data_raw(dbconn, start_date_str, end_date_str):
+def build_raw_query(start_date_str, end_date_str):
     """
-    Downloads all raw data columns from the raw_timeseries table for a given date range.
-
-    Args:
-        dbconn (str): Database connection string.
-        start_date_str (str): Start date in 'YYYY-MM-DD' format.
-        end_date_str (str): End date in 'YYYY-MM-DD' format.
+    Build the SQL query used by get_data_raw().
 
     Returns:
-        pandas.DataFrame: DataFrame containing the requested raw data.
+        tuple: (sql_query, query_params)
 
     Raises:
         ValueError: If input parameters are invalid.
@@ -561,20 +1204,43 @@ def get_data_raw(dbconn, start_date_str, end_date_str):
         raise ValueError("Invalid date format. Use YYYY-MM-DD for start and end dates.")
 
     # 2. Construct SQL query
-    # Selects session startdatetime as 'ts' and all columns from raw_timeseries
+    # Selects session startdatetime as 'ts' and the data columns from raw_timeseries.
+    # raw_timeseries is partitioned on its own copy of startdatetime, filtering on it
+    # limits the query to the partitions (months) in the range.
     sql_query = """
-        SELECT sd.startdatetime AS ts, rt.*
+        SELECT sd.startdatetime AS ts, rt.id, rt.sessionid, rt.seq, rt.salinity, rt.temperature,
+               rt.pressure_dbar, rt.oxygen, rt.fluorescence, rt.turbidity
         FROM raw_timeseries rt
         JOIN session_data sd ON rt.sessionid = sd.sessionid
-        WHERE DATE(sd.startdatetime) BETWEEN %s AND %s
+        WHERE rt.startdatetime >= %s AND rt.startdatetime < %s
+          AND sd.startdatetime >= %s AND sd.startdatetime < %s
         ORDER BY ts, rt.sessionid, rt.seq;
     """
-    query_params = [start_date, end_date]
+    query_params = [start_date, end_date + timedelta(days=1)] * 2
+
+    return sql_query, query_params
+
+def get_data_raw(dbconn, start_date_str, end_date_str):
+    """
+    Downloads all raw data columns from the raw_timeseries table for a given date range.
+
+    Args:
+        dbconn (str): Database connection string.
+        start_date_str (str): Start date in 'YYYY-MM-DD' format.
+        end_date_str (str): End date in 'YYYY-MM-DD' format.
+
+    Returns:
+        pandas.DataFrame: DataFrame containing the requested raw data.
+
+    Raises:
+        ValueError: If input parameters are invalid.
+    """
+    sql_query, query_params = build_raw_query(start_date_str, end_date_str)
 
     # 3. Execute query and fetch data
-    with psycopg2.connect(dbconn) as conn:
+    with connection(dbconn) as conn:
         with conn.cursor() as cur:
-            cur.execute(sql_query, tuple(query_params))
+            execute(cur, sql_query, tuple(query_params), label='raw')
             rows = cur.fetchall()
             colnames = [desc[0] for desc in cur.description]
     
@@ -585,27 +1251,22 @@ def get_data_raw(dbconn, start_date_str, end_date_str):
         if 'ts' in df.columns:
             df['ts'] = pd.to_datetime(df['ts'])
         
-        # Convert pressure_dbar to numeric if it exists from rt.*
+        # Convert pressure_dbar to numeric if it exists
         if 'pressure_dbar' in df.columns:
             df['pressure_dbar'] = pd.to_numeric(df['pressure_dbar'], errors='coerce')
         
-        # Other columns from rt.* will retain their types as fetched from DB
+        # Other columns from raw_timeseries will retain their types as fetched from DB
         # or converted by pandas.DataFrame constructor.
         # More specific type conversions could be added here if needed.
 
     return df
 
-def get_data_sessions(dbconn, start_date_str, end_date_str):
+def build_sessions_query(start_date_str, end_date_str):
     """
-    Downloads all columns from the session_data table for a given date range.
-
-    Args:
-        dbconn (str): Database connection string.
-        start_date_str (str): Start date in 'YYYY-MM-DD' format.
-        end_date_str (str): End date in 'YYYY-MM-DD' format.
+    Build the SQL query used by get_data_sessions().
 
     Returns:
-        pandas.DataFrame: DataFrame containing the requested session data.
+        tuple: (sql_query, query_params)
 
     Raises:
         ValueError: If input parameters are invalid.
@@ -622,15 +1283,34 @@ def get_data_sessions(dbconn, start_date_str, end_date_str):
     sql_query = """
         SELECT *, ST_AsText(location) AS location
         FROM session_data
-        WHERE DATE(startdatetime) BETWEEN %s AND %s
+        WHERE startdatetime >= %s AND startdatetime < %s
         ORDER BY startdatetime;
     """
-    query_params = [start_date, end_date]
+    query_params = [start_date, end_date + timedelta(days=1)]
+
+    return sql_query, query_params
+
+def get_data_sessions(dbconn, start_date_str, end_date_str):
+    """
+    Downloads all columns from the session_data table for a given date range.
+
+    Args:
+        dbconn (str): Database connection string.
+        start_date_str (str): Start date in 'YYYY-MM-DD' format.
+        end_date_str (str): End date in 'YYYY-MM-DD' format.
+
+    Returns:
+        pandas.DataFrame: DataFrame containing the requested session data.
+
+    Raises:
+        ValueError: If input parameters are invalid.
+    """
+    sql_query, query_params = build_sessions_query(start_date_str, end_date_str)
 
     # 3. Execute query and fetch data
-    with psycopg2.connect(dbconn) as conn:
+    with connection(dbconn) as conn:
         with conn.cursor() as cur:
-            cur.execute(sql_query, tuple(query_params))
+            execute(cur, sql_query, tuple(query_params), label='sessions')
             rows = cur.fetchall()
             colnames = [desc[0] for desc in cur.description]
     
@@ -648,6 +1328,63 @@ def get_data_sessions(dbconn, start_date_str, end_date_str):
 
     return df
 
+@contextmanager
+def export_snapshot(dbconn):
+    """
+    Connection with a read-only REPEATABLE READ transaction, for exports of several queries
+    (e.g. session_data and raw_timeseries) that must see the same data. Pass it to
+    iter_query_chunks(conn=...). The transaction is rolled back and the connection closed at the end.
+    """
+    conn = psycopg2.connect(dbconn)
+    try:
+        conn.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ, readonly=True)
+        yield conn
+    finally:
+        conn.rollback()
+        conn.close()
+
+def iter_query_chunks(dbconn, sql_query, query_params, chunk_size=5000, label='export', conn=None):
+    """
+    Run a query with a named (server-side) cursor and yield the result in chunks,
+    so that memory use does not depend on the size of the result.
+
+    Args:
+        dbconn (str): Database connection string.
+        sql_query (str): SQL query, e.g. from build_download_query().
+        query_params (list): Query parameters.
+        chunk_size (int): Number of rows fetched per round trip.
+        label (str): Name of the query in the query timing (see querylog.py).
+        conn: Connection to run the query in, e.g. from export_snapshot() (default: a new connection
+              that is closed at the end).
+
+    Yields:
+        tuple: (description, rows) where description is the cursor description and
+               rows is a list of at most chunk_size tuples. At least one (possibly
+               empty) chunk is yielded, so the column names are always available.
+    """
+    if conn is None:
+        with export_snapshot(dbconn) as conn:
+            yield from iter_query_chunks(dbconn, sql_query, query_params, chunk_size, label, conn)
+        return
+    with conn.cursor(name=f"export_{uuid.uuid4().hex}") as cur:
+        cur.itersize = chunk_size
+        # Time spent in the database, not in the consumer of the chunks
+        t0 = time.perf_counter()
+        cur.execute(sql_query, tuple(query_params))
+        rows = cur.fetchmany(chunk_size)
+        seconds = time.perf_counter() - t0
+        n_rows = len(rows)
+        yield cur.description, rows
+        while rows:
+            t0 = time.perf_counter()
+            rows = cur.fetchmany(chunk_size)
+            seconds += time.perf_counter() - t0
+            n_rows += len(rows)
+            if rows:
+                yield cur.description, rows
+    # A plain EXPLAIN, running a whole export again with ANALYZE would be expensive
+    querylog.record(label, seconds, sql_query, tuple(query_params), rows=n_rows, conn=conn, analyze=False)
+
 def load_config():
     """
     Searches for config.json in the current directory (relative to this file), parent, and grandparent directories,
@@ -1,17 +1,29 @@
 # -*- coding: utf-8 -*-
-from flask import Flask, jsonify, Response, request
-from flask import render_template, send_from_directory
+from flask import Flask, jsonify, Response, request, stream_with_context
+from flask import render_template, send_from_directory, send_file
 from flask_cors import CORS, cross_origin
 from datetime import datetime, timedelta
 from bson import json_util
-import json
-import plotly
 import os
+import threading
 from werkzeug.middleware.dispatcher import DispatcherMiddleware
-from download_frontend import DownloadFrontend
-
-from utils import generate_datasets, generate_freq, get_airtemp, get_valid_years, get_count, get_resampled_day, get_freq
-from utils import get_datatype_name, names_new_to_old_map, load_config
+from export_jobs import ExportJobs
+
+from utils import generate_datasets, generate_freq, get_airtemp, get_dataset_summary, get_resampled_day, get_resampled_range, get_freq
+from utils import get_datatype_name, load_config, load_translator, heatmap_titles, resampled_day_v1, resampled_range_columns
+from utils import build_download_query, build_surface_query, build_raw_query, build_sessions_query
+from utils import heatmap_tile, heatmap_tile_range, fetch_rows, get_series, series_columns
+from utils import build_climatology_query, climatology_result, anomaly_period, build_anomaly_query, anomaly_result
+from datacube import DataCube
+from dive_index import get_dive_index
+from events import DiveEvents
+from memcache import LRUCache
+from exports import export_formats, iter_export, iter_raw_export
+from serialize import dumps, dumps_bytes, json_response
+import dbpool
+import http_cache
+import metrics
+import querylog
 
 configdata = load_config()
 PGCONN=configdata['pg_conn']
@@ -22,42 +34,120 @@ app = Flask(__name__) # Changed from main_app
 # We add the new download frontend to the original Flask app.
 # (These are not dependent on the main app, and can be used independently)
 global_prefix = os.environ.get('SCRIPT_NAME', '').rstrip('/')
-download_frontend_no = DownloadFrontend(PGCONN, language='no', requests_pathname_prefix = global_prefix + '/download/')
-download_frontend_en = DownloadFrontend(PGCONN, language='en', requests_pathname_prefix = global_prefix + '/download/en/')
+# Large raw exports are run in the background and stored in export_dir (a temporary directory if not set)
+export_jobs = ExportJobs(export_dir=configdata.get('export_dir'))
+# Closed heatmap tiles (see heatmaptile), an entry is about 50 KB of JSON
+heatmap_tile_cache = LRUCache(maxsize=configdata.get('heatmap_tile_cache_size', 512), name='heatmap_tile')
+# Dive counts and years for the frontpage and /count, new dives show up after at most dataset_summary_ttl seconds
+dataset_summary_cache = LRUCache(maxsize=1, name='dataset_summary', ttl=configdata.get('dataset_summary_ttl', 30))
+# New dives from the ingest for /api/v2/events, each connected client holds a worker thread
+dive_events = DiveEvents(PGCONN, max_clients=configdata.get('events_max_clients', 20))
+# Memory-mapped copy of the interpolated data kept up to date by processraw (see datacube.py), the
+# heatmaps and resampled data are read from it and from the database when it is not there or stale
+data_cube = DataCube(configdata['datacube_dir']) if configdata.get('datacube_dir') else None
+# Maximum number of points in the daily scatter graphs (None: all points), can be overridden with ?max_points=
+GRAPH_MAX_POINTS = configdata.get('graph_max_points')
+frontend_options = dict(stream_url_prefix=global_prefix + '/api/v2/download/',
+                        export_jobs=export_jobs,
+                        export_url_prefix=global_prefix + '/api/v2/export/',
+                        job_threshold_dives=configdata.get('export_job_threshold_dives', 2000),
+                        overview_max_points=GRAPH_MAX_POINTS)
+
+
+class LazyWSGIApp:
+    """
+    WSGI app built by factory() on the first request. Keeps dash, plotly and the
+    download page out of the worker startup.
+    """
+    def __init__(self, factory):
+        self.factory = factory
+        self.wsgi_app = None
+        self.lock = threading.Lock()
+
+    def get_app(self):
+        if self.wsgi_app is None:
+            with self.lock:
+                if self.wsgi_app is None:
+                    self.wsgi_app = self.factory()
+        return self.wsgi_app
+
+    def __call__(self, environ, start_response):
+        return self.get_app()(environ, start_response)
+
+
+def build_download_frontend():
+    # One Dash app for both languages, /download/ is Norwegian and /download/en/ English
+    from download_frontend import DownloadFrontend
+    frontend = DownloadFrontend(PGCONN, language='no', languages=('no', 'en'),
+                                requests_pathname_prefix=global_prefix + '/download/', **frontend_options)
+    metrics.init_app(frontend.app.server, dash_app=frontend.app)
+    http_cache.init_app(frontend.app.server)
+    return frontend.app.server
+
+download_frontend = LazyWSGIApp(build_download_frontend)
 
 # Remember no trailing slashes!
 app.wsgi_app = DispatcherMiddleware(
     app.wsgi_app, {
-    '/download': download_frontend_no.app.server,  
-    '/download/en': download_frontend_en.app.server,
+    '/download': download_frontend,
 })
 
+# Latency and size per route, pool and cache use at /metrics (see metrics.py), before http_cache
+# so the sizes are after compression
+metrics.init_app(app, endpoint='/metrics' if configdata.get('metrics_endpoint', True) else None)
+dbpool.init(min_size=configdata.get('db_pool_min_size', 1), max_size=configdata.get('db_pool_max_size', 10))
+
+# Cache headers for closed periods, ETags and compression (see http_cache.py)
+http_cache.init_app(app,
+                    immutable_after_days=configdata.get('immutable_after_days', 8),
+                    compress_min_size=configdata.get('compress_min_size', 1024))
+
+# Query timing and the slow query log (see querylog.py)
+querylog.init(slow_query_ms=configdata.get('slow_query_ms', 1000),
+              explain=configdata.get('slow_query_explain', True))
+
+def max_points_arg():
+    max_points = request.args.get('max_points')
+    if max_points is None:
+        return GRAPH_MAX_POINTS
+    if not max_points.isdigit() or int(max_points) < 3:
+        raise ValueError("max_points must be an integer of at least 3.")
+    return int(max_points)
+
+def dataset_summary():
+    summary = dataset_summary_cache.get(PGCONN)
+    if summary is None:
+        summary = get_dataset_summary(PGCONN)
+        dataset_summary_cache.put(PGCONN, summary)
+    return summary
+
+def window_arg(default=7):
+    window = request.args.get('window')
+    if window is None:
+        return default
+    if not window.isdigit() or not 1 <= int(window) <= 366:
+        raise ValueError("The window must be an integer from 1 to 366 days.")
+    return int(window)
+
 # the main page
 @app.route('/')
 def frontpage():
-    return render_template('frontpage.html', valid_years=get_valid_years(PGCONN))
+    return render_template('frontpage.html', valid_years=list(dataset_summary()['years']))
 
 
 @app.route('/api/v1/heatmap/<dtype>.json', methods=['GET'])
 def heatmapapi(dtype):
     try: 
         dtype = get_datatype_name(dtype)
+        graph = generate_datasets('3H', dtype, heatmap_titles[dtype], PGCONN, cube=data_cube)
 
-        mapping = {'temperature' : 'temperatur vs dybde over tid',
-                   'oxygen' : 'oksygen vs dybde over tid',
-                   'salinity' : 'saltholdighet vs dybde over tid',
-                   'fluorescence' : 'fluorescens vs dybde over tid',
-                   'turbidity' : 'turbiditet vs dybde over tid'}
-        graph = generate_datasets('3H', dtype, mapping[dtype], PGCONN)
-        graphJSON = json.dumps(graph, cls=plotly.utils.PlotlyJSONEncoder)
-
-        resp = Response(graphJSON, status=200, mimetype='application/json')
+        resp = json_response(graph)
     except Exception as e:
         error_message = {
             "error": "An error occurred while processing your request.",
             "message": repr(e)
         }
-        resp = Response(json.dumps(error_message), status=500, mimetype='application/json')
+        resp = json_response(error_message, status=500)
 
     return resp
 
@@ -66,10 +156,13 @@ def heatmapapi(dtype):
 def airtempgraphsapi():
 
     g = {'id': 'Lufttemperatur', 'desc': 'Lufttemperatur gjennomsnitt pr døgn'}
-    graph = get_airtemp(g['desc'],PGCONN)
+    try:
+        max_points = max_points_arg()
+    except ValueError as e:
+        return json_response({"error": str(e)}, status=400)
+    graph = get_airtemp(g['desc'], PGCONN, max_points=max_points)
 
-    graphJSON = json.dumps(graph[0], cls=plotly.utils.PlotlyJSONEncoder)
-    resp = Response(graphJSON, status=200, mimetype='application/json')
+    resp = json_response(graph[0])
 
     return resp
 
@@ -79,34 +172,39 @@ def statsapi():
     ids = []
     graphs = []
     g ={'id': 'Freq', 'desc': 'Dykk pr dag'}
-    graph = generate_freq(g['desc'],PGCONN)
+    try:
+        max_points = max_points_arg()
+    except ValueError as e:
+        return json_response({"error": str(e)}, status=400)
+    graph = generate_freq(g['desc'], PGCONN, max_points=max_points)
 
-    graphJSON = json.dumps(graph[0], cls=plotly.utils.PlotlyJSONEncoder)
-    resp = Response(graphJSON, status=200, mimetype='application/json')
+    resp = json_response(graph[0])
 
     return resp
 
 
 # this resource will return a web-page with all graphs for the lifetime of the DTS
-# it is not very fast because it contains a LOT of data - this can be improved by either updating a plot at plot.ly
-# or using javascript queries
+# the page loads the heatmap tiles (/api/v2/heatmap/...) for the visible range itself,
+# daily tiles for long ranges and 3 hour tiles when zoomed in
 @app.route('/allgraphs')
 def allgraphs():
     ids = []
-    graphs = []
+    titles = []
     for g in [{'id': 'temperature', 'desc': 'temp vs dybde over tid'},
               {'id': 'oxygen', 'desc': 'oksygen vs dybde over tid'},
               {'id': 'salinity', 'desc': 'salt vs dybde over tid'},
               {'id': 'fluorescence', 'desc': 'fluorescens vs dybde over tid'},
               {'id': 'turbidity', 'desc': 'turbiditet vs dybde over tid'}, ]:
-        graph = generate_datasets('3H', g['id'], g['desc'],PGCONN)
         ids.append(g['id'])
-        graphs.append(graph)
+        titles.append(g['desc'])
 
-    graphJSON = json.dumps(graphs, cls=plotly.utils.PlotlyJSONEncoder)
+    days = get_dive_index(PGCONN).dataframe().index
+    today = datetime.now().strftime('%Y-%m-%d')
     return render_template('graphview.html',
                            ids=ids,
-                           graphJSON=graphJSON)
+                           tiles=dict(titles=titles,
+                                      first_day=days.min().strftime('%Y-%m-%d') if len(days) else today,
+                                      last_day=days.max().strftime('%Y-%m-%d') if len(days) else today))
 
 
 @app.route('/static/<path:path>')
@@ -118,11 +216,11 @@ def airtempgraphs():
     ids = []
     graphs = []
     for g in [{'id': 'Lufttemperatur', 'desc': 'Lufttemperatur gjennomsnitt pr døgn'},]:
-        graph = get_airtemp(g['desc'], PGCONN)
+        graph = get_airtemp(g['desc'], PGCONN, max_points=GRAPH_MAX_POINTS)
         ids.append(g['id'])
         graphs.append(graph[0])
 
-    graphJSON = json.dumps(graphs, cls=plotly.utils.PlotlyJSONEncoder)
+    graphJSON = dumps(graphs)
     return render_template('graphview.html',
                            ids=ids,
                            graphJSON=graphJSON)
@@ -137,31 +235,121 @@ def airtempgraphs():
 def resampleddayjson(dtype,thisdate):
     dtype_in = get_datatype_name(dtype)
     
-    df = get_resampled_day(thisdate, dtype_in, '3H', PGCONN)
+    df = get_resampled_day(thisdate, dtype_in, '3H', PGCONN, cube=data_cube)
     if df is None:
         return jsonify({"error": "Invalid date format. Use YYYYMMDD."}), 400
 
-    res = []
-    dtype_out = names_new_to_old_map.get(dtype_in)
-    for index, row in df.iterrows():
-        # Convert the index to a string
-        output_row = {  'datatype': dtype_out, 
-                        'ts' :index.strftime('%Y-%m-%d %H:%M:%S'),
-                        'divedata': [ {'pressure(dBAR)':k,dtype_out:v} for k,v in row.items() ] 
-                    } 
-        res.append(output_row)
-    return jsonify(res)
+    res = resampled_day_v1(df, dtype_in)
+    # Past days never change
+    return http_cache.cache_period(jsonify(res), thisdate)
+
+# Resampled data for a date range as columnar arrays, replaces one /resampledday call per day.
+# Dates are YYYY-MM-DD (both inclusive), dtype uses the v2 names (v1 names are accepted), e.g.
+#   /api/v2/resampled/temperature.json?start=2025-01-01&end=2025-01-31&resampling=3H
+# Returns {"datatype", "resampling", "ts": [...], "depth": [...], "values": [[...], ...]}
+# where values[i][j] is the value at ts[i] and depth[j] (null if there is no data).
+@app.route('/api/v2/resampled/<dtype>.json')
+def resampled_range(dtype):
+    args = request.args
+    try:
+        datatype = get_datatype_name(dtype)
+        start, end = args.get('start'), args.get('end')
+        if not start or not end:
+            raise ValueError("The start and end parameters (YYYY-MM-DD) are required.")
+        resampling = args.get('resampling', '3H')
+        df = get_resampled_range(datetime.strptime(start, '%Y-%m-%d'), datetime.strptime(end, '%Y-%m-%d'),
+                                 datatype, resampling, PGCONN, cube=data_cube)
+    except ValueError as e:
+        return json_response({"error": str(e)}, status=400)
+    resp = json_response(resampled_range_columns(df, datatype, resampling))
+    return http_cache.cache_period(resp, end)
+
+# One datatype at one or a few depths for line charts, per dive or resampled, e.g. the temperature at 2.5 m:
+#   /api/v2/series/temperature.json?depth=2.5&start=2020-01-01&end=2024-12-31&resampling=1D
+# depth can be given several times, resampling is 'all' (one value per dive, the default) or 3H to 1W.
+# Returns {"datatype", "resampling", "depth": [...], "ts": [...], "values": [[...], ...]}
+# where values[j][i] is the value at depth[j] and ts[i] (null if there is no data).
+@app.route('/api/v2/series/<dtype>.json')
+def series(dtype):
+    args = request.args
+    try:
+        datatype = get_datatype_name(dtype)
+        start, end = args.get('start'), args.get('end')
+        if not start or not end:
+            raise ValueError("The start and end parameters (YYYY-MM-DD) are required.")
+        depths = args.getlist('depth')
+        resampling = args.get('resampling', 'all')
+        ts, values = get_series(datetime.strptime(start, '%Y-%m-%d'), datetime.strptime(end, '%Y-%m-%d'),
+                                datatype, depths, PGCONN, resampling=resampling, cube=data_cube)
+    except ValueError as e:
+        return json_response({"error": str(e)}, status=400)
+    resp = json_response(series_columns(ts, values, datatype, depths, resampling))
+    return http_cache.cache_period(resp, end)
+
+# The heatmap in fixed time tiles: one calendar month at 3H (tile YYYY-MM) or one year at 1D (tile YYYY),
+#   /api/v2/heatmap/temperature/3H/2025-01.json
+# Returns {"datatype", "resampling", "tile", "ts": [...], "depth": [...], "z": [[...], ...]}
+# where z[j][i] is the value at depth[j] and ts[i]. Closed tiles never change, they are cached
+# here and sent as immutable, so only the current tile is computed again.
+@app.route('/api/v2/heatmap/<dtype>/<resampling>/<tile>.json')
+def heatmaptile(dtype, resampling, tile):
+    try:
+        datatype = get_datatype_name(dtype)
+        first_day, last_day = heatmap_tile_range(resampling, tile)
+    except ValueError as e:
+        return json_response({"error": str(e)}, status=400)
+    closed = http_cache.is_closed_period(last_day)
+    key = (datatype, resampling, tile)
+    body = heatmap_tile_cache.get(key) if closed else None
+    if body is None:
+        df = get_resampled_range(first_day, last_day, datatype, resampling, PGCONN, cube=data_cube)
+        body = dumps_bytes(heatmap_tile(df, datatype, resampling, tile))
+        if closed:
+            heatmap_tile_cache.put(key, body)
+    return http_cache.cache_period(Response(body, mimetype='application/json'), last_day)
+
+# Climatology per day of year and depth from the precomputed sums (see utils.build_climatology_query),
+#   /api/v2/climatology/temperature.json?window=7
+# Returns {"datatype", "window", "doy": [1..366], "depth": [...], "mean", "std", "n"} where
+# mean[d][j] is the mean over all years for the window days centered on doy[d] at depth[j].
+@app.route('/api/v2/climatology/<dtype>.json')
+def climatology(dtype):
+    try:
+        datatype = get_datatype_name(dtype)
+        window = window_arg()
+    except ValueError as e:
+        return json_response({"error": str(e)}, status=400)
+    columns, rows = fetch_rows(PGCONN, build_climatology_query(datatype), label='climatology')
+    return json_response(climatology_result(rows, datatype, window))
+
+# The mean per depth in the window days ending on date compared with the same days in the other years,
+#   /api/v2/anomaly/temperature.json?date=2025-02-14&window=7   (default: the last 7 days)
+# Returns {"datatype", "start", "end", "depth", "mean", "n", "climatology_mean", "climatology_std",
+# "climatology_n", "anomaly", "zscore"} with one value per depth. Only the dives in the window are read.
+@app.route('/api/v2/anomaly/<dtype>.json')
+def anomaly(dtype):
+    args = request.args
+    try:
+        datatype = get_datatype_name(dtype)
+        first_day, last_day = anomaly_period(args.get('date', datetime.now().strftime('%Y-%m-%d')),
+                                             window_arg())
+    except ValueError as e:
+        return json_response({"error": str(e)}, status=400)
+    columns, climatology_rows = fetch_rows(PGCONN, build_climatology_query(datatype), label='climatology')
+    columns, period_rows = fetch_rows(PGCONN, build_anomaly_query(datatype, first_day, last_day), label='anomaly')
+    # Not cached as immutable, the climatology changes with every new dive
+    return json_response(anomaly_result(climatology_rows, period_rows, datatype, first_day, last_day))
 
 @app.route('/stats')
 def stats():
     ids = []
     graphs = []
     for g in [{'id': 'Freq', 'desc': 'Dykk pr dag'},]:
-        graph = generate_freq(g['desc'],PGCONN)
+        graph = generate_freq(g['desc'], PGCONN, max_points=GRAPH_MAX_POINTS)
         ids.append(g['id'])
         graphs.append(graph[0])
 
-    graphJSON = json.dumps(graphs, cls=plotly.utils.PlotlyJSONEncoder)
+    graphJSON = dumps(graphs)
     return render_template('graphview.html',
                            ids=ids,
                            graphJSON=graphJSON)
@@ -173,10 +361,131 @@ def dives():
     return resp 
 
 
+# Streaming downloads. The result is read with a server-side cursor and written
+# chunk by chunk, so memory use is constant regardless of the date range.
+# Formats are csv, xlsx, parquet and arrow (the last two if pyarrow is installed).
+# Dates are YYYY-MM-DD, e.g.
+#   /api/v2/download/resampled.csv?start=2025-01-01&end=2025-01-31&resampling=3H&parameters=temperature&parameters=oxygen
+def stream_download(query, filename, download_format, end_date):
+    mimetype = export_formats[download_format][1]
+    resp = Response(stream_with_context(iter_export(PGCONN, query, download_format)), status=200, mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+    # Periods that ended more than a week ago are cacheable for good
+    return http_cache.cache_period(resp, end_date)
+
+def date_range_args(download_format):
+    if download_format not in export_formats:
+        raise ValueError(f"Invalid format: {download_format}. Valid options are: {list(export_formats.keys())}")
+    start, end = request.args.get('start'), request.args.get('end')
+    if not start or not end:
+        raise ValueError("The start and end parameters (YYYY-MM-DD) are required.")
+    return start, end
+
+@app.route('/api/v2/download/resampled.<download_format>')
+def download_resampled(download_format):
+    args = request.args
+    try:
+        start, end = date_range_args(download_format)
+        depth_range = [float(args.get('depth_min', 0.5)), float(args.get('depth_max', 19.5))]
+        parameters = args.getlist('parameters')
+        query = build_download_query(start, end, depth_range,
+                                     args.get('resampling', '3H'),
+                                     args.get('aggregation', 'all_selected'),
+                                     parameters)
+        if query is None:
+            raise ValueError(f"No valid depths in the range {depth_range}.")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return stream_download(query, f"resampled_data_{start}_to_{end}.{download_format}", download_format, end)
+
+@app.route('/api/v2/download/surface.<download_format>')
+def download_surface(download_format):
+    args = request.args
+    try:
+        start, end = date_range_args(download_format)
+        query = build_surface_query(start, end, args.get('resampling', 'all'), args.getlist('parameters'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return stream_download(query, f"surface_data_{start}_to_{end}.{download_format}", download_format, end)
+
+# All columns of session_data and raw_timeseries, read in one snapshot. xlsx gives a workbook with a sheet
+# per table, the other formats a zip with a file per table. lang (no or en) sets the sheet names.
+#   /api/v2/download/raw_export.csv?start=2025-01-01&end=2025-01-31  ->  raw_data_2025-01-01_to_2025-01-31.zip
+@app.route('/api/v2/download/raw_export.<download_format>')
+def download_raw_export(download_format):
+    try:
+        start, end = date_range_args(download_format)
+        t = load_translator('en' if request.args.get('lang') == 'en' else 'no')
+        # Checks the dates before the response starts
+        build_raw_query(start, end)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    extension = 'xlsx' if download_format == 'xlsx' else 'zip'
+    mimetype = export_formats['xlsx'][1] if download_format == 'xlsx' else 'application/zip'
+    resp = Response(stream_with_context(iter_raw_export(PGCONN, start, end, t, download_format)), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename=raw_data_{start}_to_{end}.{extension}'})
+    return http_cache.cache_period(resp, end)
+
+@app.route('/api/v2/download/raw.<download_format>')
+def download_raw(download_format):
+    try:
+        start, end = date_range_args(download_format)
+        query = build_raw_query(start, end)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return stream_download(query, f"raw_timeseries_data_{start}_to_{end}.{download_format}", download_format, end)
+
+@app.route('/api/v2/download/sessions.<download_format>')
+def download_sessions(download_format):
+    try:
+        start, end = date_range_args(download_format)
+        query = build_sessions_query(start, end)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return stream_download(query, f"session_data_{start}_to_{end}.{download_format}", download_format, end)
+
+
+# Status and result of background export jobs (started from the download page)
+@app.route('/api/v2/export/<job_id>.json')
+def export_job_status(job_id):
+    job = export_jobs.status(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown export job."}), 404
+    return jsonify(job)
+
+@app.route('/api/v2/export/<job_id>/download')
+def export_job_download(job_id):
+    path = export_jobs.path(job_id)
+    if path is None:
+        return jsonify({"error": "The export is not ready."}), 404
+    return send_file(path, as_attachment=True, download_name=export_jobs.status(job_id)['filename'])
+
+
+# New dives as server-sent events (see events.py): "dive" when a dive is stored, "profile" with the
+# interpolated values per depth when it is processed,
+#   const source = new EventSource('/api/v2/events');
+#   source.addEventListener('profile', e => { const dive = JSON.parse(e.data); ... });
+@app.route('/api/v2/events')
+def events():
+    stream = dive_events.stream(request.headers.get('Last-Event-ID'))
+    if stream is None:
+        return json_response({"error": "Too many clients connected to the event stream, try again later."}, status=503)
+    resp = Response(stream, mimetype='text/event-stream')
+    resp.headers['Cache-Control'] = 'no-cache'
+    # Do not let nginx buffer the stream
+    resp.headers['X-Accel-Buffering'] = 'no'
+    return resp
+
 # resource that tells how many dives are in the DB
 @app.route('/count')
 def count():
-    return 'dives {}'.format(get_count(PGCONN))
+    return 'dives {}'.format(dataset_summary()['dives'])
+
+# Recent slow queries with their plans, only with debug_endpoints in config.json
+if configdata.get('debug_endpoints', False):
+    @app.route('/debug/slow-queries')
+    def slow_queries():
+        return json_response(querylog.report())
 
 if __name__ == "__main__":
     app.config['DEBUG'] = True # Changed from dispatcher_app.config